@@ -0,0 +1,754 @@
+#!/usr/bin/env python3.6
+'''Offline benchmarks for msauto, run against the stand-ins from fakes.py'''
+import argparse
+import collections
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import random
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+from fakes import *
+from sheets import *
+from executor import ThreadGate
+from jobstore import JobStore
+from scheduling import FairShare
+from sync import SheetSync
+import tandem
+from mascot import MascotClient
+
+SPREADSHEET = 'bench'
+
+
+def legacy_set_status(service, psample, status, column=STATUS_HEADER):
+    '''Previous set_status(): fetch the whole list for every single cell update'''
+    table = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET, range=LIST_RANGE).execute()
+    colnames = table['values'][0]
+    proj_cn, sample_cn, status_cn = (colnames.index(c) for c in (PROJECT_HEADER, SAMPLE_HEADER, column))
+    for i, row in enumerate(table['values']):
+        if row[proj_cn] == psample[0] and row[sample_cn] == psample[1]:
+            cell = f'List!{column_letter(status_cn)}{i + 1}'
+            body = {'range': cell, 'values': [[status]], 'majorDimension': 'ROWS'}
+            service.spreadsheets().values().update(spreadsheetId=SPREADSHEET, range=cell,
+                                                   valueInputOption='RAW', body=body).execute()
+            return
+
+
+def report(name, elapsed, n, service):
+    calls = sum(service.calls.values())
+    print(f'{name:>10}: {n} updates in {elapsed:.3f}s, {n / elapsed:.0f} updates/s, {calls} API calls '
+          f'({dict(service.calls)})')
+
+
+def bench_status(args):
+    rows = synthetic_table(args.projects, args.samples)
+    psamples = [(r[0], r[1]) for r in rows[1:]]
+    # Import-like workload: two status writes per sample
+    updates = [(ps, s) for ps in psamples for s in ('Waiting for the analysis', 'Converting')]
+
+    service = FakeSheetsService({'List': rows}, latency=args.latency)
+    start = time.perf_counter()
+    for ps, status in updates:
+        legacy_set_status(service, ps, status)
+    report('legacy', time.perf_counter() - start, len(updates), service)
+
+    service = FakeSheetsService({'List': rows}, latency=args.latency)
+    start = time.perf_counter()
+    writer = StatusWriter(service, SPREADSHEET)
+    for ps, status in updates:
+        writer.set(ps, status)
+    writer.close()
+    report('batched', time.perf_counter() - start, len(updates), service)
+
+
+def bench_table(args):
+    rows = synthetic_table(args.projects, args.samples)
+    keys = [(r[0], r[1]) for r in rows[1::max(1, len(rows) // args.lookups)]]
+
+    start = time.perf_counter()
+    for key in keys:
+        next(i for i, r in enumerate(rows) if (r[0], r[1]) == key)
+    elapsed = time.perf_counter() - start
+    print(f'    linear: {len(keys)} lookups over {len(rows) - 1} rows in {elapsed:.3f}s')
+
+    start = time.perf_counter()
+    table = SampleTable(rows)
+    built = time.perf_counter() - start
+    for key in keys:
+        table.sheet_row(key)
+    for p in table.projects():
+        table.project_rows(p)
+    elapsed = time.perf_counter() - start
+    print(f'   indexed: {len(keys)} lookups + {len(table.projects())} project groupings in {elapsed:.3f}s '
+          f'(index built in {built:.3f}s)')
+
+
+def bench_sync(args):
+    rows = synthetic_table(args.projects, args.samples, uploaded='FALSE')
+    service = FakeSheetsService({'List': rows}, latency=args.latency)
+    grid = service.sheets['List']
+    status_col, uploaded_col = SYNTHETIC_HEADER.index(STATUS_HEADER), SYNTHETIC_HEADER.index(UPLOADED_HEADER)
+    edits = [(1 + i * 7919 % (len(grid) - 1)) for i in range(args.polls * args.edits)]
+
+    def edit(poll):
+        # Some samples uploaded every few polls, and our own status writes on many more rows
+        if poll % args.edit_every == 0:
+            for i in edits[poll * args.edits:(poll + 1) * args.edits]:
+                grid[i][uploaded_col] = 'TRUE'
+        for row in grid[1 + poll::args.polls]:
+            row[status_col] = f'Status {poll}'
+
+    start = time.perf_counter()
+    seen = 0
+    for poll in range(args.polls):
+        edit(poll)
+        table = SampleTable(service.spreadsheets().values().get(spreadsheetId=SPREADSHEET,
+                                                                range=LIST_RANGE).execute()['values'])
+        # The stages walked every uploaded row on each poll
+        seen += len(table.uploaded())
+    report_sync('full', time.perf_counter() - start, args.polls, seen, service)
+
+    for row in grid[1:]:
+        row[uploaded_col] = 'FALSE'
+    service.calls.clear()
+    service.cells_read = 0
+    workdir = tempfile.mkdtemp(prefix='bench-sync-')
+    try:
+        sync = SheetSync(JobStore(os.path.join(workdir, 'jobs.sqlite')), service, SPREADSHEET)
+        sync.poll()
+        service.calls.clear()
+        service.cells_read = 0
+        start = time.perf_counter()
+        seen = 0
+        for poll in range(args.polls):
+            edit(poll)
+            table, diff = sync.poll()
+            seen += len(diff.added) + len(diff.changed) + len(diff.removed)
+        report_sync('sync', time.perf_counter() - start, args.polls, seen, service)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def report_sync(name, elapsed, polls, seen, service):
+    print(f'{name:>10}: {polls} polls in {elapsed:.3f}s, {seen} rows handed to the stages, '
+          f'{service.cells_read} cells read, API calls {dict(service.calls)}')
+
+
+def simulate_queue(path, scheduler, workers, arrivals, service):
+    '''Run arrivals [(time, project, owner, priority, samples, kind)] through one stage queue on a simulated
+    clock, returns {kind: [hours waited]}'''
+    clock = [0.0]
+    store = JobStore(path, scheduler=scheduler, clock=lambda: clock[0])
+    arrivals = sorted(arrivals)
+    queued_at, kinds, waits = {}, {}, {}
+    running = []
+    while True:
+        while arrivals and arrivals[0][0] <= clock[0]:
+            t, project, owner, priority, samples, kind = arrivals.pop(0)
+            psamples = [(project, f'{project}_{i:03d}', 'trypsin', 'human') for i in range(samples)]
+            store.set_priorities([(p, s, priority, owner) for p, s, _, _ in psamples])
+            store.enqueue('tandem', psamples)
+            for ps in psamples:
+                queued_at[ps[:2]], kinds[ps[:2]] = t, kind
+        running.sort(key=lambda r: r[0])
+        while running and running[0][0] <= clock[0]:
+            store.ack(running.pop(0)[1])
+        while len(running) < workers:
+            job = store.claim('tandem')
+            if job is None:
+                break
+            key = (job.project, job.sample)
+            waits.setdefault(kinds[key], []).append((clock[0] - queued_at[key]) / 3600)
+            running.append((clock[0] + service, job))
+        events = [t for t, _ in running] + [a[0] for a in arrivals[:1]]
+        if not events:
+            return waits
+        clock[0] = min(events)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def bench_schedule(args):
+    arrivals = [(0, 'BIG', 'group-a', 0, args.big, 'big')]
+    for i in range(args.small_projects):
+        urgent = i % args.urgent_every == 0
+        arrivals.append(((i + 1) * args.small_interval * 3600, f'S{i:03d}', f'group-{"bcd"[i % 3]}',
+                         args.urgent_priority if urgent else 0, args.small, 'urgent' if urgent else 'small'))
+    workdir = tempfile.mkdtemp(prefix='bench-schedule-')
+    try:
+        for name, scheduler in (('fifo', None),
+                                ('fair-share', FairShare(aging=args.aging, share=args.share, window=args.window))):
+            start = time.perf_counter()
+            waits = simulate_queue(os.path.join(workdir, f'{name}.sqlite'), scheduler, args.workers,
+                                   arrivals, args.service * 3600)
+            elapsed = time.perf_counter() - start
+            print(f'{name:>10}: simulated in {elapsed:.2f}s')
+            for kind in ('big', 'small', 'urgent'):
+                w = waits.get(kind, [])
+                if w:
+                    print(f'{kind:>16}: {len(w):4d} jobs, queue wait p50 {percentile(w, 0.5):6.1f}h '
+                          f'p95 {percentile(w, 0.95):6.1f}h max {max(w):6.1f}h')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+FAKES = os.path.abspath(os.path.join(os.path.dirname(__file__), 'fakes.py'))
+FAKE_TANDEM_CMD = f'{sys.executable} {FAKES} tandem {{infile}}'
+
+
+def bench_tandem(args):
+    workdir = tempfile.mkdtemp(prefix='bench-tandem-')
+    try:
+        mgf_file = os.path.join(workdir, 'synthetic.mgf')
+        fasta = os.path.join(workdir, 'synthetic.fasta')
+        synthetic_mgf(mgf_file, args.spectra)
+        synthetic_fasta(fasta, args.proteins)
+        taxonomy = os.path.join(workdir, 'taxonomy.xml')
+        with open(taxonomy, 'w') as f:
+            f.write(f'<?xml version="1.0"?>\n<bioml label="x! taxon-to-file matching list">\n'
+                    f'\t<taxon label="synthetic">\n\t\t<file format="peptide" URL="{fasta}" />\n'
+                    f'\t</taxon>\n</bioml>\n')
+        defaults = os.path.join(workdir, 'defaults.xml')
+        with open(defaults, 'w') as f:
+            f.write(f'<?xml version="1.0"?>\n<bioml>\n'
+                    f'\t<note type="input" label="spectrum, threads">{args.threads}</note>\n'
+                    f'\t<note type="input" label="output, path hashing">no</note>\n</bioml>\n')
+        quiet = lambda line: None
+
+        conf = os.path.join(workdir, 'single.tconf.xml')
+        output = os.path.join(workdir, 'single.tandem.xml')
+        tandem.write_conf(conf, defaults, taxonomy, 'synthetic', mgf_file, output)
+        returncode, single = tandem.search(args.cmd, conf, quiet)
+        print(f'    single: {args.spectra} spectra, {args.threads} threads in {single:.2f}s (exit {returncode})')
+
+        output = os.path.join(workdir, 'split.tandem.xml')
+        split = tandem.search_split(args.cmd, mgf_file, output, defaults, taxonomy, 'synthetic',
+                                    args.shards, ThreadGate(args.threads), quiet)
+        print(f'     split: {args.shards} shards x {max(1, args.threads // args.shards)} threads in {split:.2f}s, '
+              f'speedup {single / split:.2f}x')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_mascot(args):
+    workdir = tempfile.mkdtemp(prefix='bench-mascot-')
+    server = FakeMascot(args.search_time, args.dat_size, args.latency).start()
+    try:
+        mgfs = []
+        for i in range(args.samples):
+            mgfs.append(os.path.join(workdir, f'S{i:03d}.mgf'))
+            synthetic_mgf(mgfs[-1], args.spectra, seed=i)
+        quiet = lambda line: None
+        size = sum(os.path.getsize(mgf) for mgf in mgfs)
+        for concurrency in (1, args.concurrency):
+            client = MascotClient(server.cgi, 'user', 'password', concurrency, poll=args.poll,
+                                  upload_gzip=args.gzip)
+            server.calls.clear()
+            server.bytes_received = 0
+            start = time.perf_counter()
+            searches = [client.search(mgf, {'DB': 'synthetic'}, mgf[:-4] + '.dat', quiet, args.min_intensity,
+                                      args.top_n) for mgf in mgfs]
+            results = client.run(client.gather(*searches))
+            elapsed = time.perf_counter() - start
+            client.close()
+            upload = sum(r.upload_seconds for r in results)
+            print(f'{concurrency:>3} in flight: {args.samples} searches in {elapsed:.2f}s, '
+                  f'{args.samples / elapsed:.2f} searches/s, requests {dict(server.calls)}')
+            print(f'     uploaded {server.bytes_received / 2**20:.1f} of {size / 2**20:.1f} MB MGF '
+                  f'in {upload:.2f}s total upload time')
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def measure(func):
+    '''(seconds, peak MB allocated, result) of func(), timed without the tracing overhead'''
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak / 2**20, result
+
+
+def read_dat_sections(path):
+    '''The whole .dat in memory as {section: {key: value}}, the way the Mascot parser libraries do'''
+    sections = collections.defaultdict(dict)
+    section = None
+    with open(path) as f:
+        for line in f.readlines():
+            if line.startswith('Content-Type: application/x-Mascot'):
+                section = line.split('name="')[1].split('"')[0]
+            elif '=' in line:
+                key, value = line.rstrip('\n').split('=', 1)
+                sections[section][key] = value
+    return sections
+
+
+def bench_summary(args):
+    import results
+
+    workdir = tempfile.mkdtemp(prefix='bench-summary-')
+    try:
+        tandem_xml = os.path.join(workdir, 'S1.tandem.xml')
+        dat = os.path.join(workdir, 'S1.dat')
+        synthetic_tandem_xml(tandem_xml, args.spectra)
+        synthetic_dat(dat, args.spectra)
+        print(f'{"":>28} {"seconds":>8} {"peak MB":>8} {"rows":>7}')
+        for engine, path, naive, name in (
+                ('tandem', tandem_xml, lambda: ET.parse(tandem_xml).getroot().findall('group'), 'ElementTree.parse'),
+                ('mascot', dat, lambda: read_dat_sections(dat)['peptides'], 'whole file in dicts')):
+            print(f'{engine}: {os.path.getsize(path) / 2**20:.1f} MB, {args.spectra} spectra')
+            seconds, peak, found = measure(naive)
+            print(f'{name:>28} {seconds:8.2f} {peak:8.1f} {len(found):7d}')
+            stream = results.iter_tandem if engine == 'tandem' else results.iter_mascot
+            seconds, peak, rows = measure(lambda: list(stream(path)))
+            print(f'{"streaming parse":>28} {seconds:8.2f} {peak:8.1f} {len(rows):7d}')
+            seconds, _, table = measure(lambda: results.write_table(results.psm_frame(stream(path)),
+                                                                    results.psms_base(path)))
+            print(f'{"parse and write table":>28} {seconds:8.2f} {"":>8} {os.path.getsize(table) / 2**20:6.2f}M')
+            seconds, peak, frame = measure(lambda: results.read_table(table))
+            print(f'{"read " + os.path.basename(table):>28} {seconds:8.2f} {peak:8.1f} {len(frame):7d}')
+        seconds, _, _ = measure(lambda: results.aggregate(workdir, 'P1'))
+        print(f'project aggregates from the tables in {seconds:.2f}s')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def simulate_databases(path, scheduler, workers, projects, service, cached):
+    '''Run projects [(project, organism, samples)], all queued at once, through the tandem queue of one node
+    on a simulated clock, whose page cache holds the `cached` databases used last. Returns (searches that
+    started on a cold database, hours each project waited until done)'''
+    clock = [0.0]
+    store = JobStore(path, scheduler=scheduler, clock=lambda: clock[0])
+    for project, organism, samples in projects:
+        store.enqueue('tandem', [(project, f'{project}_{i:03d}', 'trypsin', organism) for i in range(samples)])
+    cache = collections.OrderedDict()
+    running = []
+    cold = 0
+    done = {}
+    while True:
+        running.sort(key=lambda r: r[0])
+        while running and running[0][0] <= clock[0]:
+            job = running.pop(0)[1]
+            store.ack(job)
+            done[job.project] = clock[0] / 3600
+        while len(running) < workers:
+            job = store.claim('tandem')
+            if job is None:
+                break
+            cold += job.organism not in cache
+            cache[job.organism] = True
+            cache.move_to_end(job.organism)
+            while len(cache) > cached:
+                cache.popitem(last=False)
+            running.append((clock[0] + service, job))
+        if not running:
+            return cold, list(done.values())
+        clock[0] = min(end for end, _ in running)
+
+
+def bench_databases(args):
+    from databases import DatabaseManager
+
+    workdir = tempfile.mkdtemp(prefix='bench-databases-')
+    try:
+        store = JobStore(os.path.join(workdir, 'jobs.sqlite'))
+        databases = DatabaseManager(store, workdir, os.path.join(workdir, 'taxonomy.xml'))
+        names = [f'organism{i}' for i in range(args.organisms)]
+        for i, name in enumerate(names):
+            synthetic_fasta(databases.fasta_path(name), args.proteins, seed=i)
+        size = sum(os.path.getsize(databases.fasta_path(name)) for name in names)
+        start = time.perf_counter()
+        infos = [databases.verify(name) for name in names]
+        scanned = time.perf_counter() - start
+        start = time.perf_counter()
+        for name in names:
+            databases.verify(name)
+        known = time.perf_counter() - start
+        print(f'verify {args.organisms} databases, {size / 2**20:.1f} MB: scanned in {scanned:.2f}s '
+              f'({size / 2**20 / scanned:.0f} MB/s), known in {known * 1000:.1f}ms, '
+              f'{sum(i.proteins for i in infos)} proteins, {sum(i.decoys for i in infos)} decoys')
+
+        rnd = random.Random(0)
+        projects = [(f'P{i:03d}', rnd.choice(names), args.samples) for i in range(args.projects)]
+        searches = args.projects * args.samples
+        for name, affinity in (('no affinity', None), (f'affinity {args.affinity}', {'tandem': args.affinity})):
+            scheduler = FairShare(aging=args.aging, affinity=affinity)
+            cold, hours = simulate_databases(os.path.join(workdir, f'{len(name)}.sqlite'), scheduler,
+                                             args.workers, projects, args.service * 3600, args.cached)
+            print(f'{name:>16}: {cold:4d} of {searches} searches on a cold database, '
+                  f'project done p50 {percentile(hours, 0.5):5.1f}h p95 {percentile(hours, 0.95):5.1f}h')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w' if isinstance(content, str) else 'wb') as f:
+        f.write(content)
+
+
+def setup_pipeline(root, args):
+    '''Raw files, maps, prefs and a sheet for args.projects x args.samples, returns (config, sheet rows)'''
+    raw, data, db, conf = (os.path.join(root, d) for d in ('raw', 'data', 'db', 'conf'))
+    for d in (raw, data, db, conf):
+        os.makedirs(d)
+    rows = synthetic_table(args.projects, args.samples)
+    run = SYNTHETIC_HEADER.index(SCAFFOLD_RUN_HEADER)
+    for row in rows[1::args.samples]:
+        row[run] = 'RUN'
+    for row in rows[1:]:
+        write_file(os.path.join(raw, row[0], row[1] + '.raw'), b'\0' * args.raw_size)
+
+    fasta = os.path.join(conf, 'synthetic.fasta')
+    synthetic_fasta(fasta, 200)
+    write_file(os.path.join(conf, 'taxonomy.xml'),
+               f'<?xml version="1.0"?>\n<bioml label="x! taxon-to-file matching list">\n'
+               f'\t<taxon label="synthetic">\n\t\t<file format="peptide" URL="{fasta}" />\n\t</taxon>\n</bioml>\n')
+    write_file(os.path.join(conf, 'tandem.xml'), '<?xml version="1.0"?>\n<bioml>\n'
+               '\t<note type="input" label="spectrum, threads">1</note>\n</bioml>\n')
+    write_file(os.path.join(conf, 'mascot.par'), 'CLE=Trypsin\nCHARGE=2+ and 3+\n')
+    write_file(os.path.join(conf, 'postproc_scaffold_template.scafml'),
+               '<Scaffold name="{{ name }}" fasta="{{ fasta }}" output="{{ output }}">\n'
+               '{% for s in samples %}<BiologicalSample name="{{ s.name }}" category="{{ s.category }}">'
+               '{% for f in s.files %}<InputFile>{{ f }}</InputFile>{% endfor %}</BiologicalSample>\n'
+               '{% endfor %}</Scaffold>\n')
+    write_file(os.path.join(conf, 'postproc.R'), '# postprocessing\n')
+    write_file(os.path.join(db, 'protocol.map'), 'Protocol\tTandem_prefs\tMascot_prefs\tPostproc_prefs\n'
+                                                 'trypsin\ttandem.xml\tmascot.par\tpostproc\n')
+    write_file(os.path.join(db, 'organism.map'), 'Organism\tTandem_db\tMascot_db\nhuman\tsynthetic\tsynthetic\n')
+
+    py = sys.executable
+    config = {
+        'RAW_ROOT': raw, 'DATA_ROOT': data, 'CONF_DIR': conf,
+        'PROTOCOL_MAP': os.path.join(db, 'protocol.map'), 'ORGANISM_MAP': os.path.join(db, 'organism.map'),
+        'TANDEM_TAXONOMY': os.path.join(conf, 'taxonomy.xml'), 'FASTA_DIR': conf,
+        'DB_JOBS_FILE': os.path.join(db, 'jobs.sqlite'), 'RESULT_CACHE_DIR': os.path.join(data, '.cache'),
+        'EVENTS_FILE': os.path.join(db, 'events.jsonl'),
+        'METRICS_FILE': os.path.join(db, 'metrics', 'msauto_{command}.prom'),
+        'CONVERSION_CMD': f'{py} {FAKES} convert {{infile}} {{outdir}} --startup {args.convert_time} '
+                          f'--spectra {args.spectra}',
+        'TANDEM_CMD': f'{py} {FAKES} tandem {{infile}} --startup {args.tandem_time}',
+        'SCAFFOLD_CMD': f'{py} {FAKES} scaffold -f {{infile}} --seconds {args.scaffold_time} '
+                        f'--size {args.sf3_size}',
+        'POSTPROC_CMD': f'{py} {FAKES} postproc {{script}} {{wd}} {{projname}} --seconds {args.postproc_time}',
+        'RAW_SETTLE_TIME': 0, 'RAW_SCAN_INTERVAL': args.poll,
+        'DAEMON_IMPORT_INTERVAL': args.poll, 'DAEMON_SCAFFOLD_INTERVAL': args.poll,
+        'STATUS_FLUSH_INTERVAL': args.poll, 'METRICS_INTERVAL': args.poll,
+        'MASCOT_POLL_TIME': args.poll, 'CONVERT_DISK_RESERVE': 0, 'SCAFFOLD_MEMORY_CAP': None,
+        'TANDEM_SHARD_MIN_SPECTRA': args.spectra + 1,
+    }
+    return config, rows
+
+
+def read_events(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def configure_msauto(msauto, config, rows, latency):
+    '''Point msauto at a setup_pipeline() tree and a fake sheet, returns the fake Sheets service'''
+    from metrics import InstrumentedService
+
+    for name, value in config.items():
+        setattr(msauto, name, value)
+    service = FakeSheetsService({'List': rows}, latency=latency)
+    msauto.g_service = InstrumentedService(service, msauto.get_metrics())
+    problems = msauto.get_prefs_cache().validate()
+    if problems:
+        raise SystemExit('\n'.join(problems))
+    return service
+
+
+def close_msauto(msauto):
+    msauto.flush_status()
+    if msauto.g_mascot:
+        msauto.g_mascot.close()
+    msauto.g_metrics.close()
+    msauto.g_logs.close()
+
+
+def pipeline_finished(counts, projects, stage='scaffold'):
+    '''True once every project went through Scaffold or a job failed'''
+    finished = sum(n for (s, state), n in counts.items() if s == stage and state in ('done', 'failed'))
+    return finished >= projects or any(state == 'failed' for s, state in counts)
+
+
+def report_pipeline(counts, events, args, start, elapsed):
+    samples = args.projects * args.samples
+    done = counts.get(('scaffold', 'done'), 0)
+    print(f'{done}/{args.projects} projects, {samples} samples in {elapsed:.1f}s: '
+          f'{samples / elapsed:.2f} samples/s, {done / elapsed * 3600:.0f} projects/h')
+    failed = {key: n for key, n in counts.items() if key[1] != 'done'}
+    if failed:
+        print(f'  not done: {failed}')
+    print(f'{"stage":>10} {"jobs":>5} {"wait p50":>9} {"p95":>7} {"run p50":>8} {"p95":>7} {"max":>7}')
+    for stage in ('convert', 'tandem', 'mascot', 'scaffold', 'summary'):
+        waits = [e['waited'] for e in events if e['event'] == 'job_start' and e['stage'] == stage]
+        runs = [e['seconds'] for e in events if e['event'] == 'job_end' and e['stage'] == stage]
+        if runs:
+            print(f'{stage:>10} {len(runs):5d} {percentile(waits, 0.5):8.2f}s {percentile(waits, 0.95):6.2f}s '
+                  f'{percentile(runs, 0.5):7.2f}s {percentile(runs, 0.95):6.2f}s {max(runs):6.2f}s')
+    ends = [e['time'] - start for e in events if e['event'] == 'job_end' and e['stage'] == 'scaffold']
+    if ends:
+        print(f'  project done after p50 {percentile(ends, 0.5):.1f}s, p95 {percentile(ends, 0.95):.1f}s')
+
+
+def bench_pipeline(args):
+    import msauto
+
+    root = tempfile.mkdtemp(prefix='bench-pipeline-')
+    server = FakeMascot(args.search_time, args.dat_size, args.latency).start()
+    try:
+        config, rows = setup_pipeline(root, args)
+        service = configure_msauto(msauto, dict(config, MASCOT_CGI=server.cgi), rows, args.latency)
+        workers = {'convert': args.workers, 'tandem': args.workers, 'mascot': args.workers,
+                   'scaffold': args.scaffold_workers, 'summary': args.scaffold_workers}
+        supervisor = msauto.build_supervisor(argparse.Namespace(subparser='bench'), workers)
+        store = msauto.get_job_store()
+
+        def until_done(stopping):
+            deadline = time.time() + args.timeout
+            while not stopping.wait(0.2):
+                if pipeline_finished(store.counts(), args.projects) or time.time() > deadline:
+                    supervisor.stop()
+
+        supervisor.thread('bench', until_done)
+        start = time.time()
+        supervisor.run()
+        elapsed = time.time() - start
+        close_msauto(msauto)
+
+        report_pipeline(store.counts(), read_events(config['EVENTS_FILE']), args, start, elapsed)
+        print(f'  Sheets API calls {dict(service.calls)}, {service.cells_read} cells read')
+        print(f'  Mascot requests {dict(server.calls)}, {server.bytes_received / 2**20:.1f} MB uploaded')
+    finally:
+        server.stop()
+        if args.keep:
+            print(f'  kept {root}')
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_cluster(args):
+    '''The pipeline run by `msauto.py worker` processes sharing one directory, as nodes sharing a mount'''
+    from cluster import NodeRegistry, SharedLock
+
+    root = tempfile.mkdtemp(prefix='bench-cluster-')
+    server = FakeMascot(args.search_time, args.dat_size, args.latency).start()
+    nodes = {}
+    try:
+        config, rows = setup_pipeline(root, args)
+        config.update(MASCOT_CGI=server.cgi, CLUSTER_MODE=True, CLUSTER_DIR=os.path.join(root, 'db', 'cluster'),
+                      JOB_LEASE=args.lease, NODE_TTL=args.lease)
+        write_file(os.path.join(root, 'cluster.json'), json.dumps({'config': config, 'rows': rows,
+                                                                   'latency': args.latency}))
+        for i in range(args.nodes):
+            name = f'node{i}'
+            with open(os.path.join(root, f'{name}.out'), 'w') as out:
+                nodes[name] = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'cluster-node', root, name,
+                                                '--workers', str(args.workers)],
+                                               stdout=out, stderr=subprocess.STDOUT)
+        os.makedirs(config['CLUSTER_DIR'])
+        store = JobStore(config['DB_JOBS_FILE'],
+                         lock=SharedLock(os.path.join(config['CLUSTER_DIR'], 'jobs.lock'), 120, keep=True))
+        start = time.time()
+        killed = None
+        while True:
+            time.sleep(0.5)
+            if args.kill_after and killed is None and time.time() - start > args.kill_after:
+                killed = 'node0'
+                nodes[killed].kill()
+            if all(process.poll() is not None for process in nodes.values()):
+                print('  all nodes exited')
+                break
+            if pipeline_finished(store.counts(), args.projects) or time.time() - start > args.timeout:
+                break
+        elapsed = time.time() - start
+        registry = NodeRegistry(store)
+        alive = registry.nodes(args.lease)
+        for name, process in nodes.items():
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        for process in nodes.values():
+            process.wait()
+
+        events = []
+        for name in nodes:
+            path = os.path.join(root, 'db', f'events.{name}.jsonl')
+            if os.path.exists(path):
+                events += [dict(e, node=name) for e in read_events(path)]
+        report_pipeline(store.counts(), events, args, start, elapsed)
+        print(f'{"node":>8} {"stages":>28} {"convert":>8} {"tandem":>7} {"mascot":>7} {"scaffold":>8}')
+        for node in alive:
+            ended = collections.Counter(e['stage'] for e in events if e['event'] == 'job_end'
+                                        and e['node'] == node['name'] and e['state'] == 'done')
+            print(f'{node["name"]:>8} {",".join(node["stages"]):>28} {ended["convert"]:8d} {ended["tandem"]:7d} '
+                  f'{ended["mascot"]:7d} {ended["scaffold"]:8d}')
+        done = collections.Counter((e['stage'], e['project'], e['sample']) for e in events
+                                   if e['event'] == 'job_end' and e['state'] == 'done')
+        ended = {(e['node'], e['stage'], e['project'], e['sample']) for e in events if e['event'] == 'job_end'}
+        lost = [e for e in events if e['event'] == 'job_start'
+                and (e['node'], e['stage'], e['project'], e['sample']) not in ended]
+        print(f'  {sum(n > 1 for n in done.values())} jobs done twice, {len(lost)} lost with a dead node and run again'
+              + (f' ({killed} killed after {args.kill_after}s)' if killed else ''))
+        print(f'  Mascot requests {dict(server.calls)}')
+    finally:
+        for process in nodes.values():
+            if process.poll() is None:
+                process.kill()
+        server.stop()
+        if args.keep:
+            print(f'  kept {root}')
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_cluster_node(args):
+    import msauto
+
+    with open(os.path.join(args.root, 'cluster.json')) as f:
+        setup = json.load(f)
+    db = os.path.join(args.root, 'db')
+    config = dict(setup['config'], EVENTS_FILE=os.path.join(db, f'events.{args.node}.jsonl'),
+                  METRICS_FILE=os.path.join(db, 'metrics', 'msauto_{command}.prom'))
+    configure_msauto(msauto, config, setup['rows'], setup['latency'])
+    workers = {stage: args.workers for stage in msauto.DAEMON_WORKERS}
+    try:
+        msauto.run_worker(argparse.Namespace(node=args.node, stages=args.stages, subparser='worker', **workers))
+    finally:
+        close_msauto(msauto)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.set_defaults(func=lambda args: parser.print_help())
+    subparsers = parser.add_subparsers(dest='subparser')
+
+    status_parser = subparsers.add_parser('status')
+    status_parser.add_argument('--projects', type=int, default=10)
+    status_parser.add_argument('--samples', type=int, default=20)
+    status_parser.add_argument('--latency', type=float, default=0.05, help='seconds per API call')
+    status_parser.set_defaults(func=bench_status)
+
+    table_parser = subparsers.add_parser('table')
+    table_parser.add_argument('--projects', type=int, default=500)
+    table_parser.add_argument('--samples', type=int, default=100)
+    table_parser.add_argument('--lookups', type=int, default=1000)
+    table_parser.set_defaults(func=bench_table)
+
+    sync_parser = subparsers.add_parser('sync')
+    sync_parser.add_argument('--projects', type=int, default=500)
+    sync_parser.add_argument('--samples', type=int, default=100)
+    sync_parser.add_argument('--polls', type=int, default=20)
+    sync_parser.add_argument('--edits', type=int, default=10, help='rows uploaded per edit')
+    sync_parser.add_argument('--edit-every', type=int, default=3, help='polls between edits')
+    sync_parser.add_argument('--latency', type=float, default=0.05, help='seconds per API call')
+    sync_parser.set_defaults(func=bench_sync)
+
+    schedule_parser = subparsers.add_parser('schedule')
+    schedule_parser.add_argument('--workers', type=int, default=4)
+    schedule_parser.add_argument('--service', type=float, default=1.0, help='hours per search')
+    schedule_parser.add_argument('--big', type=int, default=300, help='samples of the big project')
+    schedule_parser.add_argument('--small', type=int, default=5, help='samples per small project')
+    schedule_parser.add_argument('--small-projects', type=int, default=18)
+    schedule_parser.add_argument('--small-interval', type=float, default=4.0, help='hours between small projects')
+    schedule_parser.add_argument('--urgent-every', type=int, default=3)
+    schedule_parser.add_argument('--urgent-priority', type=int, default=5)
+    schedule_parser.add_argument('--aging', type=float, default=0.1, help='priority per hour waited')
+    schedule_parser.add_argument('--share', type=float, default=1.0)
+    schedule_parser.add_argument('--window', type=float, default=3600)
+    schedule_parser.set_defaults(func=bench_schedule)
+
+    # Shared by pipeline and cluster
+    run_parser = argparse.ArgumentParser(add_help=False)
+    run_parser.add_argument('--projects', type=int, default=4)
+    run_parser.add_argument('--samples', type=int, default=4, help='samples per project')
+    run_parser.add_argument('--scaffold-workers', type=int, default=2)
+    run_parser.add_argument('--raw-size', type=int, default=2**20)
+    run_parser.add_argument('--spectra', type=int, default=500, help='spectra per converted MGF')
+    run_parser.add_argument('--convert-time', type=float, default=0.5)
+    run_parser.add_argument('--tandem-time', type=float, default=0.5)
+    run_parser.add_argument('--search-time', type=float, default=1.0, help='seconds per fake Mascot search')
+    run_parser.add_argument('--dat-size', type=int, default=2**20)
+    run_parser.add_argument('--scaffold-time', type=float, default=1.0)
+    run_parser.add_argument('--sf3-size', type=int, default=2**20)
+    run_parser.add_argument('--postproc-time', type=float, default=0.5)
+    run_parser.add_argument('--latency', type=float, default=0.05, help='seconds per Sheets/Mascot call')
+    run_parser.add_argument('--poll', type=float, default=1.0, help='seconds between periodic tasks')
+    run_parser.add_argument('--timeout', type=float, default=600)
+    run_parser.add_argument('--keep', action='store_true', help='keep the work directory')
+
+    pipeline_parser = subparsers.add_parser('pipeline', parents=[run_parser],
+                                            help='import -> convert -> search -> scaffold end to end')
+    pipeline_parser.add_argument('--workers', type=int, default=4, help='workers per search and convert stage')
+    pipeline_parser.set_defaults(func=bench_pipeline)
+
+    cluster_parser = subparsers.add_parser('cluster', parents=[run_parser],
+                                           help='the pipeline run by several worker processes')
+    cluster_parser.add_argument('--nodes', type=int, default=3)
+    cluster_parser.add_argument('--workers', type=int, default=2, help='workers per stage on each node')
+    cluster_parser.add_argument('--lease', type=float, default=5, help='JOB_LEASE and NODE_TTL of the nodes')
+    cluster_parser.add_argument('--kill-after', type=float, help='kill node0 after this many seconds')
+    cluster_parser.set_defaults(func=bench_cluster)
+
+    node_parser = subparsers.add_parser('cluster-node', help='one node of `bench.py cluster`')
+    node_parser.add_argument('root')
+    node_parser.add_argument('node')
+    node_parser.add_argument('--stages')
+    node_parser.add_argument('--workers', type=int, default=2)
+    node_parser.set_defaults(func=bench_cluster_node)
+
+    tandem_parser = subparsers.add_parser('tandem')
+    tandem_parser.add_argument('--spectra', type=int, default=20000)
+    tandem_parser.add_argument('--proteins', type=int, default=2000)
+    tandem_parser.add_argument('--shards', type=int, default=4)
+    tandem_parser.add_argument('--threads', type=int, default=os.cpu_count() or 1)
+    tandem_parser.add_argument('--cmd', default=FAKE_TANDEM_CMD, help='tandem command, {infile} is the config')
+    tandem_parser.set_defaults(func=bench_tandem)
+
+    mascot_parser = subparsers.add_parser('mascot')
+    mascot_parser.add_argument('--samples', type=int, default=8)
+    mascot_parser.add_argument('--spectra', type=int, default=2000)
+    mascot_parser.add_argument('--concurrency', type=int, default=4)
+    mascot_parser.add_argument('--search-time', type=float, default=2.0, help='seconds per fake search')
+    mascot_parser.add_argument('--dat-size', type=int, default=8 * 2**20)
+    mascot_parser.add_argument('--latency', type=float, default=0.02, help='seconds per request')
+    mascot_parser.add_argument('--poll', type=float, default=0.5)
+    mascot_parser.add_argument('--gzip', action='store_true', help='gzip uploads on the fly')
+    mascot_parser.add_argument('--min-intensity', type=float, help='drop peaks below this intensity')
+    mascot_parser.add_argument('--top-n', type=int, help='keep only the N most intense peaks per spectrum')
+    mascot_parser.set_defaults(func=bench_mascot)
+
+    databases_parser = subparsers.add_parser('databases', help='FASTA checks and searches grouped by database')
+    databases_parser.add_argument('--organisms', type=int, default=4)
+    databases_parser.add_argument('--proteins', type=int, default=20000)
+    databases_parser.add_argument('--projects', type=int, default=24)
+    databases_parser.add_argument('--samples', type=int, default=6)
+    databases_parser.add_argument('--workers', type=int, default=4)
+    databases_parser.add_argument('--cached', type=int, default=2, help='databases the page cache holds')
+    databases_parser.add_argument('--service', type=float, default=0.5, help='hours per search')
+    databases_parser.add_argument('--aging', type=float, default=0.1)
+    databases_parser.add_argument('--affinity', type=float, default=0.5)
+    databases_parser.set_defaults(func=bench_databases)
+
+    summary_parser = subparsers.add_parser('summary', help='parsing search results against reading PSM tables')
+    summary_parser.add_argument('--spectra', type=int, default=20000)
+    summary_parser.set_defaults(func=bench_summary)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,217 @@
+'''Running the stages on several hosts that share DATA_ROOT and the job store'''
+import json
+import os
+import shlex
+import shutil
+import socket
+import threading
+import time
+
+NODES_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS nodes (
+    name TEXT PRIMARY KEY,
+    host TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    stages TEXT NOT NULL,
+    cores INTEGER NOT NULL,
+    started REAL NOT NULL,
+    seen REAL NOT NULL
+);
+'''
+
+
+def owner_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+class SharedLock:
+    '''Mutex across hosts sharing a filesystem, a lock file created with O_EXCL.
+
+    Exclusive creation is atomic on local filesystems and NFSv3+, unlike
+    flock() and the POSIX locks of some NFS setups. The file names its
+    holder; a holder that stays longer than `ttl` seconds must refresh() it,
+    otherwise the lock counts as abandoned (its host died) and is broken.
+    The age of the lock is measured with the clock of the file server, the
+    mtime of a probe file touched next to it, so skewed host clocks neither
+    break a live lock nor keep a dead one. With keep=True a background thread
+    refreshes it while held, and ends once it finds it released. The lock is per process: threads sharing it need
+    a mutex of their own.
+    '''
+
+    def __init__(self, path, ttl=60, poll=0.02, keep=False):
+        self.path = path
+        self.ttl = ttl
+        self.poll = poll
+        self.keep = keep
+        self.owner = None
+        self._refresher = None
+        self._keeper = threading.Lock()
+
+    def _holder(self):
+        try:
+            with open(self.path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _server_time(self):
+        '''Current time of the file server, the mtime it gives a file touched now'''
+        probe = f'{self.path}.clock'
+        try:
+            os.utime(probe)
+        except FileNotFoundError:
+            with open(probe, 'a'):
+                pass
+        return os.stat(probe).st_mtime
+
+    def _break(self):
+        '''Remove the lock of a dead holder, unless another node has broken and retaken it meanwhile'''
+        holder = self._holder()
+        try:
+            if holder is None or self._server_time() - os.stat(self.path).st_mtime <= self.ttl:
+                return
+        except FileNotFoundError:
+            return
+        stale = f'{self.path}.{owner_id()}.stale'
+        try:
+            os.rename(self.path, stale)
+        except FileNotFoundError:
+            return
+        with open(stale) as f:
+            taken = f.read()
+        if taken != holder:
+            # Renamed a fresh lock away, put it back if its place is still free
+            try:
+                os.link(stale, self.path)
+            except FileExistsError:
+                pass
+        os.unlink(stale)
+
+    def try_acquire(self):
+        owner = owner_id()
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            self._break()
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(owner)
+        self.owner = owner
+        if self.keep:
+            with self._keeper:
+                if self._refresher is None:
+                    # Not one thread per acquire: a job store lock is taken per transaction
+                    self._refresher = threading.Thread(target=self._refresh, name='shared-lock', daemon=True)
+                    self._refresher.start()
+        return True
+
+    def _refresh(self):
+        while True:
+            time.sleep(self.ttl / 3)
+            with self._keeper:
+                if self.owner is None:
+                    # Released, the next acquire starts another one
+                    self._refresher = None
+                    return
+            try:
+                self.refresh()
+            except FileNotFoundError:
+                pass
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.try_acquire():
+            if deadline is not None and time.time() >= deadline:
+                raise TimeoutError(f'{self.path} held by {self._holder()}')
+            time.sleep(self.poll)
+
+    def held(self):
+        '''True while the lock file still names us, False once it was broken'''
+        return self.owner is not None and self._holder() == self.owner
+
+    def refresh(self):
+        os.utime(self.path)
+
+    def release(self):
+        try:
+            if self.held():
+                os.unlink(self.path)
+        finally:
+            self.owner = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class Leadership:
+    '''One node at a time runs the tasks that must not run twice (import, Scaffold checks).
+
+    lead() takes the lock when it is free or abandoned and refreshes it while
+    held, so it must be called more often than every `ttl` seconds. Another
+    node takes over `ttl` seconds after the leader stopped calling it.
+    '''
+
+    def __init__(self, path, ttl=60):
+        self.lock = SharedLock(path, ttl)
+        self._mutex = threading.Lock()
+
+    def lead(self):
+        with self._mutex:
+            if self.lock.held():
+                self.lock.refresh()
+                return True
+            return self.lock.try_acquire()
+
+    def resign(self):
+        with self._mutex:
+            self.lock.release()
+
+
+def detect_stages(commands):
+    '''Stages this host can run, commands is {stage: [command templates]} and an empty list needs nothing'''
+    found = []
+    for stage, cmds in commands.items():
+        if all(shutil.which(shlex.split(cmd)[0]) for cmd in cmds):
+            found.append(stage)
+    return found
+
+
+class NodeRegistry:
+    '''Nodes of the cluster with the stages they run and their cores, kept in the job store'''
+
+    def __init__(self, store):
+        self.store = store
+        self.store.create(NODES_SCHEMA)
+
+    def register(self, name, stages, cores):
+        now = time.time()
+        with self.store.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO nodes (name, host, pid, stages, cores, started, seen)'
+                       ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (name, socket.gethostname(), os.getpid(), json.dumps(sorted(stages)), cores, now, now))
+
+    def heartbeat(self, name):
+        with self.store.transaction() as db:
+            db.execute('UPDATE nodes SET seen = ? WHERE name = ?', (time.time(), name))
+
+    def unregister(self, name):
+        with self.store.transaction() as db:
+            db.execute('DELETE FROM nodes WHERE name = ?', (name,))
+
+    def nodes(self, ttl):
+        '''[dict] of the registered nodes, alive when seen within ttl seconds'''
+        with self.store.read() as db:
+            rows = db.execute('SELECT name, host, pid, stages, cores, started, seen FROM nodes'
+                              ' ORDER BY name').fetchall()
+        now = time.time()
+        return [dict(name=name, host=host, pid=pid, stages=json.loads(stages), cores=cores, started=started,
+                     seen=seen, alive=now - seen <= ttl)
+                for name, host, pid, stages, cores, started, seen in rows]
+
+    def stages(self, ttl):
+        '''Stages run by at least one live node'''
+        return {stage for node in self.nodes(ttl) if node['alive'] for stage in node['stages']}
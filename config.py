@@ -1,4 +1,5 @@
 import os
+import socket
 
 RAW_ROOT = '/mnt/MSdata/'
 DATA_ROOT = '/mnt/MSproc/'
@@ -10,18 +11,114 @@ CONVERSION_CMD = '/home/msauto/msauto_venv/msauto/conv.sh {infile} {outdir}'
 SCAFFOLD_CMD = '/home/msauto/Scaffold/ScaffoldBatch -f {infile}'
 POSTPROC_CMD = 'Rscript --vanilla {script} {wd} {projname}'
 CONF_DIR = '/mnt/MSproc/.conf'
+# Written by msauto from the organism map: the taxon Tandem_db searches FASTA_DIR/<Tandem_db>.fasta.
+# Taxa the organism map does not name are kept as they are.
 TANDEM_TAXONOMY = os.path.join(CONF_DIR, 'taxonomy.xml')
+# FASTA files of the databases, <Tandem_db>.fasta and <Mascot_db>.fasta (the one Scaffold reads).
+# With FASTA_LOCAL_DIR (the same local disk path on every node) Tandem reads verified copies there.
+# A database is read through before the searches on it, again once FASTA_WARM_TTL seconds passed.
+FASTA_DIR = '/home/msauto/fasta'
+FASTA_LOCAL_DIR = None
+FASTA_WARM_TTL = 3600
 TANDEM_DEFAULTS = '/home/msauto/msauto_venv/msauto/default_PROTEOME_MetOxilation_params.xml'
 MASCOT_DEFAULTS = '/home/msauto/msauto_venv/msauto/UniProtKB-HS-20_Proteome_MetOxidation_TripleTOF.par'
 TANDEM_CMD = '/home/msauto/bin/tandem-linux-17-02-01-4/bin/static_link_ubuntu/tandem.exe {infile}'
+# Samples with at least TANDEM_SHARD_MIN_SPECTRA spectra are searched as TANDEM_SHARDS concurrent
+# runs, and the results merged. All the X!Tandem runs of a process, shards or whole samples of any
+# worker, share TANDEM_THREADS threads; each takes up to TANDEM_THREADS // TANDEM_SHARDS of them
+TANDEM_SHARDS = 4
+TANDEM_SHARD_MIN_SPECTRA = 20000
+TANDEM_THREADS = os.cpu_count() or 1
+# Tandem workers of `msauto.py daemon`, as many as unsplit searches fit in TANDEM_THREADS: a worker claims
+# its job before it waits for threads, so more would hold jobs running that no thread can run yet
+TANDEM_WORKERS = TANDEM_THREADS // max(1, TANDEM_THREADS // TANDEM_SHARDS)
 MASCOT_CGI = 'http://mascot.ripcm.com/mascot/cgi'
+MASCOT_USER = 'mascotadmin'
+MASCOT_PASSWORD = 'R251260z'
+# Searches kept in flight over one Mascot session, and seconds between result polls
+MASCOT_CONCURRENCY = 4
+MASCOT_POLL_TIME = 30
+# Seconds a result file may stay incomplete, e.g. a resumed search still running, before the search fails
+MASCOT_MAX_WAIT = 24 * 3600
+# gzip the MGF upload on the fly, only if the Mascot web server accepts Content-Encoding: gzip.
+# Peak filters are set per protocol with MSAUTO_MIN_INTENSITY / MSAUTO_TOP_N in the .par files.
+MASCOT_UPLOAD_GZIP = False
+# Search results are cached by (engine version, MGF, database, prefs) and linked into the projects.
+# Bump the versions when an engine is upgraded, older results are then no longer reused.
+RESULT_CACHE_DIR = os.path.join(DATA_ROOT, '.cache')
+RESULT_CACHE_BUDGET = 500 * 2**30
+TANDEM_VERSION = '2017.2.1.4'
+MASCOT_VERSION = '2.x'
+DB_JOBS_FILE = os.path.join(DB_ROOT, "jobs.sqlite")
+JOB_MAX_ATTEMPTS = 3
+# Seconds a claimed job stays leased without a heartbeat (renewed every third of it while the worker
+# lives). Jobs of dead workers are queued again by the daemon, or by `msauto.py recover` run from
+# cron (e.g. @reboot) when the stages run from cron, which also checks the outputs written within
+# RECOVERY_WINDOW seconds for files cut off by a crash.
+JOB_LEASE = 300
+RECOVERY_WINDOW = 2 * 24 * 3600
+# Several hosts run `msauto.py worker` against one job store: set CLUSTER_MODE on every node and
+# DB_JOBS_FILE to a path on the mount they share. One node at a time (the holder of
+# CLUSTER_DIR/leader.lock) imports from the sheet and checks Run_scaffold; a node not seen for
+# NODE_TTL seconds loses the lead and its jobs come back once their leases run out. DB_ROOT (maps,
+# metrics, events) stays local to each node, and project logs are written per node.
+CLUSTER_MODE = False
+CLUSTER_DIR = os.path.join(DATA_ROOT, '.cluster')
+NODE_NAME = socket.gethostname()
+NODE_TTL = 60
+# Fair-share scheduling of each stage queue: score = Priority + SCHEDULE_AGING * hours waited
+# - SCHEDULE_SHARE * (user jobs / user weight + project jobs), counting jobs running or
+# finished within SCHEDULE_WINDOW seconds. Users missing from SCHEDULE_WEIGHTS weigh 1.
+SCHEDULE_AGING = 0.1
+SCHEDULE_SHARE = 1.0
+SCHEDULE_WINDOW = 3600
+SCHEDULE_WEIGHTS = {}
+# Score bonus of the queued searches on a database in use or just used by the stage, so searches of
+# one organism run back to back while its FASTA is in the page cache
+SCHEDULE_DB_AFFINITY = {'tandem': 0.5}
+# Old flat-file queues, only read by `msauto.py migrate`
 DB_CONV_FILE = os.path.join(DB_ROOT, "conversion.list")
-DB_CONV_LOCK = 'DB_CONV_LOCK'
 DB_IMPORTED_FILE = os.path.join(DB_ROOT, "imported.list")
-DB_IMPORTED_LOCK = 'DB_IMPORTED_LOCK'
 DB_TANDEM_FILE = os.path.join(DB_ROOT, "tandem.list")
-DB_TANDEM_LOCK = 'DB_TANDEM_LOCK'
 DB_MASCOT_FILE = os.path.join(DB_ROOT, "mascot.list")
-DB_MASCOT_LOCK = 'DB_MASCOT_LOCK'
 spreadsheetId = '1gayGq3w_eYMBCW6di5VX9FWVn7DBdJ8oafhm7QnvwK0'
-CREDENTIALS_FILE = '/home/msauto/key.json'
\ No newline at end of file
+CREDENTIALS_FILE = '/home/msauto/key.json'
+DISCOVERY_CACHE = os.path.join(DB_ROOT, 'sheets_v4_discovery.json')
+DISCOVERY_CACHE_TTL = 7 * 24 * 3600
+STATUS_FLUSH_INTERVAL = 30
+# Metrics in the Prometheus text format, one file per subcommand for the node_exporter textfile
+# collector, refreshed every METRICS_INTERVAL seconds by the daemon and at exit by the other
+# subcommands. The daemon also serves them on http://127.0.0.1:METRICS_PORT/metrics when set.
+METRICS_FILE = os.path.join(DB_ROOT, 'metrics', 'msauto_{command}.prom')
+METRICS_INTERVAL = 15
+METRICS_PORT = None
+# Job starts and ends and work stats, one JSON object per line
+EVENTS_FILE = os.path.join(DB_ROOT, 'events.jsonl')
+# Conversions run at once by `msauto.py convert`, limited by CPU slots and free space under DATA_ROOT
+CONVERT_WORKERS = 2
+CONVERT_SLOTS = os.cpu_count() or 1
+CONVERT_DISK_RESERVE = 20 * 2**30
+# Expected MGF size relative to the raw file, reserved on disk while converting
+CONVERT_SIZE_FACTOR = 2
+# Projects run through Scaffold and postprocessing at once, and the address space cap of each
+# ScaffoldBatch / Rscript process. The cap must leave room above the JVM -Xmx set in ScaffoldBatch.vmoptions.
+SCAFFOLD_WORKERS = 2
+SCAFFOLD_MEMORY_CAP = 24 * 2**30
+# Samples whose search results are parsed into PSM tables at once, and the expect value of the
+# PSMs counted as identified in the per-project summaries
+SUMMARY_WORKERS = 2
+SUMMARY_EXPECT_THRESHOLD = 0.01
+# The project tables are built once its last summary is done, and meanwhile at most every
+# SUMMARY_AGGREGATE_INTERVAL seconds, as each build reads the PSM tables of every sample
+SUMMARY_AGGREGATE_INTERVAL = 600
+# Worker threads per stage for `msauto.py daemon`
+DAEMON_WORKERS = {'convert': CONVERT_WORKERS, 'tandem': TANDEM_WORKERS, 'mascot': MASCOT_CONCURRENCY,
+                  'scaffold': SCAFFOLD_WORKERS, 'summary': SUMMARY_WORKERS}
+DAEMON_IMPORT_INTERVAL = 60
+# Seconds between checks of the Run_scaffold column, projects are queued as soon as their last search lands
+DAEMON_SCAFFOLD_INTERVAL = 300
+# Seconds between warming the databases of the queued Tandem searches
+DAEMON_DATABASE_INTERVAL = 60
+# A raw file is imported once two stats at least RAW_SETTLE_TIME seconds apart found the same size and mtime
+RAW_SETTLE_TIME = 120
+RAW_SCAN_INTERVAL = 60
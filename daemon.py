@@ -0,0 +1,65 @@
+import os
+import signal
+import socket
+import threading
+import traceback
+
+
+def worker_name(name):
+    return f'{socket.gethostname()}:{os.getpid()}:{name}'
+
+
+class Supervisor:
+    '''Keeps pools of worker threads and periodic tasks running until stopped.
+
+    A pool worker calls its function in a loop; a falsy return value means the
+    queue was empty and the worker sleeps for `poll` seconds before trying
+    again. Exceptions are printed and the worker carries on.
+    '''
+
+    def __init__(self, poll=1):
+        self.poll = poll
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def _loop(self, name, func, interval):
+        while not self.stopping.is_set():
+            try:
+                busy = func(worker_name(name))
+            except Exception:
+                traceback.print_exc()
+                busy = False
+            if interval is not None or not busy:
+                self.stopping.wait(self.poll if interval is None else interval)
+
+    def pool(self, name, size, func):
+        '''size threads running func(worker) back to back'''
+        for i in range(size):
+            self.threads.append(threading.Thread(target=self._loop, args=(f'{name}-{i}', func, None),
+                                                 name=f'{name}-{i}', daemon=True))
+        return self
+
+    def every(self, name, interval, func):
+        '''One thread running func(worker) every interval seconds'''
+        self.threads.append(threading.Thread(target=self._loop, args=(name, func, interval),
+                                             name=name, daemon=True))
+        return self
+
+    def thread(self, name, func):
+        '''One thread running func(stopping), func returns once stopping is set'''
+        self.threads.append(threading.Thread(target=func, args=(self.stopping,), name=name, daemon=True))
+        return self
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for t in self.threads:
+            t.start()
+        # Wait in slices so signals get handled by the main thread
+        while not self.stopping.wait(self.poll):
+            pass
+        for t in self.threads:
+            t.join()
@@ -0,0 +1,271 @@
+'''FASTA databases of the searches: the X!Tandem taxonomy, verification and warm copies.
+
+Every Tandem search reads its whole FASTA again. The files are checked and
+checksummed once per content (the results are kept in the job store, so
+every node shares them) and read through, or copied to a local disk, before
+the searches that use them, so those find them in the page cache.
+'''
+import collections
+import hashlib
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
+
+from executor import atomic_open
+
+DATABASES_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS databases (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    proteins INTEGER NOT NULL,
+    decoys INTEGER NOT NULL,
+    problem TEXT,
+    checked REAL NOT NULL
+);
+'''
+
+DECOY_PREFIXES = ('REV_', 'DECOY_', '###REV###', 'rev_')
+_DECOY_PREFIXES = tuple(prefix.encode() for prefix in DECOY_PREFIXES)
+SEQUENCE_CHARS = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz*-\r\n'
+
+FastaInfo = collections.namedtuple('FastaInfo', 'path size sha256 proteins decoys problem')
+
+
+class DatabaseError(Exception):
+    pass
+
+
+def scan_fasta(path):
+    '''FastaInfo of a FASTA file, read once for the checksum and the checks'''
+    h = hashlib.sha256()
+    proteins = decoys = 0
+    accessions = set()
+    problem = None
+    line_no = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            h.update(line)
+            line_no += 1
+            if problem:
+                continue
+            if line.startswith(b'>'):
+                accession = line[1:].split(None, 1)[0] if line[1:].strip() else b''
+                if not accession:
+                    problem = f'empty header on line {line_no}'
+                elif accession in accessions:
+                    problem = f'duplicate accession {accession.decode(errors="replace")} on line {line_no}'
+                accessions.add(accession)
+                proteins += 1
+                decoys += accession.startswith(_DECOY_PREFIXES)
+            elif not proteins and line.strip():
+                problem = 'does not start with a > header'
+            elif line.translate(None, SEQUENCE_CHARS):
+                problem = f'not a protein sequence on line {line_no}'
+    if not problem and not proteins:
+        problem = 'no proteins'
+    return FastaInfo(path, os.path.getsize(path), h.hexdigest(), proteins, decoys, problem)
+
+
+def taxonomy_xml(entries, kept=()):
+    '''X!Tandem taxonomy file for entries [(taxon, [fasta paths])] plus kept <taxon> elements'''
+    lines = ['<?xml version="1.0"?>', '<bioml label="x! taxon-to-file matching list">']
+    for taxon, paths in entries:
+        lines.append(f'\t<taxon label={quoteattr(taxon)}>')
+        lines.extend(f'\t\t<file format="peptide" URL={quoteattr(path)} />' for path in paths)
+        lines.append('\t</taxon>')
+    for element in kept:
+        element.tail = None
+        lines.append('\t' + ET.tostring(element, encoding='unicode').strip())
+    lines.append('</bioml>')
+    return '\n'.join(lines) + '\n'
+
+
+class DatabaseManager:
+    '''The FASTA of database `db` is the file the taxonomy lists for taxon `db`, or <fasta_dir>/<db>.fasta.
+
+    With a local_dir the searches read verified copies in local_dir (the same
+    path on every node) instead of the shared files. A warmed file is read
+    through again once `warm_ttl` seconds have passed, as the page cache may
+    have dropped it since. Taxa the taxonomy already points elsewhere, or
+    lists with several files, are read where it says, they are never copied
+    nor rewritten.
+    '''
+
+    def __init__(self, store, fasta_dir, taxonomy_path, local_dir=None, warm_ttl=3600):
+        self.store = store
+        self.fasta_dir = fasta_dir
+        self.taxonomy_path = taxonomy_path
+        self.local_dir = local_dir
+        self.warm_ttl = warm_ttl
+        self._warmed = {}
+        self._local = {}
+        self._locks = collections.defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+        self._taxonomy = (None, {})
+        self.store.create(DATABASES_SCHEMA)
+
+    def listed(self):
+        '''{taxon: [FASTA paths]} of the taxonomy file, read again when it changes'''
+        try:
+            mtime = os.stat(self.taxonomy_path).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        if self._taxonomy[0] != mtime:
+            taxa = {}
+            try:
+                for taxon in ET.parse(self.taxonomy_path).getroot().findall('taxon'):
+                    files = [f.get('URL') for f in taxon.findall('file') if f.get('URL')]
+                    if files:
+                        taxa[taxon.get('label')] = files
+            except ET.ParseError:
+                taxa = {}
+            self._taxonomy = (mtime, taxa)
+        return self._taxonomy[1]
+
+    def _external(self, db):
+        '''Path the taxonomy gives a single-file db when it is not one this manager writes'''
+        files = self.listed().get(db, [])
+        if len(files) == 1 and files[0] != self._local_path(db):
+            return files[0]
+        return None
+
+    def _shared(self, db):
+        '''FASTA files of a taxon listed with several of them, e.g. a target and cRAP, else None'''
+        files = self.listed().get(db, [])
+        return files if len(files) > 1 else None
+
+    def _local_path(self, db):
+        return os.path.join(self.local_dir, db + '.fasta') if self.local_dir else None
+
+    def fasta_path(self, db):
+        return self._external(db) or os.path.join(self.fasta_dir, db + '.fasta')
+
+    def search_path(self, db):
+        '''FASTA the searches read, the local copy when there is a local_dir'''
+        return self._external(db) or self._local_path(db) or self.fasta_path(db)
+
+    def verify(self, db):
+        '''FastaInfo of the shared FASTA of db, scanned again only when its size or mtime changed.
+
+        For a taxon with several files it sums them up, with the sha256 of
+        their checksums, and has the path of the first broken one if any.
+        '''
+        files = self._shared(db)
+        if not files:
+            return self._verify(db, self.fasta_path(db))
+        infos = [self._verify(db, path) for path in files]
+        for info in infos:
+            if info.problem:
+                return info
+        sha256 = hashlib.sha256(' '.join(info.sha256 for info in infos).encode()).hexdigest()
+        return FastaInfo(' '.join(files), sum(info.size for info in infos), sha256,
+                         sum(info.proteins for info in infos), sum(info.decoys for info in infos), '')
+
+    def _verify(self, db, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return FastaInfo(path, 0, '', 0, 0, 'does not exist')
+        info = self._known(path, st)
+        if info:
+            return info
+        with self._db_lock(db):
+            # Another thread may have scanned it meanwhile
+            info = self._known(path, st)
+            if info:
+                return info
+            info = scan_fasta(path)
+            with self.store.transaction() as tx:
+                tx.execute('INSERT OR REPLACE INTO databases (path, size, mtime, sha256, proteins, decoys, problem,'
+                           ' checked) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           (path, info.size, st.st_mtime_ns, info.sha256, info.proteins, info.decoys, info.problem,
+                            time.time()))
+            # Scanning read it all
+            self._warmed[path] = time.time()
+        return info
+
+    def _known(self, path, st):
+        with self.store.read() as db:
+            row = db.execute('SELECT size, sha256, proteins, decoys, problem FROM databases'
+                             ' WHERE path = ? AND size = ? AND mtime = ?',
+                             (path, st.st_size, st.st_mtime_ns)).fetchone()
+        return FastaInfo(path, *row) if row else None
+
+    def checked(self, db):
+        '''Verified FastaInfo of db, raises DatabaseError for a missing or broken FASTA'''
+        info = self.verify(db)
+        if info.problem:
+            raise DatabaseError(f'Database {db}: {info.path} {info.problem}')
+        return info
+
+    def prepare(self, db):
+        '''Check db, copy it to local_dir if needed and make sure it is warm, returns its FastaInfo'''
+        info = self.checked(db)
+        files = self._shared(db)
+        if files:
+            # Read where the taxonomy lists them, like any other taxon it points elsewhere
+            with self._db_lock(db):
+                for path in files:
+                    self._warm(path)
+            return info
+        path = self.search_path(db)
+        with self._db_lock(db):
+            if path != info.path and self._local.get(db) != info.sha256:
+                self._copy_local(info, path)
+                self._local[db] = info.sha256
+            self._warm(path)
+        return info
+
+    def _copy_local(self, info, path):
+        if os.path.exists(path) and scan_fasta(path).sha256 == info.sha256:
+            self._warmed[path] = time.time()
+            return
+        os.makedirs(self.local_dir, exist_ok=True)
+        with open(info.path, 'rb') as fin, atomic_open(path, 'wb') as fout:
+            for chunk in iter(lambda: fin.read(2**20), b''):
+                fout.write(chunk)
+        self._warmed[path] = time.time()
+
+    def _warm(self, path):
+        if time.time() - self._warmed.get(path, 0) < self.warm_ttl:
+            return
+        buffer = bytearray(2**20)
+        with open(path, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            while f.readinto(buffer):
+                pass
+        self._warmed[path] = time.time()
+
+    def _db_lock(self, db):
+        with self._lock:
+            return self._locks[db]
+
+    def write_taxonomy(self, dbs):
+        '''Add the taxa dbs the taxonomy file does not list yet, pointing at their FASTA.
+
+        The taxa it lists already, and the rest of the file, are kept as they
+        are. Returns True when the file changed.
+        '''
+        kept = []
+        current = None
+        if os.path.exists(self.taxonomy_path):
+            with open(self.taxonomy_path) as f:
+                current = f.read()
+            try:
+                kept = ET.fromstring(current).findall('taxon')
+            except ET.ParseError:
+                raise DatabaseError(f'{self.taxonomy_path} is not a valid taxonomy file')
+        listed = {taxon.get('label') for taxon in kept}
+        added = sorted(set(dbs) - listed)
+        if not added and current is not None:
+            return False
+        content = taxonomy_xml([(db, [self.search_path(db)]) for db in added], kept)
+        with atomic_open(self.taxonomy_path) as f:
+            f.write(content)
+        self._taxonomy = (None, {})
+        return True
@@ -0,0 +1,173 @@
+import collections
+import contextlib
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+
+def run_logged(cmd, log, **kwargs):
+    '''Run a shell command, feeding each line of its stdout and stderr to log(). Returns the exit code'''
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               universal_newlines=True, errors='replace', **kwargs)
+    # Draining the pipe as we go keeps a chatty command from blocking on a full buffer
+    for line in process.stdout:
+        line = line.rstrip()
+        if line:
+            log(line)
+    process.stdout.close()
+    return process.wait()
+
+
+def fsync_file(path):
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+def fsync_replace(src, dest):
+    '''Rename src over dest once its content is on disk, so a crash leaves either the old or the new file'''
+    fsync_file(src)
+    os.replace(src, dest)
+    fd = os.open(os.path.dirname(os.path.abspath(dest)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w'):
+    '''Write to path through a temporary file renamed into place when the block succeeds'''
+    # Unique, another host may be writing the same path
+    tmp = f'{path}.{uuid.uuid4().hex[:12]}.tmp'
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        fsync_replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def file_tail(path, size):
+    '''Last size bytes of a file, b'' for a missing file'''
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - size))
+            return f.read()
+    except FileNotFoundError:
+        return b''
+
+
+def memory_limit(nbytes):
+    '''preexec_fn capping the address space of a child process, None for no cap'''
+    if not nbytes:
+        return None
+
+    def limit():
+        resource.setrlimit(resource.RLIMIT_AS, (nbytes, nbytes))
+    return limit
+
+
+class ResourceGate:
+    '''Admits work while there are free CPU slots and enough disk space under root.
+
+    Space promised to running work is reserved in-process, so several jobs
+    starting at once do not all count the same free bytes.
+    '''
+
+    def __init__(self, root, slots, reserve=0, poll=5):
+        self.root = root
+        self.reserve = reserve
+        self.poll = poll
+        self.reserved = 0
+        self._slots = threading.BoundedSemaphore(slots)
+        self._cond = threading.Condition()
+
+    def free(self):
+        return shutil.disk_usage(self.root).free - self.reserved
+
+    @contextlib.contextmanager
+    def acquire(self, need, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        if not self._slots.acquire(timeout=timeout):
+            raise RuntimeError(f'No free slot within {timeout}s')
+        try:
+            with self._cond:
+                while self.free() - need < self.reserve:
+                    if deadline is not None and time.time() >= deadline:
+                        raise RuntimeError(f'Not enough free space under {self.root} for {need} bytes')
+                    self._cond.wait(self.poll)
+                self.reserved += need
+            try:
+                yield
+            finally:
+                with self._cond:
+                    self.reserved -= need
+                    self._cond.notify_all()
+        finally:
+            self._slots.release()
+
+
+class ThreadGate:
+    '''CPU threads shared by the searches of a process, each run takes what is free up to what it wants.
+
+    acquire() waits for at least one free thread, so the runs together never
+    use more than `threads`, however many workers and shards start them.
+    '''
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.free = threads
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def acquire(self, want):
+        '''Block until a thread is free, yields the number of threads taken'''
+        with self._cond:
+            while not self.free:
+                self._cond.wait()
+            taken = min(max(1, want), self.free)
+            self.free -= taken
+        try:
+            yield taken
+        finally:
+            with self._cond:
+                self.free += taken
+                self._cond.notify_all()
+
+
+class ConversionStats(collections.namedtuple('ConversionStats', 'seconds bytes_in bytes_out returncode')):
+    @property
+    def mbps(self):
+        return self.bytes_in / 2**20 / self.seconds if self.seconds else 0.0
+
+
+def convert_file(cmd, rawfile, mgfpath, gate, log, size_factor=2, timeout=None):
+    '''Convert rawfile with cmd into mgfpath.
+
+    The converter writes into a temporary directory next to mgfpath and the
+    result is renamed into place only if the command succeeded, so mgfpath
+    is either missing or complete.
+    '''
+    bytes_in = os.path.getsize(rawfile)
+    outdir = os.path.dirname(mgfpath)
+    with gate.acquire(int(bytes_in * size_factor), timeout):
+        tmpdir = tempfile.mkdtemp(prefix='.convert-', dir=outdir)
+        try:
+            start = time.time()
+            returncode = run_logged(cmd.format(infile=rawfile, outdir=tmpdir), log)
+            seconds = time.time() - start
+            produced = os.path.join(tmpdir, os.path.basename(mgfpath))
+            if returncode != 0 or not os.path.exists(produced):
+                raise RuntimeError(f'Conversion of {rawfile} failed with {returncode}')
+            bytes_out = os.path.getsize(produced)
+            fsync_replace(produced, mgfpath)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return ConversionStats(seconds, bytes_in, bytes_out, returncode)
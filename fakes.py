@@ -0,0 +1,525 @@
+'''Local stand-ins for the external services msauto talks to, used by bench.py'''
+import argparse
+import gzip
+import http.server
+import itertools
+import os
+import random
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+import zlib
+from collections import Counter
+
+from sheets import column_index, column_letter
+
+SYNTHETIC_HEADER = ['Project_title', 'Sample_ID', 'Proteolysis_protocol', 'Organism', 'Status',
+                    'Uploaded', 'Scaffold_sample', 'Run_scaffold', 'Comment']
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def parse_range(range_name):
+    '''"List!B2:D" -> ("List", 1, 1, 3, None), bounds are 0-based and inclusive'''
+    sheet, _, cells = range_name.partition('!')
+    bounds = []
+    for part in cells.split(':'):
+        m = re.fullmatch(r'([A-Z]*)(\d*)', part)
+        col = column_index(m.group(1)) if m.group(1) else None
+        row = int(m.group(2)) - 1 if m.group(2) else None
+        bounds.append((col, row))
+    if len(bounds) == 1:
+        bounds.append(bounds[0])
+    (c0, r0), (c1, r1) = bounds
+    return sheet, c0 or 0, r0 or 0, c1, r1
+
+
+def synthetic_table(projects=10, samples=20, uploaded='TRUE'):
+    rows = [list(SYNTHETIC_HEADER)]
+    for p in range(projects):
+        for s in range(samples):
+            rows.append([f'P{p:04d}', f'S{p:04d}_{s:03d}', 'trypsin', 'human', '',
+                         uploaded, f'{p:04d}_{s % 4}/default', '', ''])
+    return rows
+
+
+class _Request:
+    def __init__(self, service, name, func):
+        self.service = service
+        self.name = name
+        self.func = func
+
+    def execute(self):
+        self.service.calls[self.name] += 1
+        if self.service.latency:
+            time.sleep(self.service.latency)
+        return self.func()
+
+
+class _Values:
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, spreadsheetId, range, **kwargs):
+        return _Request(self.service, 'values.get', lambda: self.service.read(range))
+
+    def update(self, spreadsheetId, range, body, valueInputOption='RAW', **kwargs):
+        return _Request(self.service, 'values.update', lambda: self.service.write(range, body['values']))
+
+    def batchGet(self, spreadsheetId, ranges, majorDimension='ROWS', **kwargs):
+        return _Request(self.service, 'values.batchGet',
+                        lambda: {'spreadsheetId': spreadsheetId,
+                                 'valueRanges': [self.service.read(r) for r in ranges]})
+
+    def batchUpdate(self, spreadsheetId, body, **kwargs):
+        def run():
+            responses = [self.service.write(d['range'], d['values']) for d in body['data']]
+            return {'spreadsheetId': spreadsheetId,
+                    'totalUpdatedCells': sum(r['updatedCells'] for r in responses),
+                    'responses': responses}
+        return _Request(self.service, 'values.batchUpdate', run)
+
+
+class _Spreadsheets:
+    def __init__(self, service):
+        self.service = service
+
+    def values(self):
+        return _Values(self.service)
+
+
+class FakeSheetsService:
+    '''In-memory replacement for the Sheets v4 service built by get_g_service().
+
+    Every execute() is counted in `calls` and delayed by `latency` seconds,
+    `cells_read` counts the cells returned by reads.
+    '''
+
+    def __init__(self, sheets=None, latency=0.0):
+        self.sheets = {name: [list(row) for row in rows] for name, rows in (sheets or {}).items()}
+        self.latency = latency
+        self.calls = Counter()
+        self.cells_read = 0
+
+    def spreadsheets(self):
+        return _Spreadsheets(self)
+
+    def read(self, range_name):
+        sheet, c0, r0, c1, r1 = parse_range(range_name)
+        grid = self.sheets.get(sheet, [])
+        values = []
+        for row in grid[r0:None if r1 is None else r1 + 1]:
+            cells = row[c0:None if c1 is None else c1 + 1]
+            while cells and cells[-1] == '':
+                cells = cells[:-1]
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        self.cells_read += sum(map(len, values))
+        result = {'range': range_name, 'majorDimension': 'ROWS'}
+        if values:
+            result['values'] = values
+        return result
+
+    def write(self, range_name, values):
+        sheet, c0, r0, _, _ = parse_range(range_name)
+        grid = self.sheets.setdefault(sheet, [])
+        cells = 0
+        for i, row in enumerate(values):
+            while len(grid) <= r0 + i:
+                grid.append([])
+            target = grid[r0 + i]
+            for j, value in enumerate(row):
+                while len(target) <= c0 + j:
+                    target.append('')
+                target[c0 + j] = str(value)
+                cells += 1
+        end = f'{column_letter(c0 + max(map(len, values), default=1) - 1)}{r0 + len(values)}'
+        return {'updatedRange': f'{sheet}!{column_letter(c0)}{r0 + 1}:{end}', 'updatedCells': cells}
+
+
+def synthetic_mgf(path, spectra=1000, peaks=50, seed=0):
+    rnd = random.Random(seed)
+    with open(path, 'w') as f:
+        for i in range(1, spectra + 1):
+            f.write(f'BEGIN IONS\nTITLE=synthetic.{i}.{i}.2\nPEPMASS={rnd.uniform(400, 1600):.4f}\n'
+                    f'CHARGE={rnd.choice((2, 2, 3, 4))}+\nSCANS={i}\nRTINSECONDS={i * 0.5:.1f}\n')
+            for mz in sorted(rnd.uniform(100, 2000) for _ in range(peaks)):
+                f.write(f'{mz:.4f} {rnd.expovariate(1e-4):.1f}\n')
+            f.write('END IONS\n')
+
+
+def synthetic_fasta(path, proteins=1000, length=400, seed=0):
+    rnd = random.Random(seed)
+    with open(path, 'w') as f:
+        for i in range(proteins):
+            seq = ''.join(rnd.choice(AMINO_ACIDS) for _ in range(length))
+            f.write(f'>sp|FAKE{i:05d}|FAKE{i:05d}_SYNTH Synthetic protein {i}\n')
+            for j in range(0, length, 60):
+                f.write(seq[j:j + 60] + '\n')
+            f.write(f'>DECOY_sp|FAKE{i:05d}|FAKE{i:05d}_SYNTH Synthetic protein {i}\n{seq[::-1]}\n')
+
+
+def _synthetic_psm(rnd, i):
+    '''(peptide, protein index, start, calc mh, score, expect, oxidised position) of spectrum i'''
+    peptide = ''.join(rnd.choice(AMINO_ACIDS) for _ in range(rnd.randint(7, 20))) + rnd.choice('KR')
+    score = rnd.uniform(5, 80)
+    oxidised = peptide.find('M')
+    return (peptide, i % 1000, rnd.randint(1, 300), 110.0 * len(peptide) + rnd.uniform(0, 100), score,
+            10 ** (-score / 10) * rnd.uniform(50, 500), oxidised)
+
+
+def write_tandem_models(out, spectra, rnd, peaks=50):
+    '''Model groups of a tandem output, with its protein sequences and fragment ion traces'''
+    for i in range(1, spectra + 1):
+        peptide, protein, start, mh, score, expect, oxidised = _synthetic_psm(rnd, i)
+        end = start + len(peptide) - 1
+        label = f'sp|FAKE{protein:05d}|FAKE{protein:05d}_SYNTH Synthetic protein {protein}'
+        if rnd.random() < 0.3:
+            label = 'DECOY_' + label
+        aa = f'<aa type="M" at="{start + oxidised}" modified="15.99491" />\n' if oxidised >= 0 else ''
+        mz = ' '.join(f'{rnd.uniform(100, 2000):.2f}' for _ in range(peaks))
+        intensities = ' '.join(f'{rnd.uniform(0, 100):.0f}' for _ in range(peaks))
+        out.write(f'<group id="{i}" mh="{mh:.6f}" z="2" rt="{i * 0.5:.1f}" expect="{expect:.1e}" label="{label}" '
+                  f'type="model" sumI="6.5" maxI="1e5" fI="1000" act="0" >\n'
+                  f'<protein expect="{-score / 5:.1f}" id="{i}.1" uid="{protein + 1}" label="{label}" sumI="6.5" >\n'
+                  f'<note label="description">{label}</note>\n'
+                  f'<file type="peptide" URL="synthetic.fasta"/>\n'
+                  f'<peptide start="1" end="400">\n'
+                  + ''.join(rnd.choice(AMINO_ACIDS) for _ in range(400)) +
+                  f'\n<domain id="{i}.1.1" start="{start}" end="{end}" expect="{expect:.1e}" mh="{mh:.6f}" '
+                  f'delta="{rnd.uniform(-0.02, 0.02):.4f}" hyperscore="{score:.1f}" nextscore="{score / 2:.1f}" '
+                  f'y_score="10.2" y_ions="5" b_score="8.1" b_ions="3" pre="K" post="R" seq="{peptide}" '
+                  f'missed_cleavages="{rnd.choice((0, 0, 1))}">\n{aa}</domain>\n</peptide>\n</protein>\n'
+                  f'<group label="fragment ion mass spectrum" type="support">\n'
+                  f'<note label="Description">synthetic.{i}.{i}.2</note>\n'
+                  f'<GAML:trace id="{i}" label="{i}.spectrum" type="tandem mass spectrum">\n'
+                  f'<GAML:Xdata units="MASSTOCHARGERATIO"><GAML:values byteorder="INTEL" format="ASCII" '
+                  f'numvalues="{peaks}">\n{mz}\n</GAML:values></GAML:Xdata>\n'
+                  f'<GAML:Ydata units="UNKNOWN"><GAML:values byteorder="INTEL" format="ASCII" '
+                  f'numvalues="{peaks}">\n{intensities}\n</GAML:values></GAML:Ydata>\n'
+                  f'</GAML:trace>\n</group>\n</group>\n')
+
+
+def synthetic_tandem_xml(path, spectra=1000, seed=0):
+    rnd = random.Random(seed)
+    with open(path, 'w') as out:
+        out.write('<?xml version="1.0"?>\n<bioml xmlns:GAML="http://www.bioml.com/gaml/" '
+                  'label="models from \'synthetic.mgf\'">\n')
+        write_tandem_models(out, spectra, rnd)
+        out.write('<group label="input parameters" type="parameters">\n'
+                  '\t<note type="input" label="spectrum, path">synthetic.mgf</note>\n</group>\n</bioml>\n')
+
+
+def synthetic_dat(path, queries=1000, peaks=50, seed=0):
+    '''Mascot .dat with 10 ranked matches and a decoy match per query, as an automatic decoy search writes'''
+    rnd = random.Random(seed)
+    section = f'--{DAT_BOUNDARY}\nContent-Type: application/x-Mascot; name="{{}}"\n\n'
+    with open(path, 'w') as out:
+        out.write(f'MIME-Version: 1.0 (Generated by Mascot version 2.6.0)\n'
+                  f'Content-Type: multipart/mixed; boundary={DAT_BOUNDARY}\n\n')
+        out.write(section.format('parameters') + 'FILE=synthetic.mgf\nDECOY=1\nCLE=Trypsin\n')
+        out.write(section.format('masses') + 'C=103.009185\ndelta1=15.994915,Oxidation (M)\n'
+                                             'FixedMod1=57.021464,Carbamidomethyl (C)\n')
+        summary = []
+        peptides, decoys = [], []
+        for q in range(1, queries + 1):
+            summary.append(f'qmass{q}={rnd.uniform(800, 3000):.6f}\nqexp{q}={rnd.uniform(400, 1500):.6f},2+\n'
+                           f'qintensity{q}={rnd.uniform(1e4, 1e6):.0f}\nqmatch{q}={rnd.randint(50, 2000)}\n'
+                           f'qplughole{q}=0.000000\n')
+            for rank, target in [(r, True) for r in range(1, 11)] + [(1, False)]:
+                peptide, protein, start, mh, score, expect, oxidised = _synthetic_psm(rnd, q)
+                mods = ['0'] * (len(peptide) + 2)
+                if oxidised >= 0:
+                    mods[oxidised + 1] = '1'
+                accession = f'sp|FAKE{protein:05d}|FAKE{protein:05d}_SYNTH' if target else f'FAKE{protein:05d}'
+                line = (f'q{q}_p{rank}={rnd.choice((0, 0, 1))},{mh - 1.007276:.6f},{rnd.uniform(-0.02, 0.02):.6f},'
+                        f'{len(peptide) // 2},{peptide},18,{"".join(mods)},{score / rank:.2f},'
+                        f'0001002000000000000,0,0;"{accession}":0:{start}:{start + len(peptide) - 1}:1\n'
+                        f'q{q}_p{rank}_terms=K,R\n')
+                (peptides if target else decoys).append(line)
+        out.write(section.format('summary') + ''.join(summary))
+        out.write(section.format('peptides') + ''.join(peptides))
+        out.write(section.format('decoy_peptides') + ''.join(decoys))
+        for q in range(1, queries + 1):
+            ions = ','.join(f'{rnd.uniform(100, 2000):.4f}:{rnd.uniform(1, 1e4):.1f}' for _ in range(peaks))
+            out.write(section.format(f'query{q}') + f'title=synthetic%2e{q}%2e{q}%2e2\ncharge=2+\nIons1={ions}\n')
+        out.write(f'--{DAT_BOUNDARY}--\n')
+
+
+def read_notes(path):
+    '''label -> value of the <note type="input"> entries of a tandem parameter file'''
+    with open(path) as f:
+        return dict(re.findall(r'<note type="input" label="([^"]+)">([^<]*)</note>', f.read()))
+
+
+def fake_tandem(args):
+    '''Stand-in for tandem.exe: sleeps like a search and writes one model group per spectrum'''
+    notes = read_notes(args.conf)
+    defaults = notes.get('list path, default parameters')
+    if defaults and os.path.exists(defaults):
+        notes = dict(read_notes(defaults), **notes)
+    threads = int(notes.get('spectrum, threads', 1))
+    mgf_file, output = notes['spectrum, path'], notes['output, path']
+    with open(mgf_file, 'rb') as f:
+        spectra = sum(1 for line in f if line.startswith(b'BEGIN IONS'))
+    print(f'Loading spectra... {spectra} loaded, {threads} threads')
+    # Amdahl: part of a tandem search does not scale with threads
+    time.sleep(args.startup + spectra * args.per_spectrum * (args.serial + (1 - args.serial) / threads))
+    with open(output, 'w') as out:
+        out.write(f'<?xml version="1.0"?>\n<bioml xmlns:GAML="http://www.bioml.com/gaml/" '
+                  f'label="models from \'{mgf_file}\'">\n')
+        write_tandem_models(out, spectra, random.Random(spectra))
+        out.write('<group label="input parameters" type="parameters">\n')
+        for label, value in sorted(notes.items()):
+            out.write(f'\t<note type="input" label="{label}">{value}</note>\n')
+        out.write('</group>\n</bioml>\n')
+    print('Valid models = {}'.format(spectra))
+
+
+def fake_convert(args):
+    '''Stand-in for the raw to MGF conversion: reads the raw file, sleeps and writes a synthetic MGF'''
+    name = os.path.splitext(os.path.basename(args.infile))[0]
+    with open(args.infile, 'rb') as f:
+        size = sum(len(chunk) for chunk in iter(lambda: f.read(2**20), b''))
+    time.sleep(args.startup + size / 2**20 * args.per_mb)
+    # Seeded by the sample name, so samples do not share results through the result cache
+    synthetic_mgf(os.path.join(args.outdir, name + '.mgf'), args.spectra, seed=zlib.crc32(name.encode()))
+    print(f'Converted {size} bytes into {args.spectra} spectra')
+
+
+def fake_scaffold(args):
+    '''Stand-in for ScaffoldBatch: sleeps and writes <scafml>.sf3 of the given size'''
+    time.sleep(args.seconds)
+    with open(os.path.splitext(args.file)[0] + '.sf3', 'wb') as f:
+        f.write(b'\0' * args.size)
+    print(f'Scaffold finished {args.file}')
+
+
+def fake_postproc(args):
+    '''Stand-in for the Rscript postprocessing: sleeps and writes a report into the project directory'''
+    time.sleep(args.seconds)
+    with open(os.path.join(args.wd, args.projname + '_report.txt'), 'w') as f:
+        f.write(f'{args.script} {args.projname}\n')
+
+
+DAT_BOUNDARY = 'gc0p4Jq0M2Yt08jU534c0p'
+
+
+class _ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _MascotHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.fake.bytes_received += len(body)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def _send(self, status, body, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunked(self, status, parts):
+        self.send_response(status)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for part in parts:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(part), part))
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def do_POST(self):
+        fake = self.server.fake
+        path = urllib.parse.urlparse(self.path).path
+        body = self._body()
+        fake.hit(path.rsplit('/', 1)[-1])
+        if path.endswith('/login.pl'):
+            if fake.password and urllib.parse.parse_qs(body.decode()).get('password') != [fake.password]:
+                self._send(200, b'<html>Invalid username or password</html>')
+                return
+            self._send(200, b'<html>Logged in</html>', [('Set-Cookie', f'MASCOT_SESSION={fake.session}; Path=/')])
+        elif path.endswith('/nph-mascot.exe'):
+            if not fake.logged_in(self.headers):
+                self._send(200, b'<html>Sorry, your search could not be performed<br>\n'
+                                b'[M00279] You must be logged in to submit a search</html>')
+                return
+            fake.uploads.append(body)
+            fake.upload_headers.append(dict(self.headers))
+            if b'BEGIN IONS' not in body:
+                self._send(200, b'<html>Finished uploading search details...<br>\n'
+                                b'Sorry, your search could not be performed<br>\n[M00012] No queries</html>')
+                return
+            self._send_chunked(200, fake.search_page())
+        else:
+            self._send(404, b'')
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urllib.parse.urlparse(self.path)
+        fake.hit(url.path.rsplit('/', 1)[-1])
+        query = dict(urllib.parse.parse_qsl(url.query))
+        job = fake.jobs.get((query.get('DateDir'), query.get('ResJob')))
+        if not url.path.endswith('/ms-status.exe') or job is None:
+            self._send(404, b'')
+            return
+        if not fake.logged_in(self.headers):
+            self._send(403, b'<html>You must be logged in</html>')
+            return
+        ready_at, content = job
+        if time.time() < ready_at:
+            # Mascot is still writing the file
+            content = content[:len(content) // 2]
+        m = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if not m or not fake.ranges:
+            self._send(200, content)
+            return
+        if m.group(1):
+            start = int(m.group(1))
+            end = int(m.group(2)) + 1 if m.group(2) else len(content)
+        else:
+            start, end = max(0, len(content) - int(m.group(2))), len(content)
+        if start >= len(content):
+            self._send(416, b'', [('Content-Range', f'bytes */{len(content)}')])
+            return
+        self._send(206, content[start:end], [('Content-Range', f'bytes {start}-{end - 1}/{len(content)}')])
+
+
+class FakeMascot:
+    '''Local HTTP server answering login.pl, nph-mascot.exe and ms-status.exe like Mascot does.
+
+    nph-mascot.exe keeps the connection open with progress dots while a
+    search runs, `search_time` seconds, and names the result file, a .dat of
+    `dat_size` bytes, once it has finished. ms-status.exe serves a truncated
+    file for another `write_time` seconds. Requests are counted in `calls`,
+    uploaded bytes (as sent) in `bytes_received`. expire_sessions() logs
+    every client out; with a `password` only that one logs in. With ranges
+    False Range headers are ignored, as some proxies do.
+    '''
+
+    def __init__(self, search_time=1.0, dat_size=2**20, latency=0.0, host='127.0.0.1', port=0, write_time=0.0,
+                 password=None, ranges=True):
+        self.search_time = search_time
+        self.dat_size = dat_size
+        self.latency = latency
+        self.write_time = write_time
+        self.password = password
+        self.ranges = ranges
+        self.session = 1
+        self.calls = Counter()
+        self.bytes_received = 0
+        self.uploads = []
+        self.upload_headers = []
+        self.jobs = {}
+        self._ids = itertools.count(1)
+        self.server = _ThreadingServer((host, port), _MascotHandler)
+        self.server.fake = self
+        self._thread = None
+
+    @property
+    def cgi(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/mascot/cgi'
+
+    def hit(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def new_job(self):
+        date, file = time.strftime('%Y%m%d'), f'F{next(self._ids):06d}.dat'
+        head = f'MIME-Version: 1.0 (Generated by Mascot version 2.6.0)\nContent-Type: multipart/mixed; ' \
+               f'boundary={DAT_BOUNDARY}\n\n--{DAT_BOUNDARY}\nContent-Type: application/x-Mascot; ' \
+               f'name="parameters"\n\nFILE={file}\n'
+        tail = f'\n--{DAT_BOUNDARY}--\n'
+        filler = max(0, self.dat_size - len(head) - len(tail))
+        content = (head + 'q1_p1=0\n' * (filler // 7) + tail).encode()
+        self.jobs[(date, file)] = (time.time() + self.write_time, content)
+        return date, file
+
+    def search_page(self):
+        '''Parts of the nph-mascot.exe reply to an accepted search'''
+        yield b'<html>Finished uploading search details...<br>\nSearching'
+        end = time.time() + self.search_time
+        while time.time() < end:
+            time.sleep(min(0.5, max(0.0, end - time.time())))
+            yield b'.'
+        date, file = self.new_job()
+        yield (f'<br>\nSearch complete<br>\n'
+               f'<a href="../cgi/master_results_2.pl?file=../data/{date}/{file}">results</a>\n</html>').encode()
+
+    def logged_in(self, headers):
+        return re.search(rf'\bMASCOT_SESSION={self.session}\b', headers.get('Cookie', '')) is not None
+
+    def expire_sessions(self):
+        self.session += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='FakeMascot', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.set_defaults(func=lambda args: parser.print_help())
+    subparsers = parser.add_subparsers(dest='subparser')
+
+    tandem_parser = subparsers.add_parser('tandem')
+    tandem_parser.add_argument('conf')
+    tandem_parser.add_argument('--startup', type=float, default=0.5, help='seconds to load the database')
+    tandem_parser.add_argument('--per-spectrum', type=float, default=0.001, help='CPU seconds per spectrum')
+    tandem_parser.add_argument('--serial', type=float, default=0.3, help='fraction not sped up by threads')
+    tandem_parser.set_defaults(func=fake_tandem)
+
+    convert_parser = subparsers.add_parser('convert')
+    convert_parser.add_argument('infile')
+    convert_parser.add_argument('outdir')
+    convert_parser.add_argument('--startup', type=float, default=0.2, help='seconds per conversion')
+    convert_parser.add_argument('--per-mb', type=float, default=0.01, help='seconds per MB of raw file')
+    convert_parser.add_argument('--spectra', type=int, default=2000)
+    convert_parser.set_defaults(func=fake_convert)
+
+    scaffold_parser = subparsers.add_parser('scaffold')
+    scaffold_parser.add_argument('-f', dest='file', required=True)
+    scaffold_parser.add_argument('--seconds', type=float, default=1.0)
+    scaffold_parser.add_argument('--size', type=int, default=2**20, help='bytes of the .sf3 output')
+    scaffold_parser.set_defaults(func=fake_scaffold)
+
+    postproc_parser = subparsers.add_parser('postproc')
+    postproc_parser.add_argument('script')
+    postproc_parser.add_argument('wd')
+    postproc_parser.add_argument('projname')
+    postproc_parser.add_argument('--seconds', type=float, default=0.5)
+    postproc_parser.set_defaults(func=fake_postproc)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,438 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from scheduling import QueuedJob
+
+STAGE_IMPORT = 'import'
+STAGE_CONVERT = 'convert'
+STAGE_TANDEM = 'tandem'
+STAGE_MASCOT = 'mascot'
+# One job per project, keyed by its Run_scaffold = RUN row
+STAGE_SCAFFOLD = 'scaffold'
+# PSM tables of the search results, queued again by each search of the sample
+STAGE_SUMMARY = 'summary'
+# Only used for timings in the stats table
+STAGE_MASCOT_UPLOAD = 'mascot_upload'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stage TEXT NOT NULL,
+    project TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    protocol TEXT NOT NULL DEFAULT '',
+    organism TEXT NOT NULL DEFAULT '',
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    lease REAL,
+    UNIQUE (stage, project, sample)
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (stage, state, id);
+CREATE INDEX IF NOT EXISTS jobs_sample ON jobs (project, sample);
+CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (stage, updated);
+CREATE TABLE IF NOT EXISTS priorities (
+    project TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    owner TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (project, sample)
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    stage TEXT NOT NULL,
+    project TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (stage, project, sample, name)
+);
+CREATE TABLE IF NOT EXISTS stats (
+    stage TEXT NOT NULL,
+    project TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    bytes_in INTEGER,
+    bytes_out INTEGER,
+    returncode INTEGER,
+    finished REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stats_stage ON stats (stage, finished);
+'''
+
+JOB_COLUMNS = 'id, stage, project, sample, protocol, organism, state, attempts, updated'
+
+
+class Job:
+    __slots__ = ('id', 'stage', 'project', 'sample', 'protocol', 'organism', 'state', 'attempts', 'queued')
+
+    def __init__(self, id, stage, project, sample, protocol, organism, state, attempts, queued=None):
+        self.id = id
+        self.stage = stage
+        self.project = project
+        self.sample = sample
+        self.protocol = protocol
+        self.organism = organism
+        self.state = state
+        self.attempts = attempts
+        # When the job last entered the queue
+        self.queued = queued
+
+    @property
+    def psample(self):
+        return (self.project, self.sample, self.protocol, self.organism)
+
+    def __repr__(self):
+        return f'Job({self.id}, {self.stage}, {"/".join(self.psample)}, {self.state})'
+
+
+class JobStore:
+    '''SQLite (WAL) queue of pipeline jobs, one row per (stage, project, sample).
+
+    claim() atomically moves the next queued job of a stage to running,
+    ack() marks it done and retry() puts it back into the queue until
+    max_attempts is reached. Connections are per thread.
+
+    Without a scheduler the next job is the oldest one. A scheduler (see
+    scheduling.FairShare) picks from the queued jobs of the stage with their
+    sample's priority and owner, set with set_priorities(). `clock` is only
+    replaced by simulations.
+
+    A claimed job is leased for `lease` seconds. claimed() renews the leases
+    from a background thread while the block runs, so the lease only runs out
+    when the process dies, and recover() then puts the job back into the
+    queue. Jobs keep named checkpoints (e.g. the id of a submitted search)
+    until they are done, so a resumed job can skip the work already done.
+
+    Hosts sharing the database file over a network filesystem pass a `lock`
+    (cluster.SharedLock) that every transaction holds, and the database uses
+    a rollback journal, as WAL needs memory shared by all its users. Reads
+    and schema changes outside of a transaction go through read() and
+    create(), which hold the lock as well.
+    '''
+
+    def __init__(self, path, max_attempts=3, timeout=60, scheduler=None, clock=time.time, lease=300, lock=None):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.scheduler = scheduler
+        self.clock = clock
+        self.lease = lease
+        self.lock = lock
+        self._lock_mutex = threading.Lock()
+        self._local = threading.local()
+        self._held = {}
+        self._held_lock = threading.Lock()
+        self._renewer = None
+        with self.read() as db:
+            db.executescript(SCHEMA)
+            if 'lease' not in {column for _, column, *rest in db.execute('PRAGMA table_info(jobs)')}:
+                db.execute('ALTER TABLE jobs ADD COLUMN lease REAL')
+
+    def connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            db.execute('PRAGMA journal_mode=DELETE' if self.lock else 'PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _exclusive(self):
+        if self.lock is None:
+            yield
+            return
+        with self._lock_mutex, self.lock:
+            yield
+
+    @contextlib.contextmanager
+    def read(self):
+        '''Connection for the block, holding the lock of the hosts sharing the database; fetch the rows within'''
+        db = self.connection()
+        with self._exclusive():
+            yield db
+
+    def create(self, schema):
+        '''Run the CREATE ... IF NOT EXISTS statements of schema'''
+        with self.read() as db:
+            db.executescript(schema)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        db = self.connection()
+        with self._exclusive():
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            else:
+                db.execute('COMMIT')
+
+    def enqueue(self, stage, psamples, state=QUEUED):
+        '''Add jobs, returns the psamples that were not already known for the stage'''
+        added = []
+        now = self.clock()
+        with self.transaction() as db:
+            for project, sample, protocol, organism in psamples:
+                cur = db.execute('INSERT OR IGNORE INTO jobs (stage, project, sample, protocol, organism, state,'
+                                 ' created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                 (stage, project, sample, protocol, organism, state, now, now))
+                if cur.rowcount:
+                    added.append((project, sample, protocol, organism))
+        return added
+
+    def requeue(self, stage, psample):
+        '''Queue a known job again regardless of its state'''
+        with self.transaction() as db:
+            db.execute('UPDATE jobs SET state = ?, attempts = 0, error = NULL, lease = NULL, updated = ?'
+                       ' WHERE stage = ? AND project = ? AND sample = ?',
+                       (QUEUED, self.clock(), stage, psample[0], psample[1]))
+            self._clear_checkpoints(db, stage, psample)
+
+    def remove(self, stage, psamples):
+        '''Forget jobs, so the psamples can be enqueued again'''
+        with self.transaction() as db:
+            for psample in psamples:
+                db.execute('DELETE FROM jobs WHERE stage = ? AND project = ? AND sample = ?',
+                           (stage, psample[0], psample[1]))
+                self._clear_checkpoints(db, stage, psample)
+
+    def set_priorities(self, entries):
+        '''entries is [(project, sample, priority, owner)], applies to every stage of the sample'''
+        with self.transaction() as db:
+            db.executemany('INSERT OR REPLACE INTO priorities (project, sample, priority, owner) VALUES (?, ?, ?, ?)',
+                           entries)
+
+    def _next_id(self, db, stage, now):
+        if self.scheduler is None:
+            row = db.execute('SELECT id FROM jobs WHERE stage = ? AND state = ? ORDER BY id LIMIT 1',
+                             (stage, QUEUED)).fetchone()
+            return row[0] if row else None
+        queued = [QueuedJob(*row) for row in db.execute(
+            'SELECT j.id, j.project, COALESCE(p.owner, \'\'), COALESCE(p.priority, 0), j.updated, j.organism'
+            ' FROM jobs j'
+            ' LEFT JOIN priorities p ON p.project = j.project AND p.sample = j.sample'
+            ' WHERE j.stage = ? AND j.state = ?', (stage, QUEUED))]
+        if not queued:
+            return None
+        used = db.execute('SELECT j.project, COALESCE(p.owner, \'\'), COUNT(*) FROM jobs j'
+                          ' LEFT JOIN priorities p ON p.project = j.project AND p.sample = j.sample'
+                          ' WHERE j.stage = ? AND (j.state = ? OR (j.state IN (?, ?) AND j.updated >= ?))'
+                          ' GROUP BY j.project, p.owner',
+                          (stage, RUNNING, DONE, FAILED, now - self.scheduler.window)).fetchall()
+        bonus = self.scheduler.affinity.get(stage, 0.0)
+        warm = self._warm_organisms(db, stage) if bonus else ()
+        return self.scheduler.pick(queued, used, now, warm, bonus)
+
+    def _warm_organisms(self, db, stage):
+        '''Organisms of the running jobs of the stage and of the last one finished'''
+        warm = {organism for organism, in db.execute('SELECT organism FROM jobs WHERE stage = ? AND state = ?',
+                                                      (stage, RUNNING))}
+        last = db.execute('SELECT organism FROM jobs WHERE stage = ? AND state IN (?, ?) ORDER BY updated DESC'
+                          ' LIMIT 1', (stage, DONE, FAILED)).fetchone()
+        if last:
+            warm.add(last[0])
+        return warm
+
+    def claim(self, stage, worker=None):
+        with self.transaction() as db:
+            now = self.clock()
+            job_id = self._next_id(db, stage, now)
+            if job_id is None:
+                return None
+            job = Job(*db.execute(f'SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?', (job_id,)).fetchone())
+            job.state, job.attempts = RUNNING, job.attempts + 1
+            db.execute('UPDATE jobs SET state = ?, attempts = ?, worker = ?, lease = ?, updated = ? WHERE id = ?',
+                       (job.state, job.attempts, worker, now + self.lease, now, job.id))
+        return job
+
+    def _finish(self, job, state, error=None):
+        '''False when the job is no longer ours, its lease expired and recover() took it back'''
+        with self.transaction() as db:
+            cur = db.execute('UPDATE jobs SET state = ?, error = ?, lease = NULL, updated = ?'
+                             ' WHERE id = ? AND state = ? AND attempts = ?',
+                             (state, error, self.clock(), job.id, RUNNING, job.attempts))
+            if not cur.rowcount:
+                return False
+            if state == DONE:
+                self._clear_checkpoints(db, job.stage, job.psample)
+        job.state = state
+        return True
+
+    def ack(self, job):
+        return self._finish(job, DONE)
+
+    def retry(self, job, error=None):
+        '''Back into the queue, or failed after max_attempts'''
+        return self._finish(job, QUEUED if job.attempts < self.max_attempts else FAILED, error)
+
+    def fail(self, job, error=None):
+        return self._finish(job, FAILED, error)
+
+    def heartbeat(self):
+        '''Renew the leases of the jobs held by claimed() blocks, returns the jobs whose lease was lost'''
+        with self._held_lock:
+            held = list(self._held.values())
+        lost = []
+        if not held:
+            return lost
+        with self.transaction() as db:
+            expires = self.clock() + self.lease
+            for job in held:
+                cur = db.execute('UPDATE jobs SET lease = ? WHERE id = ? AND state = ? AND attempts = ?',
+                                 (expires, job.id, RUNNING, job.attempts))
+                if not cur.rowcount:
+                    lost.append(job)
+        return lost
+
+    def _renew(self):
+        while True:
+            time.sleep(self.lease / 3)
+            try:
+                self.heartbeat()
+            except sqlite3.Error:
+                # Busy database, the lease still has two thirds to go
+                pass
+
+    def _hold(self, job):
+        with self._held_lock:
+            self._held[job.id] = job
+            if self._renewer is None:
+                self._renewer = threading.Thread(target=self._renew, name='job-leases', daemon=True)
+                self._renewer.start()
+
+    def _release(self, job):
+        with self._held_lock:
+            self._held.pop(job.id, None)
+
+    @contextlib.contextmanager
+    def claimed(self, stage, worker=None):
+        '''Claim a job (or None) for the block, ack on success and retry on exceptions.
+
+        The lease of the job is renewed until the block exits.
+        '''
+        job = self.claim(stage, worker)
+        if job is not None:
+            self._hold(job)
+        try:
+            yield job
+        except BaseException as e:
+            if job is not None and job.state == RUNNING:
+                self.retry(job, repr(e))
+            raise
+        else:
+            if job is not None and job.state == RUNNING:
+                self.ack(job)
+        finally:
+            if job is not None:
+                self._release(job)
+
+    def recover(self):
+        '''Queue again (or fail after max_attempts) the running jobs whose lease expired, returns them'''
+        now = self.clock()
+        with self.transaction() as db:
+            jobs = [Job(*row) for row in db.execute(f'SELECT {JOB_COLUMNS} FROM jobs'
+                                                    f' WHERE state = ? AND (lease IS NULL OR lease < ?)',
+                                                    (RUNNING, now))]
+            for job in jobs:
+                job.state = QUEUED if job.attempts < self.max_attempts else FAILED
+                db.execute('UPDATE jobs SET state = ?, error = ?, lease = NULL, updated = ? WHERE id = ?',
+                           (job.state, 'lease expired', now, job.id))
+        return jobs
+
+    def checkpoint(self, stage, psample, name, value):
+        '''Remember a step of a job done, kept until the job is done or requeued'''
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO checkpoints (stage, project, sample, name, value) VALUES (?, ?, ?, ?, ?)',
+                       (stage, psample[0], psample[1], name, json.dumps(value)))
+
+    def checkpoints(self, stage, psample):
+        '''{name: value} of the checkpoints of a job'''
+        with self.read() as db:
+            rows = db.execute('SELECT name, value FROM checkpoints WHERE stage = ? AND project = ? AND sample = ?',
+                              (stage, psample[0], psample[1])).fetchall()
+        return {name: json.loads(value) for name, value in rows}
+
+    def clear_checkpoints(self, stage, psample):
+        with self.transaction() as db:
+            self._clear_checkpoints(db, stage, psample)
+
+    def _clear_checkpoints(self, db, stage, psample):
+        db.execute('DELETE FROM checkpoints WHERE stage = ? AND project = ? AND sample = ?',
+                   (stage, psample[0], psample[1]))
+
+    def record(self, stage, psample, seconds, bytes_in=None, bytes_out=None, returncode=None):
+        '''Keep timings of a finished piece of work'''
+        with self.transaction() as db:
+            db.execute('INSERT INTO stats (stage, project, sample, seconds, bytes_in, bytes_out, returncode, finished)'
+                       ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (stage, psample[0], psample[1], seconds, bytes_in, bytes_out, returncode, self.clock()))
+
+    def keys(self, stage, state=None):
+        '''Set of (project, sample) known for the stage'''
+        query, params = 'SELECT project, sample FROM jobs WHERE stage = ?', (stage,)
+        if state:
+            query, params = query + ' AND state = ?', params + (state,)
+        with self.read() as db:
+            return set(db.execute(query, params).fetchall())
+
+    def pending(self, project, stages, states=(QUEUED, RUNNING)):
+        '''Number of jobs of the project in the stages that are still in one of the states'''
+        stages, states = tuple(stages), tuple(states)
+        with self.read() as db:
+            return db.execute(
+                f'SELECT COUNT(*) FROM jobs WHERE project = ? AND stage IN ({", ".join("?" * len(stages))})'
+                f' AND state IN ({", ".join("?" * len(states))})', (project,) + stages + states).fetchone()[0]
+
+    def finished(self, stage, since):
+        '''Jobs of the stage done since the given time'''
+        with self.read() as db:
+            rows = db.execute(f'SELECT {JOB_COLUMNS} FROM jobs WHERE stage = ? AND state = ? AND updated >= ?',
+                              (stage, DONE, since)).fetchall()
+        return [Job(*row) for row in rows]
+
+    def counts(self):
+        '''{(stage, state): n}'''
+        with self.read() as db:
+            rows = db.execute('SELECT stage, state, COUNT(*) FROM jobs GROUP BY stage, state').fetchall()
+        return {(stage, state): n for stage, state, n in rows}
+
+
+def read_list(filename):
+    result = []
+    if not os.path.exists(filename):
+        return result
+    with open(filename, "r") as f:
+        for l in f.readlines():
+            if l.strip():
+                result.append(tuple(map(lambda x: x.strip(), l.split('\t'))))
+    return result
+
+
+def migrate_lists(store, lists):
+    '''One-shot import of the old TSV queues, lists is [(filename, stage, state)].
+
+    Migrated files are renamed to <filename>.migrated so a second run is a no-op.
+    '''
+    migrated = {}
+    for filename, stage, state in lists:
+        entries = read_list(filename)
+        if not os.path.exists(filename):
+            continue
+        migrated[filename] = len(store.enqueue(stage, entries, state))
+        os.rename(filename, filename + '.migrated')
+    return migrated
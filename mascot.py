@@ -0,0 +1,393 @@
+'''Mascot client keeping several searches in flight over one authenticated session.
+
+The event loop runs in a background thread; blocking requests calls are
+handed to a thread pool, so worker threads can share one client through
+MascotClient.run().
+'''
+import asyncio
+import collections
+import functools
+import heapq
+import os
+import re
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import mgf
+from executor import file_tail, fsync_replace
+
+RESULT_RE = re.compile(r'master_results(?:_2)?\.pl\?file=.*?data/(?P<date>\d+)/(?P<file>F\d+\.dat)')
+SEARCH_ERROR = 'Sorry, your search could not be performed'
+# Mascot security asking for a login again, the session expired or the server restarted
+LOGIN_REQUIRED_RE = re.compile(r'must be logged in|not logged in|session (?:has )?expired', re.I)
+# Closing MIME boundary of a complete .dat file
+DAT_END = b'--gc0p4Jq0M2Yt08jU534c0p--'
+# Upload settings kept in the .par files, not sent to Mascot
+MIN_INTENSITY_PAR = 'MSAUTO_MIN_INTENSITY'
+TOP_N_PAR = 'MSAUTO_TOP_N'
+
+MascotResult = collections.namedtuple('MascotResult', 'date file bytes_sent upload_seconds dat_bytes')
+
+
+class MascotError(Exception):
+    pass
+
+
+class LoginRequired(MascotError):
+    pass
+
+
+def dat_complete(path):
+    '''True for a whole .dat result file, False for a missing or cut off one'''
+    return file_tail(path, len(DAT_END) + 16).rstrip().endswith(DAT_END)
+
+
+def get_default_mascot_pars(mascot_defaults):
+    filename = mascot_defaults
+    pars = {}
+    with open(filename, "r") as f:
+        for l in f.readlines():
+            name, par = map(lambda x: x.strip(), l.split("="))
+            pars[name] = par
+    pars['FORMVER'] = '1.01'
+    return pars
+
+
+def pop_peak_filter(pars):
+    '''Remove the peak filter settings from .par pars, returns (min_intensity, top_n)'''
+    min_intensity = pars.pop(MIN_INTENSITY_PAR, None)
+    top_n = pars.pop(TOP_N_PAR, None)
+    return (float(min_intensity) if min_intensity else None,
+            int(top_n) if top_n else None)
+
+
+def filter_peaks(block, min_intensity=None, top_n=None):
+    '''Drop peaks of one MGF spectrum block below min_intensity or outside the top_n most intense'''
+    lines, peaks = [], []
+    for line in block.splitlines(True):
+        if line[:1].isdigit():
+            values = line.split()
+            intensity = float(values[1]) if len(values) > 1 else 0.0
+            if min_intensity is None or intensity >= min_intensity:
+                peaks.append((len(lines), intensity))
+                lines.append(line)
+            continue
+        lines.append(line)
+    if top_n is not None and len(peaks) > top_n:
+        drop = {i for i, _ in peaks} - {i for i, _ in heapq.nlargest(top_n, peaks, key=lambda p: p[1])}
+        lines = [line for i, line in enumerate(lines) if i not in drop]
+    return b''.join(lines)
+
+
+def iter_mgf(mgfpath, min_intensity=None, top_n=None, chunk_size=2**20):
+    '''MGF content in chunks, spectrum by spectrum through filter_peaks() when a filter is set'''
+    with open(mgfpath, 'rb') as f:
+        if min_intensity is None and top_n is None:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+            return
+        buffer = []
+        size = 0
+        for line in f:
+            if line.startswith(mgf.BEGIN):
+                block = [line]
+                for line in f:
+                    block.append(line)
+                    if line.startswith(mgf.END):
+                        break
+                line = filter_peaks(b''.join(block), min_intensity, top_n)
+            buffer.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                yield b''.join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield b''.join(buffer)
+
+
+def multipart(boundary, fields, filename, chunks):
+    '''multipart/form-data body with the file part streamed from chunks'''
+    for name, value in fields.items():
+        yield (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n').encode()
+    yield (f'--{boundary}\r\nContent-Disposition: form-data; name="FILE"; filename="{filename}"\r\n'
+           f'Content-Type: application/octet-stream\r\n\r\n').encode()
+    for chunk in chunks:
+        yield chunk
+    yield f'\r\n--{boundary}--\r\n'.encode()
+
+
+def gzipped(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class UploadCounter:
+    '''Passes chunks through, counting bytes and the time until the last one was taken'''
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def __iter__(self):
+        start = time.time()
+        for chunk in self.chunks:
+            self.bytes += len(chunk)
+            yield chunk
+        self.seconds = time.time() - start
+
+
+class SizedBody:
+    '''Chunks of a body of known size, sent with a Content-Length instead of chunked'''
+
+    def __init__(self, chunks, size):
+        self.chunks = chunks
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+
+class MascotClient:
+    def __init__(self, cgi, user, password, concurrency=4, poll=30, chunk_size=2**20, timeout=600,
+                 upload_gzip=False, max_wait=24 * 3600):
+        self.cgi = cgi
+        self.xcgi = cgi.replace('cgi', 'x-cgi')
+        self.user = user
+        self.password = password
+        self.concurrency = concurrency
+        self.poll = poll
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.upload_gzip = upload_gzip
+        # Seconds a result file may stay incomplete, in wait() and again in download(), before giving up
+        self.max_wait = max_wait
+        self.session = requests.Session()
+        # Logins done so far, a request failing for want of one logs in again unless another did since
+        self.logins = 0
+        # False once the server answered a Range request with the whole file
+        self.ranges = None
+        self.loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(concurrency * 2)
+        self._limit = None
+        self._login_lock = None
+        self._thread = threading.Thread(target=self.loop.run_forever, name='MascotClient', daemon=True)
+        self._thread.start()
+
+    def run(self, coro):
+        '''Run a coroutine on the client loop from any other thread and wait for it'''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def gather(self, *coros):
+        return await asyncio.gather(*coros)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._executor.shutdown()
+        self.session.close()
+
+    async def _call(self, func, *args, **kwargs):
+        return await self.loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def login(self, expired=None):
+        '''Log in once, or again when the session of login number `expired` was refused'''
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        async with self._login_lock:
+            if self.logins and self.logins != expired:
+                return
+            response = await self._call(self.session.post, self.cgi + '/login.pl', timeout=self.timeout,
+                                        data={'username': self.user, 'password': self.password,
+                                              'action': 'login', 'savecookie': '1'})
+            response.raise_for_status()
+            self.logins += 1
+
+    async def _logged_in(self, func, *args):
+        '''func(*args) in the pool, logging in again and retrying once when Mascot asks for a login'''
+        await self.login()
+        logins = self.logins
+        try:
+            return await self._call(func, *args)
+        except LoginRequired:
+            await self.login(logins)
+            return await self._call(func, *args)
+
+    @staticmethod
+    def _check_login(response):
+        if response.status_code in (401, 403):
+            raise LoginRequired(f'Mascot refused {response.url} with {response.status_code}')
+
+    def _submit(self, mgfpath, pars, log, min_intensity=None, top_n=None):
+        '''Upload the search and read the nph-mascot.exe page until it names the result file.
+
+        Mascot only names it once the search has run, so this request stays
+        open for the whole search: completion is still signalled by it, and
+        wait() only covers the last write of the file and resumed searches.
+        '''
+        boundary = uuid.uuid4().hex
+        headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        body = multipart(boundary, pars, os.path.basename(mgfpath),
+                         iter_mgf(mgfpath, min_intensity, top_n, self.chunk_size))
+        if self.upload_gzip:
+            body = gzipped(body)
+            headers['Content-Encoding'] = 'gzip'
+        upload = UploadCounter(body)
+        # Streamed either way, the MGF is never held in memory. Only a filtered or gzipped body, whose
+        # size is not known up front, is sent chunked, which not every server in front of Mascot accepts
+        if self.upload_gzip or min_intensity is not None or top_n is not None:
+            data = iter(upload)
+        else:
+            size = sum(map(len, multipart(boundary, pars, os.path.basename(mgfpath), []))) + os.path.getsize(mgfpath)
+            data = SizedBody(upload, size)
+        response = self.session.post(self.cgi + '/nph-mascot.exe?1', data=data, headers=headers,
+                                     stream=True, timeout=self.timeout)
+        with response:
+            self._check_login(response)
+            response.raise_for_status()
+            text = ''
+            # Stop reading as soon as the result file is named instead of waiting for the whole page
+            chunks = response.iter_content(chunk_size=None, decode_unicode=True)
+            for chunk in chunks:
+                text += chunk if isinstance(chunk, str) else chunk.decode(errors='replace')
+                if SEARCH_ERROR in text:
+                    # The reason follows, the rest of the error page is short
+                    text += ''.join(c if isinstance(c, str) else c.decode(errors='replace') for c in chunks)
+                    if LOGIN_REQUIRED_RE.search(text):
+                        raise LoginRequired(f'Mascot asked for a login again to search {mgfpath}')
+                    log("Mascot response was: " + text)
+                    raise MascotError(f'Search of {mgfpath} could not be performed')
+                match = RESULT_RE.search(text)
+                if match:
+                    return match.group('date'), match.group('file'), upload.bytes, upload.seconds
+        log("Mascot response was: " + text)
+        raise MascotError(f'No result file in the Mascot response for {mgfpath}')
+
+    async def submit(self, mgfpath, pars, log, min_intensity=None, top_n=None):
+        '''Upload a search, returns (date dir, result file, bytes sent, upload seconds)'''
+        return await self._logged_in(self._submit, mgfpath, pars, log, min_intensity, top_n)
+
+    def result_url(self, date, file):
+        return self.xcgi + f'/ms-status.exe?Autorefresh=false&Show=RESULTFILE&DateDir={date}&ResJob={file}'
+
+    def _finished(self, date, file):
+        '''True once the result file is complete, None when the server ignores Range and cannot tell cheaply'''
+        response = self.session.get(self.result_url(date, file), headers={'Range': f'bytes=-{len(DAT_END) + 2}'},
+                                    stream=True, timeout=self.timeout)
+        with response:
+            if response.status_code == 416:
+                return False
+            self._check_login(response)
+            response.raise_for_status()
+            if response.status_code != 206:
+                # The whole file again on every poll, closed unread
+                self.ranges = False
+                return None
+            return response.content.rstrip().endswith(DAT_END)
+
+    async def wait(self, date, file):
+        '''Poll ms-status.exe until the result file is complete.
+
+        Without Range support the download itself checks the file is whole,
+        so it is the only full read of the file. Raises MascotError when it
+        is still incomplete after max_wait seconds.
+        '''
+        deadline = time.monotonic() + self.max_wait
+        while self.ranges is not False:
+            finished = await self._logged_in(self._finished, date, file)
+            if finished is not False:
+                return
+            if time.monotonic() >= deadline:
+                raise MascotError(f'Mascot result {date}/{file} still incomplete after {self.max_wait}s')
+            await asyncio.sleep(self.poll)
+
+    def _download(self, date, file, datpath):
+        '''Size of the downloaded file, None when it is not complete yet'''
+        part = datpath + '.part'
+        done = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range': f'bytes={done}-'} if done and self.ranges is not False else {}
+        with self.session.get(self.result_url(date, file), headers=headers, stream=True,
+                              timeout=self.timeout) as r:
+            if r.status_code == 416:
+                # Nothing left to fetch, the part file is complete
+                r.close()
+            else:
+                self._check_login(r)
+                r.raise_for_status()
+                mode = 'ab' if r.status_code == 206 else 'wb'
+                with open(part, mode) as f:
+                    for chunk in r.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+        if not dat_complete(part):
+            return None
+        fsync_replace(part, datpath)
+        return os.path.getsize(datpath)
+
+    async def download(self, date, file, datpath, retries=3):
+        '''Fetch the result file, resuming a partial download with a Range request.
+
+        Raises MascotError when the file is still incomplete after max_wait
+        seconds, the error of the last attempt after `retries` failed ones.
+        '''
+        attempt = 0
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            try:
+                size = await self._logged_in(self._download, date, file, datpath)
+            except requests.RequestException:
+                attempt += 1
+                if attempt == retries:
+                    raise
+            else:
+                if size is not None:
+                    return size
+                if time.monotonic() >= deadline:
+                    raise MascotError(f'Mascot result {date}/{file} still incomplete after {self.max_wait}s')
+                # Still being written, what was fetched is kept and resumed from
+            await asyncio.sleep(self.poll)
+
+    async def search(self, mgfpath, pars, datpath, log, min_intensity=None, top_n=None, resume=None,
+                     submitted=None):
+        '''Submit, wait and download with at most `concurrency` searches in flight.
+
+        The upload returns once Mascot has run the search (see _submit), so
+        a slot stays taken for the whole search.
+
+        resume is the (date dir, result file) of a search submitted before an
+        interruption, which is waited for instead of uploading the MGF again.
+        submitted(date, file) is called from a worker thread once a new search
+        is accepted.
+        '''
+        if self._limit is None:
+            self._limit = asyncio.Semaphore(self.concurrency)
+        async with self._limit:
+            if resume:
+                date, file = resume
+                sent, seconds = 0, 0.0
+                log(f'Resuming Mascot search {date}/{file}')
+            else:
+                part = datpath + '.part'
+                if os.path.exists(part):
+                    # Left by another search, never resume a download into it
+                    os.unlink(part)
+                date, file, sent, seconds = await self.submit(mgfpath, pars, log, min_intensity, top_n)
+                log(f'Mascot search {date}/{file} submitted, {sent} bytes uploaded in {seconds:.1f}s')
+                if submitted:
+                    await self._call(submitted, date, file)
+            await self.wait(date, file)
+            log(f'Downloading file {self.result_url(date, file)}')
+            size = await self.download(date, file, datpath)
+            log(f'Downloaded {size} bytes')
+            return MascotResult(date, file, sent, seconds, size)
@@ -0,0 +1,211 @@
+'''Counters and timings in the Prometheus text format, JSON-lines events and per-project log files'''
+import collections
+import contextlib
+import http.server
+import json
+import os
+import socketserver
+import threading
+import time
+from datetime import datetime
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+class Metrics:
+    '''In-process counters, gauges and summaries (count, sum, max) keyed by name and labels.
+
+    text() renders them in the Prometheus exposition format, export() writes
+    that atomically to a file (for the node_exporter textfile collector) and
+    serve() answers GET /metrics on a local port. event() appends one JSON
+    object per line to `events_path`.
+    '''
+
+    def __init__(self, prefix='msauto', events_path=None):
+        self.prefix = prefix
+        self.counters = collections.defaultdict(float)
+        self.gauges = {}
+        self.summaries = {}
+        self._lock = threading.Lock()
+        self._events = None
+        if events_path:
+            os.makedirs(os.path.dirname(events_path) or '.', exist_ok=True)
+            self._events = open(events_path, 'a', buffering=1)
+        self._server = None
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[(name, _labels(labels))] += value
+
+    def gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, _labels(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            summary = self.summaries.setdefault(key, [0, 0.0, value])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        '''Observe the seconds spent in the block, labelled with outcome="ok" or "error"'''
+        start = time.time()
+        try:
+            yield
+        except BaseException:
+            self.observe(name, time.time() - start, outcome='error', **labels)
+            raise
+        self.observe(name, time.time() - start, outcome='ok', **labels)
+
+    def event(self, kind, **fields):
+        if self._events is None:
+            return
+        line = json.dumps(dict(time=time.time(), event=kind, **fields), default=str)
+        with self._lock:
+            self._events.write(line + '\n')
+
+    def text(self):
+        lines = []
+        with self._lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f'# TYPE {self.prefix}_{name} {kind}')
+                    for (n, labels), value in sorted(values.items()):
+                        if n == name:
+                            lines.append(f'{self.prefix}_{name}{_format_labels(labels)} {value}')
+            for name in sorted({name for name, _ in self.summaries}):
+                summaries = [(labels, s) for (n, labels), s in sorted(self.summaries.items()) if n == name]
+                lines.append(f'# TYPE {self.prefix}_{name} summary')
+                for labels, (count, total, peak) in summaries:
+                    lines.append(f'{self.prefix}_{name}_count{_format_labels(labels)} {count}')
+                    lines.append(f'{self.prefix}_{name}_sum{_format_labels(labels)} {total}')
+                lines.append(f'# TYPE {self.prefix}_{name}_max gauge')
+                for labels, (count, total, peak) in summaries:
+                    lines.append(f'{self.prefix}_{name}_max{_format_labels(labels)} {peak}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.text())
+        os.replace(tmp, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        self._server = Server((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True).start()
+        return self._server.server_address[1]
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._events is not None:
+            self._events.close()
+            self._events = None
+
+
+class _TimedRequest:
+    def __init__(self, request, metrics, api, call):
+        self._request = request
+        self._metrics = metrics
+        self._api = api
+        self._call = call
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+    def execute(self, *args, **kwargs):
+        with self._metrics.timer('api_seconds', api=self._api, call=self._call):
+            return self._request.execute(*args, **kwargs)
+
+
+class InstrumentedService:
+    '''Proxy over a googleapiclient service timing every execute() as api_seconds{call="spreadsheets.values.get"}'''
+
+    def __init__(self, service, metrics, api='sheets', path=()):
+        self._service = service
+        self._metrics = metrics
+        self._api = api
+        self._path = path
+
+    def __getattr__(self, name):
+        attr = getattr(self._service, name)
+        if not callable(attr):
+            return attr
+        path = self._path + (name,)
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if hasattr(result, 'execute'):
+                return _TimedRequest(result, self._metrics, self._api, '.'.join(path))
+            return InstrumentedService(result, self._metrics, self._api, path)
+        return call
+
+
+def requests_hook(metrics, api):
+    '''requests response hook observing the time to the response headers'''
+    def hook(response, *args, **kwargs):
+        call = response.request.path_url.split('?')[0].rsplit('/', 1)[-1]
+        metrics.observe('api_seconds', response.elapsed.total_seconds(), api=api, call=call,
+                        outcome='ok' if response.ok else str(response.status_code))
+    return hook
+
+
+class LogFiles:
+    '''Append-only text logs kept open between lines, at most `keep` files at a time'''
+
+    def __init__(self, keep=64):
+        self.keep = keep
+        self._files = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def write(self, path, line):
+        stamp = datetime.now().strftime("[%d/%m/%Y  %H:%M:%S]\t")
+        with self._lock:
+            f = self._files.pop(path, None)
+            if f is None:
+                f = open(path, 'a', buffering=1)
+                while len(self._files) >= self.keep:
+                    self._files.popitem(last=False)[1].close()
+            self._files[path] = f
+            f.write(stamp + line + '\n')
+
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files.clear()
@@ -0,0 +1,222 @@
+'''Streaming access to MGF peak lists.
+
+Spectra are read block by block ("BEGIN IONS" ... "END IONS") without loading
+the file. build_index() records the byte offset of every spectrum in a
+sidecar <file>.mgf.idx so single spectra can be read from a memory map and
+the file can be split at spectrum boundaries by plain byte copies.
+'''
+import collections
+import mmap
+import os
+import re
+
+from executor import file_tail, atomic_open
+
+BEGIN = b'BEGIN IONS'
+END = b'END IONS'
+INDEX_SUFFIX = '.idx'
+INDEX_HEADER = 'scan\toffset\tlength\tcharge\tpepmass\n'
+COPY_BUFFER = 2**20
+
+TITLE_SCAN_RES = (re.compile(rb'scan=(\d+)'), re.compile(rb'\.(\d+)\.\d+\.\d+\s*$'))
+
+Spectrum = collections.namedtuple('Spectrum', 'params peaks')
+IndexEntry = collections.namedtuple('IndexEntry', 'scan offset length charge pepmass')
+
+
+def parse_spectrum(block):
+    '''bytes of one BEGIN IONS ... END IONS block -> Spectrum'''
+    params = collections.OrderedDict()
+    peaks = []
+    for line in block.splitlines():
+        line = line.strip()
+        if not line or line == BEGIN or line == END or line.startswith(b'#'):
+            continue
+        if line[:1].isdigit():
+            values = line.split()
+            peaks.append((float(values[0]), float(values[1]) if len(values) > 1 else 0.0))
+        elif b'=' in line:
+            key, _, value = line.partition(b'=')
+            params[key.decode().upper()] = value.decode()
+    return Spectrum(params, peaks)
+
+
+def format_spectrum(spectrum):
+    lines = ['BEGIN IONS']
+    lines.extend(f'{k}={v}' for k, v in spectrum.params.items())
+    lines.extend(f'{mz:g} {intensity:g}' for mz, intensity in spectrum.peaks)
+    lines.append('END IONS\n')
+    return '\n'.join(lines).encode()
+
+
+def iter_blocks(f):
+    '''Yield (offset, bytes) of every spectrum block of a binary file object'''
+    offset = f.tell()
+    start = None
+    lines = []
+    for line in f:
+        if start is None:
+            if line.startswith(BEGIN):
+                start = offset
+                lines = [line]
+        else:
+            lines.append(line)
+            if line.startswith(END):
+                yield start, b''.join(lines)
+                start = None
+        offset += len(line)
+
+
+def iter_spectra(path):
+    with open(path, 'rb') as f:
+        for offset, block in iter_blocks(f):
+            yield parse_spectrum(block)
+
+
+def write_spectra(path, spectra):
+    with open(path, 'wb') as f:
+        for spectrum in spectra:
+            f.write(format_spectrum(spectrum))
+
+
+def _block_entry(ordinal, offset, block):
+    scan, title, charge, pepmass = None, None, '', ''
+    for line in block.splitlines():
+        if line[:1].isdigit():
+            break
+        if line.startswith(b'SCANS='):
+            scan = line[6:].strip().split(b'-')[0]
+        elif line.startswith(b'TITLE='):
+            title = line[6:]
+        elif line.startswith(b'CHARGE='):
+            charge = line[7:].strip().decode()
+        elif line.startswith(b'PEPMASS='):
+            pepmass = line[8:].split()[0].decode() if line[8:].split() else ''
+    if scan is None and title is not None:
+        for regex in TITLE_SCAN_RES:
+            m = regex.search(title)
+            if m:
+                scan = m.group(1)
+                break
+    scan = int(scan) if scan is not None and scan.isdigit() else ordinal
+    return IndexEntry(scan, offset, len(block), charge, pepmass)
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def build_index(path):
+    '''Scan the MGF once and write the sidecar index, returns the entries'''
+    entries = []
+    with open(path, 'rb') as f:
+        for i, (offset, block) in enumerate(iter_blocks(f), 1):
+            entries.append(_block_entry(i, offset, block))
+    with atomic_open(index_path(path)) as f:
+        f.write(INDEX_HEADER)
+        for e in entries:
+            f.write(f'{e.scan}\t{e.offset}\t{e.length}\t{e.charge}\t{e.pepmass}\n')
+    return entries
+
+
+def load_index(path):
+    '''Sidecar index of path, rebuilt if missing or older than the MGF'''
+    ipath = index_path(path)
+    if not os.path.exists(ipath) or os.path.getmtime(ipath) < os.path.getmtime(path):
+        return build_index(path)
+    entries = []
+    with open(ipath) as f:
+        next(f)
+        for line in f:
+            scan, offset, length, charge, pepmass = line.rstrip('\n').split('\t')
+            entries.append(IndexEntry(int(scan), int(offset), int(length), charge, pepmass))
+    return entries
+
+
+class MgfFile:
+    '''Random access to the spectra of an indexed MGF through a memory map'''
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = load_index(path)
+        self.scans = {}
+        for e in self.entries:
+            self.scans.setdefault(e.scan, e)
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.entries else None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, scan):
+        return scan in self.scans
+
+    def block(self, scan):
+        e = self.scans[scan]
+        return self._map[e.offset:e.offset + e.length]
+
+    def __getitem__(self, scan):
+        return parse_spectrum(self.block(scan))
+
+    def header(self):
+        '''Global parameters before the first spectrum'''
+        return self._map[:self.entries[0].offset] if self.entries else b''
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def qc(path):
+    '''Spectrum count and precursor charge histogram from the index'''
+    entries = load_index(path)
+    charges = collections.Counter(e.charge or 'unknown' for e in entries)
+    return {'spectra': len(entries), 'charges': dict(sorted(charges.items()))}
+
+
+def is_complete(path):
+    '''True when the file ends with a whole spectrum, False for a missing or cut off MGF'''
+    return file_tail(path, 64).rstrip().endswith(END)
+
+
+def copy_range(src, dst, offset, length):
+    src.seek(offset)
+    while length > 0:
+        chunk = src.read(min(COPY_BUFFER, length))
+        if not chunk:
+            break
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+def split(path, parts, outpath):
+    '''Split into up to `parts` files of consecutive spectra with about equal counts.
+
+    outpath is a format string taking the part number, e.g. "x.part{}.mgf".
+    The global header is repeated in every part. Returns [(path, spectra)].
+    '''
+    entries = load_index(path)
+    parts = max(1, min(parts, len(entries)))
+    paths = []
+    with open(path, 'rb') as src:
+        header = src.read(entries[0].offset) if entries else b''
+        for i in range(parts):
+            chunk = entries[len(entries) * i // parts:len(entries) * (i + 1) // parts]
+            if not chunk and entries:
+                continue
+            part = outpath.format(i)
+            with open(part, 'wb') as dst:
+                dst.write(header)
+                if chunk:
+                    # Entries are consecutive, the part is one byte range
+                    start = chunk[0].offset
+                    copy_range(src, dst, start, chunk[-1].offset + chunk[-1].length - start)
+            paths.append((part, len(chunk)))
+    return paths
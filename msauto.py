@@ -7,41 +7,73 @@ from datetime import datetime
 import calendar
 import locale
 from pprint import pprint
-import httplib2
-import apiclient
-import requests
-from oauth2client.service_account import ServiceAccountCredentials
-import pandas as pd
+import time
 from time import sleep
 import os
+import shutil
+import sys
 from ilock import ILock
 import threading
-from tempfile import NamedTemporaryFile
-from shutil import move
-import contextlib
 import functools
-import jinja2
+from concurrent.futures import ThreadPoolExecutor
 
 from config import *
-
-PROJECT_HEADER = 'Project_title'
-SAMPLE_HEADER = 'Sample_ID'
-PROTOCOL_HEADER = 'Proteolysis_protocol'
-ORGANISM_HEADER = 'Organism'
-STATUS_HEADER = 'Status'
-SCAFFOLD_SAMPLE_HEADER = 'Scaffold_sample'
-SCAFFOLD_RUN_HEADER = 'Run_scaffold'
-
-TANDEM_DB_HEADER = 'Tandem_db'
-MASCOT_DB_HEADER = 'Mascot_db'
-TANDEM_PREFS_HEADER = 'Tandem_prefs'
-MASCOT_PREFS_HEADER = 'Mascot_prefs'
-POSTPROC_PREFS_HEADER = 'Postproc_prefs'
+from sheets import *
+from jobstore import *
+from prefs import *
+from daemon import Supervisor
+from watcher import RawIndex
+from sync import SheetSync
+from resultcache import ResultCache
+from readiness import ReadinessTracker
+from scheduling import FairShare
+from metrics import Metrics, InstrumentedService, LogFiles, requests_hook
+from cluster import SharedLock, Leadership, NodeRegistry, detect_stages
+from databases import DatabaseManager, DatabaseError
+from executor import *
+import mgf
+import tandem
+
+# pandas, jinja2, requests and the Google client libraries are imported by the
+# functions that use them, so the cron entry points start fast
 
 POOL_TIME = 1
+# Refreshed while held, so this only bounds the wait on the lock of a crashed host. Far above the
+# milliseconds of a transaction, one stalled by a slow mount or a swapping host is not broken into
+JOBS_LOCK_TTL = 120
+
+DISCOVERY_URL = 'https://sheets.googleapis.com/$discovery/rest?version=v4'
+
+GOOGLE_IMPORTS = ('httplib2', 'apiclient.discovery', 'oauth2client.service_account')
+# Deferred imports each subcommand ends up loading, used by bench-startup
+SUBCOMMAND_IMPORTS = {
+    'import': GOOGLE_IMPORTS,
+    'convert': GOOGLE_IMPORTS,
+    'tandem': GOOGLE_IMPORTS,
+    'mascot': GOOGLE_IMPORTS + ('mascot',),
+    'prefs': GOOGLE_IMPORTS + ('pandas',),
+    'scaffold': GOOGLE_IMPORTS + ('jinja2',),
+    'summary': GOOGLE_IMPORTS + ('mascot', 'results'),
+    'daemon': GOOGLE_IMPORTS + ('mascot', 'jinja2', 'results'),
+}
 
-LETTERS='ABCDEFGHIJKLNMOPQRSTUVWXYZ'
 g_service = None
+g_status = None
+g_jobs = None
+g_raw = None
+g_convert_gate = None
+g_tandem_gate = None
+g_mascot = None
+g_prefs = None
+g_sync = None
+g_results = None
+g_readiness = None
+g_metrics = None
+g_logs = LogFiles()
+g_nodes = None
+g_databases = None
+# Set by `msauto.py worker`, project logs are then written per node
+g_node = None
 
 LOCK_PREFS = 'LOCK_PREFS'
 LOCK_IMPORT = 'LOCK_IMPORT'
@@ -49,24 +81,49 @@ LOCK_CONVERT = 'LOCK_CONVERT'
 LOCK_TANDEM = 'LOCK_TANDEM'
 LOCK_MASCOT = 'LOCK_MASCOT'
 LOCK_SCAFFOLD = 'LOCK_SCAFFOLD'
+LOCK_SUMMARY = 'LOCK_SUMMARY'
 
 
-tandem_stub='''<?xml version="1.0"?>
-<bioml>
-	<note type="input" label="list path, default parameters">{defaults_path}</note>
-	<note type="input" label="list path, taxonomy information">{taxonomy_path}</note>
-	<note type="input" label="protein, taxon">{taxon}</note>
-	<note type="input" label="spectrum, path">{mgf_file}</note>
-	<note type="input" label="output, path">{output_path}</note>
-</bioml>
-'''
-
 def locked(lockname):
-    '''Run function locked system-wide'''
+    '''Run function locked system-wide, or cluster-wide in CLUSTER_MODE'''
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            with ILock(lockname):
+            lock = get_cluster_lock(lockname, NODE_TTL, keep=True) if CLUSTER_MODE else ILock(lockname)
+            with lock:
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_metrics():
+    global g_metrics
+
+    if g_metrics:
+        return g_metrics
+
+    g_metrics = Metrics(events_path=EVENTS_FILE)
+    return g_metrics
+
+
+def export_metrics(command):
+    '''Queue depths as gauges, then everything to METRICS_FILE'''
+    metrics = get_metrics()
+    counts = get_job_store().counts()
+    # Every stage and state, so a queue drained since the last export reads 0 rather than its last depth
+    stages = {STAGE_IMPORT, STAGE_CONVERT, STAGE_TANDEM, STAGE_MASCOT, STAGE_SCAFFOLD, STAGE_SUMMARY}
+    for stage in stages | {stage for stage, state in counts}:
+        for state in (QUEUED, RUNNING, DONE, FAILED):
+            metrics.gauge('jobs', counts.get((stage, state), 0), stage=stage, state=state)
+    metrics.export(METRICS_FILE.format(command=command))
+
+
+def timed(task):
+    '''Observe the run time of a periodic task as task_seconds{task=...}'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_metrics().timer('task_seconds', task=task):
                 return func(*args, **kwargs)
         return wrapper
     return decorator
@@ -78,106 +135,218 @@ def get_g_service():
     if g_service:
         return g_service
 
+    import httplib2
+    from apiclient import discovery
+    from oauth2client.service_account import ServiceAccountCredentials
+
     locale.setlocale(locale.LC_TIME, 'en_US.UTF-8')
     credentials = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE,
                                                                    ['https://www.googleapis.com/auth/spreadsheets',
                                                                     'https://www.googleapis.com/auth/drive'])
     httpAuth = credentials.authorize(httplib2.Http())
-    service = apiclient.discovery.build('sheets', 'v4', http=httpAuth)
+    service = discovery.build_from_document(get_discovery_doc(httplib2.Http()), http=httpAuth)
 
-    g_service = service
-    return service
+    g_service = InstrumentedService(service, get_metrics())
+    return g_service
 
 
-def get_current_table(uploaded=True, scaffold_check=False):
-    service = get_g_service()
-    range_name = 'List!A:I'
-    table = service.spreadsheets().values().get(spreadsheetId=spreadsheetId, range=range_name).execute()
-    colnames = table['values'][0]
-    colnames = list(map(lambda s: s.replace(' ', '_'), colnames))
-    d = pd.DataFrame( table['values'][1:], columns=colnames)
-    if uploaded:
-        d = d[d['Uploaded']=='TRUE']
-    if scaffold_check:
-        d = d[d['Run_scaffold']=='TRUE']
-    return d
+def get_discovery_doc(http):
+    '''Sheets v4 discovery document, cached on disk for DISCOVERY_CACHE_TTL seconds'''
+    if os.path.exists(DISCOVERY_CACHE) and time.time() - os.path.getmtime(DISCOVERY_CACHE) < DISCOVERY_CACHE_TTL:
+        with open(DISCOVERY_CACHE) as f:
+            return f.read()
+    response, content = http.request(DISCOVERY_URL)
+    if response.status != 200:
+        raise RuntimeError(f"Cannot fetch {DISCOVERY_URL}: {response.status}")
+    doc = content.decode()
+    with open(DISCOVERY_CACHE+'.tmp', 'w') as f:
+        f.write(doc)
+    os.replace(DISCOVERY_CACHE+'.tmp', DISCOVERY_CACHE)
+    return doc
+
+
+def get_sheet_sync():
+    global g_sync
+
+    if g_sync:
+        return g_sync
+
+    g_sync = SheetSync(get_job_store(), get_g_service(), spreadsheetId, LIST_RANGE,
+                       io_lock=get_status_writer().io_lock)
+    return g_sync
+
+
+def get_current_table():
+    '''Poll the tracking sheet once, the status writer resolves its rows from the same table'''
+    table, diff = get_sheet_sync().poll()
+    get_status_writer().use(table)
+    return table
 
 
 @locked(LOCK_PREFS)
 def get_current_prefs(args):
+    import pandas as pd
+
     service = get_g_service()
     range_name = 'Prefs!A:D'
     table = service.spreadsheets().values().get(spreadsheetId=spreadsheetId, range=range_name).execute()
     colnames = table['values'][0]
     colnames = list(map(lambda s: s.replace(' ', '_'), colnames))
     protocol = pd.DataFrame( table['values'][1:], columns=colnames)
-    protocol.to_csv(PROTOCOL_MAP, sep='\t', index=False)
+    protocol.to_csv(PROTOCOL_MAP+'.tmp', sep='\t', index=False)
 
     range_name = 'Prefs!E:G'
     table = service.spreadsheets().values().get(spreadsheetId=spreadsheetId, range=range_name).execute()
     colnames = table['values'][0]
     colnames = list(map(lambda s: s.replace(' ', '_'), colnames))
     organism = pd.DataFrame(table['values'][1:], columns=colnames)
-    organism.to_csv(ORGANISM_MAP, sep='\t', index=False)
+    organism.to_csv(ORGANISM_MAP+'.tmp', sep='\t', index=False)
+    # Readers do not lock, replace both maps only once they are complete
+    os.replace(PROTOCOL_MAP+'.tmp', PROTOCOL_MAP)
+    os.replace(ORGANISM_MAP+'.tmp', ORGANISM_MAP)
+    for problem in get_prefs_cache().validate():
+        print(problem)
     return protocol, organism
 
 
+def get_status_writer():
+    global g_status
+
+    if g_status:
+        return g_status
+
+    g_status = StatusWriter(get_g_service(), spreadsheetId, LIST_RANGE, STATUS_FLUSH_INTERVAL).start()
+    return g_status
+
+
 def set_status(psample, status, column=STATUS_HEADER):
-    service = get_g_service()
-    range_name = 'List!A:I'
-    table = service.spreadsheets().values().get(spreadsheetId=spreadsheetId, range=range_name).execute()
-    colnames = table['values'][0]
-    proj_cn = None
-    sample_cn = None
-    status_cn = None
-    target_row = None
-    for i, cn in enumerate(colnames):
-        if cn == PROJECT_HEADER:
-            proj_cn = i
-        elif cn == SAMPLE_HEADER:
-            sample_cn = i
-        elif cn == column:
-            status_cn = i
-    assert not(proj_cn is None and sample_cn is None and status_cn is None)
-    for i, col in enumerate(table['values']):
-        if col[proj_cn] == psample[0] and col[sample_cn] == psample[1]:
-            target_row = i
-            break
-    assert target_row is not None
-    range = f'List!{LETTERS[status_cn]}{target_row+1}'
+    get_status_writer().set(psample, status, column)
 
-    service = get_g_service()
-    body = {
-        'range': range,
-        'values': [[status]],
-        'majorDimension': 'ROWS',
-    }
-    request = service.spreadsheets().values().update(spreadsheetId=spreadsheetId, range=range,
-                                                     valueInputOption='RAW', body=body)
-    response = request.execute()
-
-
-def read_list(filename, lockname = None):
-    result = []
-    mgr = ILock if lockname else contextlib.suppress  # Kinda null manager, nullcontext for 3.7
-    with mgr(lockname):
-        if not os.path.exists(filename):
-            return result
-        with open(filename, "r") as f:
-            for l in f.readlines():
-                if l:
-                    sp = tuple(map(lambda x: x.strip(), l.split('\t')))
-                    result.append(sp)
-    return result
-
-
-def append_list(filename, pslist, lockname=None):
-    mgr = ILock if lockname else contextlib.suppress  # Kinda null manager, nullcontext for 3.7
-    with mgr(lockname):
-        mode = "a" if os.path.exists(filename) else "w"
-        with open(filename, mode) as f:
-            for project, sample, protocol, organism in pslist:
-                f.writelines(f"{project}\t{sample}\t{protocol}\t{organism}\n")
+
+def flush_status():
+    if g_status:
+        g_status.close()
+
+
+def get_job_store():
+    global g_jobs
+
+    if g_jobs:
+        return g_jobs
+
+    g_jobs = JobStore(DB_JOBS_FILE, JOB_MAX_ATTEMPTS,
+                      scheduler=FairShare(SCHEDULE_WEIGHTS, SCHEDULE_AGING, SCHEDULE_SHARE, SCHEDULE_WINDOW,
+                                          SCHEDULE_DB_AFFINITY),
+                      lease=JOB_LEASE, lock=get_cluster_lock('jobs.lock', JOBS_LOCK_TTL, keep=True))
+    return g_jobs
+
+
+def get_cluster_lock(name, ttl, keep=False):
+    if not CLUSTER_MODE:
+        return None
+    os.makedirs(CLUSTER_DIR, exist_ok=True)
+    return SharedLock(os.path.join(CLUSTER_DIR, name), ttl, keep=keep)
+
+
+def get_nodes():
+    global g_nodes
+
+    if g_nodes:
+        return g_nodes
+
+    g_nodes = NodeRegistry(get_job_store())
+    return g_nodes
+
+
+def get_databases():
+    global g_databases
+
+    if g_databases:
+        return g_databases
+
+    g_databases = DatabaseManager(get_job_store(), FASTA_DIR, TANDEM_TAXONOMY, FASTA_LOCAL_DIR, FASTA_WARM_TTL)
+    return g_databases
+
+
+def tandem_dbs():
+    return {row[TANDEM_DB_HEADER] for row in get_prefs_cache().organisms.get().values() if row[TANDEM_DB_HEADER]}
+
+
+def warm_databases():
+    '''Check and warm the databases of the queued Tandem searches, the most searched first'''
+    with get_job_store().read() as db:
+        rows = db.execute('SELECT organism, COUNT(*) FROM jobs WHERE stage = ? AND state IN (?, ?) GROUP BY organism'
+                          ' ORDER BY COUNT(*) DESC', (STAGE_TANDEM, QUEUED, RUNNING)).fetchall()
+    databases = get_databases()
+    for organism, n in rows:
+        try:
+            databases.prepare(get_db(organism, TANDEM_DB_HEADER))
+        except (KeyError, DatabaseError):
+            # Reported by the searches themselves
+            continue
+
+
+def database_problems():
+    '''Missing or broken FASTA of the databases named by the organism map'''
+    databases = get_databases()
+    problems = []
+    for organism, row in sorted(get_prefs_cache().organisms.get().items()):
+        for header in (TANDEM_DB_HEADER, MASCOT_DB_HEADER):
+            if not row[header]:
+                continue
+            info = databases.verify(row[header])
+            if info.problem:
+                problems.append(f'Organism {organism}: {header} {info.path} {info.problem}')
+    return problems
+
+
+def get_raw_index():
+    global g_raw
+
+    if g_raw:
+        return g_raw
+
+    g_raw = RawIndex(get_job_store(), RAW_ROOT, RAW_SETTLE_TIME)
+    return g_raw
+
+
+def run_stage(stage, func, worker=None):
+    '''Claim one queued job of the stage and run func(psample) on it'''
+    metrics = get_metrics()
+    start = time.time()
+    job = None
+    try:
+        with get_job_store().claimed(stage, worker) as job:
+            if job:
+                metrics.observe('queue_wait_seconds', start - job.queued, stage=stage)
+                metrics.event('job_start', stage=stage, project=job.project, sample=job.sample, worker=worker,
+                              attempt=job.attempts, waited=start - job.queued)
+                func(job.psample)
+    finally:
+        if job:
+            seconds = time.time() - start
+            metrics.observe('job_seconds', seconds, stage=stage, state=job.state)
+            metrics.event('job_end', stage=stage, project=job.project, sample=job.sample, worker=worker,
+                          state=job.state, seconds=seconds)
+    if job and job.state == DONE and stage in (STAGE_TANDEM, STAGE_MASCOT):
+        if get_readiness().search_done(job.project):
+            log(job.project, f"All searches of project {job.project} are done, queued for Scaffold")
+    return job
+
+
+def record_stats(stage, psample, seconds, bytes_in=None, bytes_out=None, returncode=None):
+    '''Stats of a finished piece of work to the job store, the metrics and the event log'''
+    get_job_store().record(stage, psample, seconds, bytes_in, bytes_out, returncode)
+    metrics = get_metrics()
+    metrics.observe('work_seconds', seconds, stage=stage)
+    if bytes_in is not None:
+        metrics.inc('bytes_in_total', bytes_in, stage=stage)
+    if bytes_out is not None:
+        metrics.inc('bytes_out_total', bytes_out, stage=stage)
+    if returncode is not None:
+        metrics.inc('exit_codes_total', stage=stage, code=returncode)
+    metrics.event('stats', stage=stage, project=psample[0], sample=psample[1], seconds=seconds,
+                  bytes_in=bytes_in, bytes_out=bytes_out, returncode=returncode)
 
 
 def get_proj_root(project):
@@ -188,24 +357,31 @@ def get_proj_raw_root(project):
     return os.path.join(RAW_ROOT, project)
 
 
-@locked(LOCK_PREFS)
+def get_prefs_cache():
+    global g_prefs
+
+    if g_prefs:
+        return g_prefs
+
+    g_prefs = Prefs(PROTOCOL_MAP, ORGANISM_MAP, CONF_DIR)
+    return g_prefs
+
+
 def get_db(organism, header):
-    return pd.read_csv(ORGANISM_MAP, sep='\t', index_col=0, header=0).to_dict('index')[organism][header]
+    return get_prefs_cache().db(organism, header)
 
 
-@locked(LOCK_PREFS)
 def get_prefs(protocol, header):
-    name = pd.read_csv(PROTOCOL_MAP, sep='\t', index_col=0, header=0).to_dict('index')[protocol][header]
-    return os.path.join(CONF_DIR, name)
+    return get_prefs_cache().prefs(protocol, header)
+
 
 def log(project, str):
-    now = datetime.now().strftime("[%d/%m/%Y  %H:%M:%S]\t")
-    root = get_proj_root(project)
-    fname = os.path.join(root, LOGNAME)
-    mode = "a" if os.path.exists(fname) else "w"
-    with open(fname, mode) as f:
-        f.writelines(now+str)
-        f.writelines('\n')
+    name = LOGNAME
+    if g_node:
+        # Appends from several NFS clients to one file can overwrite each other
+        base, ext = os.path.splitext(LOGNAME)
+        name = f'{base}.{g_node}{ext}'
+    g_logs.write(os.path.join(get_proj_root(project), name), str)
 
 
 def get_sample_raw_path(psample):
@@ -224,161 +400,180 @@ def get_sample_mascot_path(psample):
     return os.path.join(get_proj_root(psample[0]), psample[1]+".dat")
 
 
-def remove_first_line(file_path):
-    with open(file_path, 'r') as f_in:
-        with NamedTemporaryFile(mode='w', delete=False) as f_out:
-            temp_path = f_out.name
-            next(f_in)
-            for line in f_in:
-                f_out.write(line)
-    os.remove(file_path)
-    move(temp_path, file_path)
-
-
 @locked(LOCK_IMPORT)
+@timed('import')
 def run_gimport(args):
-    gdata = get_current_table()
-
-    old_samples = read_list(DB_IMPORTED_FILE, DB_IMPORTED_LOCK)
+    table = get_current_table()
+    diff = get_sheet_sync().take()
+    # Rows are re-checked every run, but only new or edited rows get a status
+    touched = {(r[PROJECT_HEADER], r[SAMPLE_HEADER]) for r in diff.added + diff.changed}
+
+    store = get_job_store()
+    # Priorities apply to every queue of the sample, also to jobs already waiting
+    store.set_priorities([(r[PROJECT_HEADER], r[SAMPLE_HEADER]) + table.priority(r)
+                          for r in diff.added + diff.changed])
+    imported = store.keys(STAGE_IMPORT)
+    rows = [r for r in table.uploaded() if (r[PROJECT_HEADER], r[SAMPLE_HEADER]) not in imported]
+    index = get_raw_index()
+    index.refresh({r[PROJECT_HEADER] for r in rows}, RAW_SCAN_INTERVAL)
+    raw_files = index.files()
     samples = []
-    for k, row in gdata.iterrows():
-        project = row[PROJECT_HEADER]
-        sample = row[SAMPLE_HEADER]
-        protocol = row[PROTOCOL_HEADER]
-        organism = row[ORGANISM_HEADER]
-
-        if os.path.exists(get_sample_raw_path((project, sample, protocol, organism))):
-            samples.append((project, sample, protocol, organism))
-        else:
-            set_status((project, sample, protocol, organism), "No file found: {}".format(
-                get_sample_raw_path((project, sample, protocol, organism))))
-
-
-    # remove  already imported samples
-    samples = list(filter(lambda x: x not in old_samples, samples))
-    append_list(DB_IMPORTED_FILE, samples, DB_IMPORTED_LOCK)
-
-    conv_queue = []
-    conv_old = read_list(DB_CONV_FILE, DB_CONV_LOCK)
-
+    for row in rows:
+        psample = table.psample(row)
+        settled = raw_files.get(psample[:2])
+        if settled:
+            samples.append(psample)
+        elif settled is None and psample[:2] in touched:
+            set_status(psample, "No file found: {}".format(get_sample_raw_path(psample)))
+        # else the file is still being copied
+
+    samples = store.enqueue(STAGE_IMPORT, samples, DONE)
     for project, sample, protocol, organism in samples:
         root = get_proj_root(project)
         if not os.path.exists(root):
             os.mkdir(root)
             log(project, f"Created root for project {project}")
-        if (project, sample, protocol, organism) not in conv_old:
-            conv_queue.append((project, sample, protocol, organism))
-            set_status((project, sample, protocol, organism), "Waiting for the analysis")
-            log(project, f"Sample ID {sample} is waiting for the analysis")
 
-    with ILock(DB_CONV_LOCK):
-        with open(DB_CONV_FILE, "a") as f:
-            for project, sample, protocol, organism in conv_queue:
-                f.writelines(f"{project}\t{sample}\t{protocol}\t{organism}\n")
+    for project, sample, protocol, organism in store.enqueue(STAGE_CONVERT, samples):
+        set_status((project, sample, protocol, organism), "Waiting for the analysis")
+        log(project, f"Sample ID {sample} is waiting for the analysis")
+
+
+def get_convert_gate():
+    global g_convert_gate
+
+    if g_convert_gate:
+        return g_convert_gate
+
+    g_convert_gate = ResourceGate(DATA_ROOT, CONVERT_SLOTS, CONVERT_DISK_RESERVE)
+    return g_convert_gate
 
-    # os.remove(LOCK_IMPORT)
+
+def get_tandem_gate():
+    global g_tandem_gate
+
+    if g_tandem_gate:
+        return g_tandem_gate
+
+    g_tandem_gate = ThreadGate(TANDEM_THREADS)
+    return g_tandem_gate
+
+
+def convert_sample(ps):
+    project = ps[0]
+    rawfile = get_sample_raw_path(ps)
+    log(project, f"Started converting {rawfile}")
+    set_status(ps, 'Converting')
+    stats = convert_file(CONVERSION_CMD, rawfile, get_sample_mgf_path(ps), get_convert_gate(),
+                         lambda line: log(project, line), CONVERT_SIZE_FACTOR)
+    log(project, f'Converted {rawfile} in {stats.seconds:.1f}s, {stats.mbps:.1f} MB/s')
+    spectra = mgf.qc(get_sample_mgf_path(ps))
+    log(project, f"{spectra['spectra']} spectra in {ps[1]}, precursor charges {spectra['charges']}")
+    set_status(ps, 'Converted')
+    store = get_job_store()
+    record_stats(STAGE_CONVERT, ps, stats.seconds, stats.bytes_in, stats.bytes_out, stats.returncode)
+    store.enqueue(STAGE_TANDEM, [ps])
+    store.enqueue(STAGE_MASCOT, [ps])
 
 
 @locked(LOCK_CONVERT)
 def run_conversions(args):
-    l = None
-    with ILock(DB_CONV_LOCK):
-        if os.path.exists(DB_CONV_FILE):
-            with open(DB_CONV_FILE, "r") as f:
-                l = f.readline()
-            if l:
-                remove_first_line(DB_CONV_FILE)
-    if l:
-        project, sample, protocol, organism = map(lambda x: x.strip(), l.split('\t'))
-        ps = (project, sample, protocol, organism)
-        rawfile = get_sample_raw_path(ps)
-        log(project, f"Started converting {rawfile}")
-        set_status(ps, 'Converting')
-        process = subprocess.Popen(CONVERSION_CMD.format(infile = rawfile, outdir = get_proj_root(project)),
-                                                         shell=True, stdout=subprocess.PIPE)
-        process.wait()
-        log(project, f'Converted {rawfile}')
-        set_status(ps, 'Converted')
-        append_list(DB_TANDEM_FILE, [(project, sample, protocol, organism)], DB_TANDEM_LOCK)
-        append_list(DB_MASCOT_FILE, [(project, sample, protocol, organism)], DB_MASCOT_LOCK)
+    with ThreadPoolExecutor(CONVERT_WORKERS) as pool:
+        jobs = [pool.submit(run_stage, STAGE_CONVERT, convert_sample) for i in range(CONVERT_WORKERS)]
+    for job in jobs:
+        job.result()
+
+
+def get_result_cache():
+    global g_results
+
+    if g_results:
+        return g_results
+
+    g_results = ResultCache(get_job_store(), RESULT_CACHE_DIR, RESULT_CACHE_BUDGET)
+    return g_results
+
+
+def tandem_sample(psample):
+    project, sample, protocol, organism = psample
+    confpath = os.path.join(get_proj_root(project), sample+".tconf.xml")
+    mgfpath = get_sample_mgf_path(psample)
+    outpath = get_sample_tandem_path(psample)
+
+    tandem_db = get_db(organism, TANDEM_DB_HEADER)
+    tandem_prefs = get_prefs(protocol, TANDEM_PREFS_HEADER)
+
+    set_status(psample, "Identification (Tandem) running")
+    databases = get_databases()
+    # The taxonomy is written by `msauto databases`, not behind the back of the searches running on it
+    if tandem_db not in databases.listed():
+        raise DatabaseError(f'Database {tandem_db} is not in {TANDEM_TAXONOMY}, run msauto databases')
+    database = databases.prepare(tandem_db)
+    cache = get_result_cache()
+    # By database content, a FASTA updated in place gets searched again. Not by the taxonomy file,
+    # which changes each time a taxon is added
+    key = cache.key('tandem', TANDEM_VERSION, mgfpath, f'{tandem_db}:{database.sha256}', [tandem_prefs])
+    if cache.get(key, '.tandem.xml', outpath, tandem.is_complete):
+        log(project, f"X!Tandem result {key[:12]} found in the cache: {outpath}")
+        returncode, seconds = 0, 0.0
+    else:
+        # The previous result may be a link into the cache, never overwrite it in place
+        if os.path.lexists(outpath):
+            os.unlink(outpath)
+        spectra = len(mgf.load_index(mgfpath))
+        if TANDEM_SHARDS > 1 and spectra >= TANDEM_SHARD_MIN_SPECTRA:
+            log(project, f"Starting X!Tandem on {spectra} spectra in {TANDEM_SHARDS} shards: {mgfpath}")
+            # Named after the cache key, so an interrupted search resumes with the shards it finished
+            seconds = tandem.search_split(TANDEM_CMD, mgfpath, outpath, tandem_prefs, TANDEM_TAXONOMY, tandem_db,
+                                          TANDEM_SHARDS, get_tandem_gate(), lambda line: log(project, line),
+                                          f'{outpath}.{key[:12]}.shards')
+            returncode = 0
+            log(project, f"X!Tandem finished in {seconds:.0f}s")
+        else:
+            partial = outpath + '.part'
+            # As many threads as a shard, from those the other workers leave free
+            with get_tandem_gate().acquire(TANDEM_THREADS // TANDEM_SHARDS) as threads:
+                tandem.write_conf(confpath, tandem_prefs, TANDEM_TAXONOMY, tandem_db, mgfpath, partial, threads)
+                log(project, f"Starting X!Tandem with {threads} threads: "+TANDEM_CMD.format(infile=confpath))
+                returncode, seconds = tandem.search(TANDEM_CMD, confpath, lambda line: log(project, line))
+            log(project, f"X!Tandem finished with {returncode} in {seconds:.0f}s")
+            if returncode != 0:
+                # Retried by claimed(), like a failed shard, conversion or Scaffold run
+                raise RuntimeError(f'X!Tandem failed for {mgfpath} with {returncode}')
+            tandem.finish_output(partial, outpath)
+        cache.put(key, '.tandem.xml', outpath)
+    record_stats(STAGE_TANDEM, psample, seconds, os.path.getsize(mgfpath), os.path.getsize(outpath), returncode)
+    queue_summary(psample)
+    if os.path.exists(get_sample_mascot_path(psample)):
+        amp = 'Mascot&Tandem'
+    else:
+        amp = 'Tandem'
+    set_status(psample, f"Identification ({amp}) finished")
 
 
 @locked(LOCK_TANDEM)
 def run_tandem(args):
-    l = None
-    with ILock(DB_TANDEM_LOCK):
-        if os.path.exists(DB_TANDEM_FILE):
-            with open(DB_TANDEM_FILE, "r") as f:
-                l = f.readline()
-            if l:
-                remove_first_line(DB_TANDEM_FILE)
-    if l:
-        project, sample, protocol, organism = map(lambda x: x.strip(), l.split('\t'))
-        psample = (project, sample, protocol, organism)
-        confpath = os.path.join(get_proj_root(project), sample+".tconf.xml")
-        mgfpath = get_sample_mgf_path(psample)
-
-        tandem_db = get_db(organism, TANDEM_DB_HEADER)
-        tandem_prefs = get_prefs(protocol, TANDEM_PREFS_HEADER)
-
-        tandemconf = tandem_stub.format(defaults_path=tandem_prefs,
-                                        taxonomy_path=TANDEM_TAXONOMY,
-                                        mgf_file=mgfpath,
-                                        output_path=get_sample_tandem_path(psample),
-                                        taxon=tandem_db)
-        with open(confpath, "w") as f:
-            f.writelines(tandemconf)
-        set_status(psample, "Identification (Tandem) running")
-        log(project, "Starting X!Tandem: "+TANDEM_CMD.format(infile=confpath))
-        process = subprocess.Popen(TANDEM_CMD.format(infile=confpath),
-                               shell=True, stdout=subprocess.PIPE)
-        process.wait()
-        log(project, f"X!Tandem finished with {process.returncode}, {process.stdout}")
-        if os.path.exists(get_sample_mascot_path(psample)):
-            amp = 'Mascot&Tandem'
-        else:
-            amp = 'Tandem'
-        set_status(psample, f"Identification ({amp}) finished")
+    run_stage(STAGE_TANDEM, tandem_sample)
 
 
-def get_default_mascot_pars(mascot_defaults):
-    filename = mascot_defaults
-    pars = {}
-    with open(filename, "r") as f:
-        for l in f.readlines():
-            name, par = map(lambda x: x.strip(), l.split("="))
-            pars[name] = par
-    pars['FORMVER'] = '1.01'
-    return pars
+def get_mascot_client():
+    global g_mascot
 
+    if g_mascot:
+        return g_mascot
 
-def mascot_login(mascot_cgi, user, password):
-    postdict={}
-    postdict['username'] = user
-    postdict['password'] = password
-    postdict['action'] = 'login'
-    postdict['savecookie'] = '1'
+    from mascot import MascotClient
 
-    session = requests.Session()
-    response = session.post(MASCOT_CGI+'/login.pl', data=postdict)
+    g_mascot = MascotClient(MASCOT_CGI, MASCOT_USER, MASCOT_PASSWORD, MASCOT_CONCURRENCY, MASCOT_POLL_TIME,
+                            upload_gzip=MASCOT_UPLOAD_GZIP, max_wait=MASCOT_MAX_WAIT)
+    g_mascot.session.hooks['response'].append(requests_hook(get_metrics(), 'mascot'))
+    return g_mascot
 
-    return session
 
+def mascot_sample(psample):
+    from mascot import get_default_mascot_pars, pop_peak_filter, dat_complete
 
-@locked(LOCK_MASCOT)
-def run_mascot(args):
-    l = None
-    with ILock(DB_MASCOT_LOCK):
-        if os.path.exists(DB_MASCOT_FILE):
-            with open(DB_MASCOT_FILE, "r") as f:
-                l = f.readline()
-            if l:
-                remove_first_line(DB_MASCOT_FILE)
-    if not l:
-        return
-
-    project, sample, protocol, organism = map(lambda x: x.strip(), l.split('\t'))
-    psample = (project, sample, protocol, organism)
+    project, sample, protocol, organism = psample
     mgfpath = get_sample_mgf_path(psample)
     datpath = get_sample_mascot_path(psample)
     set_status(psample, "Identification (Mascot) running")
@@ -386,117 +581,443 @@ def run_mascot(args):
     mascot_prefs = get_prefs(protocol, MASCOT_PREFS_HEADER)
     pars = get_default_mascot_pars(mascot_prefs)
 
+    min_intensity, top_n = pop_peak_filter(pars)
+
     pars['DB'] = mascot_db
     pars['COM'] = 'msauto_prot1: '+'/'.join(psample)
 
-
-    session = mascot_login(MASCOT_CGI, 'mascotadmin', 'R251260z')
-    if session:
-        log(project, f"Logged in {MASCOT_CGI}")
-
-    pars1 = {}
-    # pars1['MASCOT_SESSION'] = cookies['MASCOT_SESSION']
-    # pars1['MASCOT_USERID'] = cookies['MASCOT_USERID']
-    # pars1['MASCOT_USERNAME'] = cookies['MASCOT_USERNAME']
-    sendurl = MASCOT_CGI + '/nph-mascot.exe?1'
-    with open(mgfpath, 'rb') as f:
-        response = session.post(sendurl, files={'FILE':f}, data=pars)
-    log(project, "Mascot response was: " + response.content.decode())
-    if response.ok:
-        error_result = re.match('Sorry, your search could not be performed', response.content.decode())
-        if error_result:
-            log('Search failed')
-        #http://mascot.ripcm.com/mascot/cgi/master_results_2.pl?file=../data/20210420/F052415.dat
-        match = re.search(r'master_results_2\.pl\?file=.*data/(?P<date>\d+)/(?P<file>F\d+\.dat)',
-                          response.content.decode())
-        date, file = match.group('date'), match.group('file')
-
-        mascot_xcgi = MASCOT_CGI.replace('cgi', 'x-cgi')
-        get_url = mascot_xcgi + f'/ms-status.exe?Autorefresh=false&Show=RESULTFILE&DateDir={date}&ResJob={file}'
-        log(project, f'Downloading file {get_url}')
-
-        with session.get(get_url, stream=True) as r:
-            r.raise_for_status()
-            with open(datpath, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        log(project, 'Downloaded')
-        if os.path.exists(get_sample_tandem_path(psample)):
-            amp = 'Mascot&Tandem'
-        else:
-            amp = 'Mascot'
-        set_status(psample, f'Identification ({amp}) finished')
-
+    cache = get_result_cache()
+    key = cache.key('mascot', MASCOT_VERSION, mgfpath, mascot_db, [mascot_prefs])
+    if cache.get(key, '.dat', datpath, dat_complete):
+        log(project, f"Mascot result {key[:12]} found in the cache: {datpath}")
+        record_stats(STAGE_MASCOT, psample, 0.0, 0, os.path.getsize(datpath))
+    else:
+        store = get_job_store()
+        # A search submitted before an interruption is picked up again instead of uploading anew
+        submitted = store.checkpoints(STAGE_MASCOT, psample).get('search')
+        resume = submitted[1:] if submitted and submitted[0] == key else None
+        client = get_mascot_client()
+        start = datetime.now()
+        try:
+            result = client.run(client.search(mgfpath, pars, datpath, lambda line: log(project, line),
+                                              min_intensity, top_n, resume,
+                                              lambda date, file: store.checkpoint(STAGE_MASCOT, psample, 'search',
+                                                                                  [key, date, file])))
+        except Exception:
+            if resume:
+                # The server may have dropped the search, the retry submits it again
+                store.clear_checkpoints(STAGE_MASCOT, psample)
+            raise
+        seconds = (datetime.now() - start).total_seconds()
+        cache.put(key, '.dat', datpath)
+        record_stats(STAGE_MASCOT_UPLOAD, psample, result.upload_seconds, os.path.getsize(mgfpath),
+                     result.bytes_sent)
+        record_stats(STAGE_MASCOT, psample, seconds, result.bytes_sent, result.dat_bytes)
+    queue_summary(psample)
+    if os.path.exists(get_sample_tandem_path(psample)):
+        amp = 'Mascot&Tandem'
     else:
-        log(project, "Bad response")
+        amp = 'Mascot'
+    set_status(psample, f'Identification ({amp}) finished')
 
 
-@locked(LOCK_SCAFFOLD)
-def run_scaffold(args):
+@locked(LOCK_MASCOT)
+def run_mascot(args):
+    with ThreadPoolExecutor(MASCOT_CONCURRENCY) as pool:
+        jobs = [pool.submit(run_stage, STAGE_MASCOT, mascot_sample) for i in range(MASCOT_CONCURRENCY)]
+    for job in jobs:
+        job.result()
 
-    def make_scafml(templatefile, resultfile, data):
-        with open(templatefile) as tf:
-            template = jinja2.Template(tf.read())
-        with open(resultfile, "w") as fo:
-            fo.write(template.render(data))
 
-    def check_ready(psample):
-        return os.path.exists(get_sample_mascot_path(psample)) and\
-               os.path.exists(get_sample_tandem_path(psample))
+def queue_summary(psample):
+    '''Parse the results of the sample again, also when its summary is running on the other engine's result'''
+    store = get_job_store()
+    if not store.enqueue(STAGE_SUMMARY, [psample]):
+        store.requeue(STAGE_SUMMARY, psample)
 
 
-    df = get_current_table(False)
-    projects = df[df[SCAFFOLD_RUN_HEADER]=='RUN'][PROJECT_HEADER]
+def summarize_sample(psample):
+    import results
+    from mascot import dat_complete
 
-    for p in projects:
-        d = df[df[PROJECT_HEADER]==p]
-        psamples = []
-        slist = defaultdict(dict)
-        s_run = None
-        for k, row in d.iterrows():
-            project = row[PROJECT_HEADER]
-            sample = row[SAMPLE_HEADER]
-            protocol = row[PROTOCOL_HEADER]
-            organism = row[ORGANISM_HEADER]
-            scafsample = row[SCAFFOLD_SAMPLE_HEADER]
-            psample = (project, sample, protocol, organism, scafsample)
-            psamples.append(psample)
-            if row[SCAFFOLD_RUN_HEADER] == 'RUN':
-                s_run = psample
-            scat = tuple(scafsample.split('/'))
-            scat = scat if len(scat) == 2 else (scat,"default")
-            slist[scat]['name']=scat[0]
-            slist[scat]['category']=scat[1]
-            slist[scat]['files'] = slist[scat].get('files', [])+[get_sample_mascot_path(psample)]
-            slist[scat]['files'] = slist[scat].get('files', [])+[get_sample_tandem_path(psample)]
-        if not all(map(check_ready, psamples)):
+    project, sample, protocol, organism = psample
+    start = time.time()
+    bytes_in = 0
+    for path, engine, complete in ((get_sample_tandem_path(psample), 'tandem', tandem.is_complete),
+                                   (get_sample_mascot_path(psample), 'mascot', dat_complete)):
+        if not complete(path):
             continue
+        table = results.summarize(path, engine)
+        bytes_in += os.path.getsize(path)
+        log(project, f"{engine} PSMs of {sample}: {table}")
+    if aggregate_due(project):
+        summary, proteins = results.aggregate(get_proj_root(project), project, SUMMARY_EXPECT_THRESHOLD)
+        if summary:
+            log(project, f"Project summary updated: {summary}, {proteins}")
+    record_stats(STAGE_SUMMARY, psample, time.time() - start, bytes_in)
+
+
+def aggregate_due(project):
+    '''True when all the summaries of the project are done, or its tables are SUMMARY_AGGREGATE_INTERVAL old'''
+    import results
+
+    store = get_job_store()
+    # Running summaries do not count, two finishing together would each leave it to the other
+    if not (store.pending(project, (STAGE_CONVERT, STAGE_TANDEM, STAGE_MASCOT))
+            or store.pending(project, (STAGE_SUMMARY,), (QUEUED,))):
+        return True
+    path = results.table_path(os.path.join(get_proj_root(project), f'{project}_summary'))
+    return path is None or time.time() - os.path.getmtime(path) >= SUMMARY_AGGREGATE_INTERVAL
+
+
+@locked(LOCK_SUMMARY)
+def run_summaries(args):
+    with ThreadPoolExecutor(SUMMARY_WORKERS) as pool:
+        jobs = [pool.submit(run_stage, STAGE_SUMMARY, summarize_sample) for i in range(SUMMARY_WORKERS)]
+    for job in jobs:
+        job.result()
+
+
+def get_readiness():
+    global g_readiness
+
+    if g_readiness:
+        return g_readiness
+
+    g_readiness = ReadinessTracker(get_job_store(), finished=search_finished)
+    return g_readiness
+
+
+def search_finished(stage, project, sample):
+    '''True when the result of a search run without a job, before the job store, is there and whole'''
+    psample = (project, sample, None, None)
+    if stage == STAGE_TANDEM:
+        return tandem.is_complete(get_sample_tandem_path(psample))
+    from mascot import dat_complete
+    return dat_complete(get_sample_mascot_path(psample))
+
+
+@timed('scaffold-watch')
+def watch_scaffold(args):
+    '''Track the projects set to RUN, those with all searches done get a Scaffold job'''
+    table = get_current_table()
+    table.require(SCAFFOLD_SAMPLE_HEADER, SCAFFOLD_RUN_HEADER)
+    tracker = get_readiness()
+    projects = table.projects(SCAFFOLD_RUN_HEADER, 'RUN')
+    for p in projects:
+        rows = table.project_rows(p)
+        run_row = next(r for r in rows if r[SCAFFOLD_RUN_HEADER] == 'RUN')
+        if tracker.watch(table.psample(run_row), [(r[SAMPLE_HEADER], r[SCAFFOLD_SAMPLE_HEADER]) for r in rows]):
+            log(p, f"All searches of project {p} are done, queued for Scaffold")
+    tracker.unwatch(set(projects))
+
+
+def scaffold_project(psample):
+    import jinja2
+
+    project, run_sample, protocol, organism = psample
+    slist = defaultdict(dict)
+    for sample, scafsample in get_readiness().samples(project):
+        spsample = (project, sample, protocol, organism)
+        scat = tuple(scafsample.split('/'))
+        scat = scat if len(scat) == 2 else (scat,"default")
+        slist[scat]['name']=scat[0]
+        slist[scat]['category']=scat[1]
+        slist[scat]['files'] = slist[scat].get('files', [])+[get_sample_mascot_path(spsample)]
+        slist[scat]['files'] = slist[scat].get('files', [])+[get_sample_tandem_path(spsample)]
+
+    fasta = get_databases().checked(get_db(organism, MASCOT_DB_HEADER)).path
+    stemplate = get_prefs(protocol, POSTPROC_PREFS_HEADER)+"_scaffold_template.scafml"
+    scafml = os.path.join(get_proj_root(project), project+"_scaffold.scafml")
+    with open(stemplate) as tf:
+        template = jinja2.Template(tf.read())
+    with atomic_open(scafml) as fo:
+        fo.write(template.render({'name': project, 'fasta': fasta, 'output': get_proj_root(project)+'/',
+                                  'samples': slist.values()}))
+
+    set_status(psample, "Running Scaffold")
+    log(project, f'Running Scaffold for {scafml}')
+    limit = memory_limit(SCAFFOLD_MEMORY_CAP)
+    start = time.time()
+    returncode = run_logged(SCAFFOLD_CMD.format(infile=scafml), lambda line: log(project, line), preexec_fn=limit)
+    log(project, f"Scaffold finished with {returncode}")
+    record_stats(STAGE_SCAFFOLD, psample, time.time() - start, returncode=returncode)
+    if returncode != 0:
+        raise RuntimeError(f'Scaffold failed for {scafml} with {returncode}')
+
+    set_status(psample, "Running postprocessing")
+    script = get_prefs(protocol, POSTPROC_PREFS_HEADER)+".R"
+    wd = get_proj_root(project)
+    returncode = run_logged(POSTPROC_CMD.format(script=script, wd=wd, projname=project),
+                            lambda line: log(project, line), preexec_fn=limit)
+    log(project, f"Postproc finished with {returncode}")
+    if returncode != 0:
+        raise RuntimeError(f'Postprocessing failed for {project} with {returncode}')
+    set_status(psample, "All done")
+    set_status(psample, "OK", SCAFFOLD_RUN_HEADER)
+    # Written now, so the next check does not see the project as RUN anymore
+    get_status_writer().flush()
 
-        fasta = os.path.join("/home/msauto/fasta", get_db(organism, MASCOT_DB_HEADER)+'.fasta')
-        stemplate = get_prefs(protocol, POSTPROC_PREFS_HEADER)+"_scaffold_template.scafml"
-        scafml = os.path.join(get_proj_root(p), p+"_scaffold.scafml")
-        make_scafml(stemplate,
-                    scafml,
-                    {'name': p, 'fasta': fasta, 'output':get_proj_root(p)+'/', 'samples':slist.values()})
-        log(p, f'Running Scaffold for {scafml}')
-        process = subprocess.Popen(SCAFFOLD_CMD.format(infile=scafml,
-                                   shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).split())
-        process.wait()
-        log(project, f"Scaffold finished with {process.returncode}, {process.stdout}, {process.stderr}")
-        set_status(psample, "Running postprocessing")
-        script = get_prefs(protocol, POSTPROC_PREFS_HEADER)+".R"
-        wd = get_proj_root(project)
-        process = subprocess.Popen(POSTPROC_CMD.format(script=script, wd = wd, projname=project,
-                                                       shell=True, stdout=subprocess.PIPE,
-                                                       stderr=subprocess.PIPE).split())
-        process.wait()
-        log(project, f"Postproc finished with {process.returncode}, {process.stdout}, {process.stderr}")
-        set_status(psample, "All done")
 
+@locked(LOCK_SCAFFOLD)
+def run_scaffold(args):
+    watch_scaffold(args)
+    with ThreadPoolExecutor(SCAFFOLD_WORKERS) as pool:
+        jobs = [pool.submit(run_stage, STAGE_SCAFFOLD, scaffold_project) for i in range(SCAFFOLD_WORKERS)]
+    for job in jobs:
+        job.result()
 
 
+def stage_outputs(stage, psample):
+    '''[(path, is_complete)] written by a job of the stage'''
+    from mascot import dat_complete
 
-        set_status(psample, "OK", SCAFFOLD_RUN_HEADER)
+    return {STAGE_CONVERT: [(get_sample_mgf_path(psample), mgf.is_complete)],
+            STAGE_TANDEM: [(get_sample_tandem_path(psample), tandem.is_complete)],
+            STAGE_MASCOT: [(get_sample_mascot_path(psample), dat_complete)]}.get(stage, [])
+
+
+def recover_leases():
+    '''Queue again the jobs of workers that died, returns them'''
+    jobs = get_job_store().recover()
+    for job in jobs:
+        if job.state == QUEUED:
+            log(job.project, f"{job.stage} of {job.sample} was interrupted, queued again")
+            set_status(job.psample, f"Interrupted ({job.stage}), queued again")
+        else:
+            log(job.project, f"{job.stage} of {job.sample} was interrupted, failed after {job.attempts} attempts")
+            set_status(job.psample, f"Failed ({job.stage}) after {job.attempts} interrupted attempts")
+    return jobs
+
+
+def recover_outputs(since):
+    '''Queue again the jobs done since the given time whose output was cut off by a crash.
+
+    Outputs are renamed into place once written, so a missing one was deleted on purpose (e.g. an MGF
+    removed to free space once searched) and is left alone. The jobs running at the crash are queued
+    again by recover_leases().
+    '''
+    store = get_job_store()
+    requeued = []
+    for stage in (STAGE_CONVERT, STAGE_TANDEM, STAGE_MASCOT):
+        for job in store.finished(stage, since):
+            broken = [path for path, complete in stage_outputs(stage, job.psample)
+                      if os.path.exists(path) and not complete(path)]
+            if not broken:
+                continue
+            for path in broken:
+                os.unlink(path)
+            log(job.project, f"{', '.join(broken)} incomplete, {stage} of {job.sample} queued again")
+            set_status(job.psample, f"Incomplete {stage} output, queued again")
+            store.requeue(stage, job.psample)
+            job.state = QUEUED
+            if stage == STAGE_CONVERT:
+                # The searches are queued again once the MGF is rewritten
+                store.remove(STAGE_TANDEM, [job.psample])
+                store.remove(STAGE_MASCOT, [job.psample])
+            requeued.append(job)
+    return requeued
+
+
+def remove_stale_files(projects):
+    '''Temporary files of conversions, searches and writes that never finished'''
+    store = get_job_store()
+    busy = {project for stage in (STAGE_CONVERT, STAGE_TANDEM, STAGE_MASCOT, STAGE_SCAFFOLD, STAGE_SUMMARY)
+            for project, sample in store.keys(stage, RUNNING)}
+    searched = store.keys(STAGE_TANDEM, DONE)
+    for project in set(projects) - busy:
+        root = get_proj_root(project)
+        if not os.path.isdir(root):
+            continue
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            # Files of work that started after this pass looked at the queue are recent
+            if time.time() - os.path.getmtime(path) < JOB_LEASE:
+                continue
+            if name.startswith(('.convert-', '.tandem-')):
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.endswith('.shards') and (project, name.rsplit('.tandem.xml.', 1)[0]) in searched:
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.endswith('.tmp'):
+                os.unlink(path)
+
+
+def recover(since=None):
+    '''Startup pass: jobs of dead workers, outputs cut off by a crash and their temporary files'''
+    jobs = recover_leases()
+    jobs += recover_outputs(time.time() - RECOVERY_WINDOW if since is None else since)
+    remove_stale_files({job.project for job in jobs})
+    return jobs
+
+
+def run_recover(args):
+    for job in recover(time.time() - args.window if args.window is not None else None):
+        print(f"{job.stage}\t{job.project}\t{job.sample}\t{job.state}")
+
+
+def build_supervisor(args, workers, leader=None):
+    '''Supervisor with a worker pool per stage and the periodic import, scaffold and metrics tasks.
+
+    With a leader (cluster.Leadership) import and the Run_scaffold checks only
+    run while this node holds the lead, and raw files are found by the scans
+    of import as inotify does not see writes of other NFS clients.
+    '''
+    supervisor = Supervisor(POOL_TIME)
+    for stage, func in ((STAGE_CONVERT, convert_sample),
+                        (STAGE_TANDEM, tandem_sample),
+                        (STAGE_MASCOT, mascot_sample),
+                        (STAGE_SCAFFOLD, scaffold_project),
+                        (STAGE_SUMMARY, summarize_sample)):
+        if workers.get(stage):
+            supervisor.pool(stage, workers[stage], functools.partial(run_stage, stage, func))
+
+    def leading(task):
+        return lambda worker: task() if leader is None or leader.lead() else None
+
+    if leader is None:
+        supervisor.thread('raw-watcher', lambda stopping: get_raw_index().watch(stopping, RAW_SCAN_INTERVAL))
+    else:
+        supervisor.every('leader', NODE_TTL / 3, lambda worker: leader.lead())
+    supervisor.every('import', DAEMON_IMPORT_INTERVAL, leading(lambda: run_gimport(args)))
+    supervisor.every('scaffold-watch', DAEMON_SCAFFOLD_INTERVAL, leading(lambda: watch_scaffold(args)))
+    if workers.get(STAGE_TANDEM):
+        supervisor.every('databases', DAEMON_DATABASE_INTERVAL, lambda worker: warm_databases())
+    supervisor.every('metrics', METRICS_INTERVAL, lambda worker: export_metrics(args.subparser))
+    supervisor.every('recover', JOB_LEASE, lambda worker: recover_leases())
+    return supervisor
+
+
+def run_daemon(args):
+    problems = get_prefs_cache().validate()
+    if problems:
+        raise SystemExit('\n'.join(problems))
+
+    workers = dict(DAEMON_WORKERS)
+    for stage in workers:
+        if getattr(args, stage) is not None:
+            workers[stage] = getattr(args, stage)
+
+    recover()
+    supervisor = build_supervisor(args, workers)
+    if METRICS_PORT:
+        get_metrics().serve(METRICS_PORT)
+    supervisor.run()
+
+
+def stage_commands():
+    '''{stage: [commands it runs]}, Mascot only needs the network and the summaries pandas'''
+    return {STAGE_CONVERT: [CONVERSION_CMD], STAGE_TANDEM: [TANDEM_CMD], STAGE_MASCOT: [],
+            STAGE_SCAFFOLD: [SCAFFOLD_CMD, POSTPROC_CMD], STAGE_SUMMARY: []}
+
+
+def run_worker(args):
+    '''One node of a cluster: registers its stages and runs them until stopped'''
+    global g_node
+
+    if not CLUSTER_MODE:
+        raise SystemExit('Set CLUSTER_MODE = True and a shared DB_JOBS_FILE in config.py on every node')
+    problems = get_prefs_cache().validate()
+    if problems:
+        raise SystemExit('\n'.join(problems))
+
+    g_node = args.node or NODE_NAME
+    stages = args.stages.split(',') if args.stages else detect_stages(stage_commands())
+    cores = os.cpu_count() or 1
+    workers = {stage: DAEMON_WORKERS[stage] for stage in stages}
+    for stage in workers:
+        if getattr(args, stage) is not None:
+            workers[stage] = getattr(args, stage)
+    # Metrics of each node go to their own file
+    args.subparser = f'worker-{g_node}'
+
+    nodes = get_nodes()
+    nodes.register(g_node, [stage for stage, n in workers.items() if n], cores)
+    print(f"Node {g_node}: {', '.join(f'{stage} x{n}' for stage, n in workers.items()) or 'no stages'}")
+    leader = Leadership(os.path.join(CLUSTER_DIR, 'leader.lock'), NODE_TTL)
+    recover()
+    supervisor = build_supervisor(args, workers, leader)
+    supervisor.every('node', NODE_TTL / 3, lambda worker: nodes.heartbeat(g_node))
+    if METRICS_PORT:
+        get_metrics().serve(METRICS_PORT)
+    try:
+        supervisor.run()
+    finally:
+        leader.resign()
+        nodes.unregister(g_node)
+
+
+def run_nodes(args):
+    running = defaultdict(int)
+    with get_job_store().read() as db:
+        workers = db.execute('SELECT worker FROM jobs WHERE state = ?', (RUNNING,)).fetchall()
+    for worker, in workers:
+        if worker:
+            running[':'.join(worker.split(':')[:2])] += 1
+    print(f"{'node':>16} {'host':>16} {'pid':>7} {'cores':>5} {'running':>7} {'seen':>8}  stages")
+    for node in get_nodes().nodes(NODE_TTL):
+        seen = f"{time.time() - node['seen']:.0f}s" + ('' if node['alive'] else '!')
+        jobs = running[f"{node['host']}:{node['pid']}"]
+        print(f"{node['name']:>16} {node['host']:>16} {node['pid']:>7} {node['cores']:>5} {jobs:>7} {seen:>8}  "
+              f"{','.join(node['stages'])}")
+
+
+def run_check_prefs(args):
+    problems = get_prefs_cache().validate()
+    if not problems:
+        problems = database_problems()
+    for problem in problems:
+        print(problem)
+    if problems:
+        raise SystemExit(1)
+
+
+def run_databases(args):
+    '''Write the taxonomy file and list the databases of the organism map with their checks'''
+    databases = get_databases()
+    if databases.write_taxonomy(tandem_dbs()):
+        print(f"{TANDEM_TAXONOMY}: taxa added")
+    searched = tandem_dbs()
+    names = searched | {row[MASCOT_DB_HEADER] for row in get_prefs_cache().organisms.get().values()
+                        if row[MASCOT_DB_HEADER]}
+    failed = False
+    print(f"{'database':>24} {'proteins':>9} {'decoys':>9} {'MB':>8} {'sha256':>12}  problem")
+    for name in sorted(names):
+        info = databases.verify(name)
+        if args.warm and name in searched and not info.problem:
+            info = databases.prepare(name)
+        failed = failed or bool(info.problem)
+        print(f"{name:>24} {info.proteins:>9} {info.decoys:>9} {info.size / 2**20:>8.1f} {info.sha256[:12]:>12}  "
+              f"{info.problem or ''}")
+    if failed:
+        raise SystemExit(1)
+
+
+def run_bench_startup(args):
+    '''Import time of msauto plus the deferred imports of every subcommand, each in a fresh interpreter'''
+    root = os.path.dirname(os.path.abspath(__file__))
+    eager = sorted(set(m for modules in SUBCOMMAND_IMPORTS.values() for m in modules))
+    cases = [('(msauto only)', ())] + sorted(SUBCOMMAND_IMPORTS.items()) + [('(everything eager)', eager)]
+    print(f"{'subcommand':>20} {'imports':>10} {'process':>10}")
+    for name, modules in cases:
+        code = ('import time; start = time.perf_counter(); import msauto; '
+                + ''.join(f'import {m}; ' for m in modules)
+                + 'print(time.perf_counter() - start)')
+        imports, wall = [], []
+        for i in range(args.repeat):
+            start = time.perf_counter()
+            out = subprocess.run([sys.executable, '-c', code], cwd=root, stdout=subprocess.PIPE, check=True)
+            wall.append(time.perf_counter() - start)
+            imports.append(float(out.stdout))
+        print(f"{name:>20} {sorted(imports)[len(imports) // 2]:>9.3f}s {sorted(wall)[len(wall) // 2]:>9.3f}s")
+
+
+def run_migrate(args):
+    migrated = migrate_lists(get_job_store(), [(DB_IMPORTED_FILE, STAGE_IMPORT, DONE),
+                                               (DB_CONV_FILE, STAGE_CONVERT, QUEUED),
+                                               (DB_TANDEM_FILE, STAGE_TANDEM, QUEUED),
+                                               (DB_MASCOT_FILE, STAGE_MASCOT, QUEUED)])
+    for filename, n in migrated.items():
+        print(f"{filename}: {n} jobs migrated")
 
 
 if __name__ == '__main__':
@@ -521,8 +1042,54 @@ if __name__ == '__main__':
     scaffold_parser = subparsers.add_parser('scaffold')
     scaffold_parser.set_defaults(func=run_scaffold)
 
+    summary_parser = subparsers.add_parser('summary', help='parse the search results into PSM tables')
+    summary_parser.set_defaults(func=run_summaries)
+
+    daemon_parser = subparsers.add_parser('daemon')
+    for stage in DAEMON_WORKERS:
+        daemon_parser.add_argument(f'--{stage}', type=int, help=f'number of {stage} workers')
+    daemon_parser.set_defaults(func=run_daemon)
+
+    check_prefs_parser = subparsers.add_parser('check-prefs')
+    check_prefs_parser.set_defaults(func=run_check_prefs)
+
+    bench_startup_parser = subparsers.add_parser('bench-startup')
+    bench_startup_parser.add_argument('--repeat', type=int, default=5)
+    bench_startup_parser.set_defaults(func=run_bench_startup)
+
+    worker_parser = subparsers.add_parser('worker', help='one node of a cluster sharing the job store')
+    worker_parser.add_argument('--node', help=f'node name (default {NODE_NAME})')
+    worker_parser.add_argument('--stages', help='comma-separated stages to run (default: those whose commands '
+                                                'are installed)')
+    for stage in DAEMON_WORKERS:
+        worker_parser.add_argument(f'--{stage}', type=int, help=f'number of {stage} workers')
+    worker_parser.set_defaults(func=run_worker)
+
+    databases_parser = subparsers.add_parser('databases', help='write the taxonomy file and check the FASTA files')
+    databases_parser.add_argument('--warm', action='store_true', help='also read the Tandem databases into memory')
+    databases_parser.set_defaults(func=run_databases)
+
+    nodes_parser = subparsers.add_parser('nodes', help='list the nodes of the cluster')
+    nodes_parser.set_defaults(func=run_nodes)
+
+    recover_parser = subparsers.add_parser('recover', help='queue again the jobs interrupted by a crash')
+    recover_parser.add_argument('--window', type=float,
+                                help=f'check the outputs of jobs done within this many seconds '
+                                     f'(default {RECOVERY_WINDOW})')
+    recover_parser.set_defaults(func=run_recover)
+
+    migrate_parser = subparsers.add_parser('migrate')
+    migrate_parser.set_defaults(func=run_migrate)
+
     args = parser.parse_args()
-    args.func(args)
+    try:
+        args.func(args)
+    finally:
+        flush_status()
+        if g_metrics:
+            export_metrics(args.subparser)
+            g_metrics.close()
+        g_logs.close()
 
 
 
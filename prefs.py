@@ -0,0 +1,91 @@
+'''Protocol and organism maps, loaded once per process and reloaded when the files change'''
+import csv
+import os
+import threading
+
+TANDEM_DB_HEADER = 'Tandem_db'
+MASCOT_DB_HEADER = 'Mascot_db'
+TANDEM_PREFS_HEADER = 'Tandem_prefs'
+MASCOT_PREFS_HEADER = 'Mascot_prefs'
+POSTPROC_PREFS_HEADER = 'Postproc_prefs'
+
+# Postproc_prefs names a prefix shared by the Scaffold template and the R script
+POSTPROC_SUFFIXES = ('_scaffold_template.scafml', '.R')
+
+
+class MapFile:
+    '''Tab separated map file as {first column: {header: value}}, reread when mtime or size change'''
+
+    def __init__(self, path):
+        self.path = path
+        self.signature = None
+        self.rows = {}
+        self.columns = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        st = os.stat(self.path)
+        signature = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if signature != self.signature:
+                with open(self.path, newline='') as f:
+                    reader = csv.reader(f, delimiter='\t')
+                    header = next(reader, [])
+                    self.columns = header[1:]
+                    self.rows = {row[0]: dict(zip(self.columns, row[1:] + [''] * len(self.columns)))
+                                 for row in reader if row}
+                self.signature = signature
+            return self.rows
+
+
+class Prefs:
+    '''Typed lookups into the protocol and organism maps'''
+
+    def __init__(self, protocol_map, organism_map, conf_dir):
+        self.protocols = MapFile(protocol_map)
+        self.organisms = MapFile(organism_map)
+        self.conf_dir = conf_dir
+
+    def db(self, organism, header):
+        return self.organisms.get()[organism][header]
+
+    def prefs(self, protocol, header):
+        return os.path.join(self.conf_dir, self.protocols.get()[protocol][header])
+
+    def tandem_db(self, organism):
+        return self.db(organism, TANDEM_DB_HEADER)
+
+    def mascot_db(self, organism):
+        return self.db(organism, MASCOT_DB_HEADER)
+
+    def tandem_prefs(self, protocol):
+        return self.prefs(protocol, TANDEM_PREFS_HEADER)
+
+    def mascot_prefs(self, protocol):
+        return self.prefs(protocol, MASCOT_PREFS_HEADER)
+
+    def postproc_prefs(self, protocol):
+        return self.prefs(protocol, POSTPROC_PREFS_HEADER)
+
+    def validate(self):
+        '''List of problems: missing map columns or prefs files referenced by the protocol map'''
+        problems = []
+        for mapfile, headers in ((self.protocols, (TANDEM_PREFS_HEADER, MASCOT_PREFS_HEADER, POSTPROC_PREFS_HEADER)),
+                                 (self.organisms, (TANDEM_DB_HEADER, MASCOT_DB_HEADER))):
+            try:
+                mapfile.get()
+            except OSError as e:
+                problems.append(f'Cannot read {mapfile.path}: {e}')
+                continue
+            missing = [h for h in headers if h not in mapfile.columns]
+            if missing:
+                problems.append(f'{mapfile.path} has no columns {missing}')
+        if problems:
+            return problems
+        for protocol, row in self.protocols.get().items():
+            paths = [self.prefs(protocol, TANDEM_PREFS_HEADER), self.prefs(protocol, MASCOT_PREFS_HEADER)]
+            paths += [self.prefs(protocol, POSTPROC_PREFS_HEADER) + s for s in POSTPROC_SUFFIXES]
+            for path in paths:
+                if not os.path.isfile(path):
+                    problems.append(f'Protocol {protocol}: {path} does not exist')
+        return problems
@@ -0,0 +1,109 @@
+'''Finished searches per project, for the projects waiting to run through Scaffold'''
+import json
+
+from jobstore import *
+
+READY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scaffold_projects (
+    project TEXT PRIMARY KEY,
+    sample TEXT NOT NULL,
+    protocol TEXT NOT NULL,
+    organism TEXT NOT NULL,
+    samples TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    queued INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+
+class ReadinessTracker:
+    '''Queues a Scaffold job for a project once every search of its samples is done.
+
+    watch() registers a project with its Run_scaffold = RUN row and the
+    [(sample, scaffold sample)] pairs to combine. search_done() is called as
+    search jobs finish and recounts the finished searches of that project
+    only, so a project is queued as soon as its last search lands instead of
+    on the next periodic check.
+
+    A sample without a job of a stage, searched before the job store (the
+    migrated lists bring no search jobs), counts as done when
+    finished(stage, project, sample) finds its result.
+    '''
+
+    def __init__(self, store, stages=(STAGE_TANDEM, STAGE_MASCOT), finished=None):
+        self.store = store
+        self.stages = tuple(stages)
+        self.finished = finished
+        self.store.create(READY_SCHEMA)
+
+    def watch(self, psample, samples):
+        '''Track the project of the RUN row psample, returns True when this call queued its Scaffold job'''
+        project, sample, protocol, organism = psample
+        samples = json.dumps([list(s) for s in samples])
+        with self.store.transaction() as db:
+            row = db.execute('SELECT sample, samples FROM scaffold_projects WHERE project = ?', (project,)).fetchone()
+            if row is None:
+                db.execute('INSERT INTO scaffold_projects (project, sample, protocol, organism, samples)'
+                           ' VALUES (?, ?, ?, ?, ?)', (project, sample, protocol, organism, samples))
+            elif row != (sample, samples):
+                db.execute('UPDATE scaffold_projects SET sample = ?, protocol = ?, organism = ?, samples = ?'
+                           ' WHERE project = ?', (sample, protocol, organism, samples, project))
+            return self._check(db, project)
+
+    def unwatch(self, keep):
+        '''Stop tracking every project not in keep, returns the projects dropped'''
+        with self.store.transaction() as db:
+            dropped = [p for p, in db.execute('SELECT project FROM scaffold_projects') if p not in keep]
+            db.executemany('DELETE FROM scaffold_projects WHERE project = ?', [(p,) for p in dropped])
+        return dropped
+
+    def search_done(self, project):
+        '''Recount the searches of project, returns True when this call queued its Scaffold job'''
+        with self.store.transaction() as db:
+            return self._check(db, project)
+
+    def _check(self, db, project):
+        row = db.execute('SELECT sample, protocol, organism, samples, queued FROM scaffold_projects'
+                         ' WHERE project = ?', (project,)).fetchone()
+        if row is None:
+            return False
+        sample, protocol, organism, samples, queued = row
+        if queued:
+            return False
+        wanted = {s for s, _ in json.loads(samples)}
+        marks = ', '.join('?' * len(self.stages))
+        states = {(s, stage): state for s, stage, state in db.execute(
+            f'SELECT sample, stage, state FROM jobs WHERE project = ? AND stage IN ({marks})',
+            (project,) + self.stages)}
+        done = 0
+        for s in wanted:
+            for stage in self.stages:
+                state = states.get((s, stage))
+                if state == DONE or state is None and self.finished and self.finished(stage, project, s):
+                    done += 1
+        if done < len(wanted) * len(self.stages):
+            db.execute('UPDATE scaffold_projects SET done = ? WHERE project = ?', (done, project))
+            return False
+        now = self.store.clock()
+        cur = db.execute('INSERT OR IGNORE INTO jobs (stage, project, sample, protocol, organism, state,'
+                         ' created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (STAGE_SCAFFOLD, project, sample, protocol, organism, QUEUED, now, now))
+        if not cur.rowcount:
+            # A project set to RUN again is run again
+            db.execute('UPDATE jobs SET state = ?, attempts = 0, error = NULL, protocol = ?, organism = ?,'
+                       ' updated = ? WHERE stage = ? AND project = ? AND sample = ? AND state != ?',
+                       (QUEUED, protocol, organism, now, STAGE_SCAFFOLD, project, sample, RUNNING))
+        db.execute('UPDATE scaffold_projects SET done = ?, queued = 1 WHERE project = ?', (done, project))
+        return True
+
+    def samples(self, project):
+        '''[(sample, scaffold sample)] registered for the project'''
+        with self.store.read() as db:
+            row = db.execute('SELECT samples FROM scaffold_projects WHERE project = ?', (project,)).fetchone()
+        return [tuple(s) for s in json.loads(row[0])] if row else []
+
+    def progress(self):
+        '''{project: (searches done, searches needed)}'''
+        with self.store.read() as db:
+            rows = db.execute('SELECT project, done, samples FROM scaffold_projects').fetchall()
+        return {p: (done, len(json.loads(samples)) * len(self.stages)) for p, done, samples in rows}
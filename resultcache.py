@@ -0,0 +1,151 @@
+'''Content-addressed cache of search results, shared by all projects'''
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+
+CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS result_cache (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS result_cache_used ON result_cache (used);
+'''
+
+
+def file_digest(path, chunk_size=2**20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def copy_file(src, dest):
+    '''Copy with copy_file_range where available, which shares extents (reflink) on btrfs and XFS'''
+    if not hasattr(os, 'copy_file_range'):
+        shutil.copyfile(src, dest)
+        return
+    with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+        left = os.fstat(fin.fileno()).st_size
+        while left > 0:
+            n = os.copy_file_range(fin.fileno(), fout.fileno(), left)
+            if n == 0:
+                break
+            left -= n
+
+
+def link_file(src, dest):
+    '''Hardlink src to dest, copying when linking is not possible. dest is replaced atomically'''
+    # Unique, the same result may be linked by several workers or hosts at once
+    tmp = f'{dest}.{uuid.uuid4().hex[:12]}.link'
+    try:
+        os.link(src, tmp)
+    except OSError:
+        copy_file(src, tmp)
+    os.replace(tmp, dest)
+
+
+class ResultCache:
+    '''Search results stored under <root>/<key[:2]>/<key><suffix>.
+
+    The key is a hash of everything a search result depends on: the engine
+    and its version, the MGF content, the database name and the content of
+    the prefs files. Entries are hardlinked into the project folders, so
+    cached files must never be modified in place: unlink a result before
+    writing a new one. Use times are kept in the job store and the least
+    recently used entries are evicted once the cache exceeds `budget` bytes.
+    '''
+
+    def __init__(self, store, root, budget):
+        self.store = store
+        self.root = root
+        self.budget = budget
+        self._digests = {}
+        self._lock = threading.Lock()
+        self.store.create(CACHE_SCHEMA)
+
+    def digest(self, path):
+        '''sha256 of a file, remembered while its size and mtime stay the same'''
+        st = os.stat(path)
+        signature = (path, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if signature in self._digests:
+                return self._digests[signature]
+        digest = file_digest(path)
+        with self._lock:
+            self._digests[signature] = digest
+        return digest
+
+    def key(self, engine, version, mgfpath, database, prefs_paths):
+        h = hashlib.sha256()
+        for part in [engine, version, self.digest(mgfpath), database] + [self.digest(p) for p in prefs_paths]:
+            h.update(part.encode() + b'\0')
+        return h.hexdigest()
+
+    def path(self, key, suffix):
+        return os.path.join(self.root, key[:2], key + suffix)
+
+    def get(self, key, suffix, dest, check=None):
+        '''Link a cached result to dest, returns False on a miss.
+
+        An entry for which check(path) is false (e.g. cut off by a crash) is
+        dropped and counts as a miss.
+        '''
+        name = key + suffix
+        with self.store.read() as db:
+            row = db.execute('SELECT size FROM result_cache WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return False
+        path = self.path(key, suffix)
+        try:
+            if check is not None and not check(path):
+                os.unlink(path)
+                raise FileNotFoundError(path)
+            link_file(path, dest)
+        except FileNotFoundError:
+            with self.store.transaction() as db:
+                db.execute('DELETE FROM result_cache WHERE name = ?', (name,))
+            return False
+        with self.store.transaction() as db:
+            db.execute('UPDATE result_cache SET used = ? WHERE name = ?', (time.time(), name))
+        return True
+
+    def put(self, key, suffix, src):
+        '''Add the finished result src to the cache'''
+        path = self.path(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        link_file(src, path)
+        with self.store.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO result_cache (name, size, used) VALUES (?, ?, ?)',
+                       (key + suffix, os.path.getsize(path), time.time()))
+        self.evict()
+
+    def size(self):
+        with self.store.read() as db:
+            return db.execute('SELECT COALESCE(SUM(size), 0) FROM result_cache').fetchone()[0]
+
+    def evict(self):
+        '''Remove least recently used entries until the cache fits the budget, returns the bytes freed'''
+        freed = 0
+        excess = self.size() - self.budget
+        if excess <= 0:
+            return freed
+        evicted = []
+        with self.store.transaction() as db:
+            for name, size in db.execute('SELECT name, size FROM result_cache ORDER BY used').fetchall():
+                if freed >= excess:
+                    break
+                db.execute('DELETE FROM result_cache WHERE name = ?', (name,))
+                evicted.append(name)
+                freed += size
+        # Once committed, the job store stays free for the other workers while the files go
+        for name in evicted:
+            try:
+                os.unlink(os.path.join(self.root, name[:2], name))
+            except FileNotFoundError:
+                pass
+        return freed
@@ -0,0 +1,258 @@
+'''Peptide-spectrum matches of Mascot .dat and X!Tandem .tandem.xml files, parsed once into columnar files.
+
+Both result formats are streamed, never read whole: the .dat line by line,
+the tandem XML with iterparse, freeing every spectrum group once read. The
+memory used grows with the number of PSMs kept, not with the file size (the
+.dat names the spectra of its PSMs only in its last sections, so those are
+held until the end). The PSMs of a result go to <result>.psms.parquet next
+to it and the per-project aggregates to <project>_summary.parquet and
+<project>_proteins.parquet. Without pyarrow the same tables are written as
+gzipped TSV (.tsv.gz), which R reads with read.delim().
+'''
+import glob
+import os
+import re
+import urllib.parse
+import uuid
+import xml.etree.ElementTree as ET
+
+import pandas as pd
+
+from databases import DECOY_PREFIXES
+from executor import fsync_replace
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+PSM_COLUMNS = ['engine', 'spectrum', 'title', 'rank', 'charge', 'peptide', 'mods', 'calc_mh', 'delta', 'score',
+               'expect', 'proteins', 'missed', 'decoy']
+PSM_SUFFIX = '.psms'
+# Accepted matches for the counts of the aggregates
+EXPECT_THRESHOLD = 0.01
+PROTON = 1.007276
+
+SECTION_RE = re.compile(r'Content-Type: application/x-Mascot; name="(\w+)"')
+PEPTIDE_KEY_RE = re.compile(r'q(\d+)_p(\d+)$')
+PROTEIN_RE = re.compile(r'"([^"]+)":\d+:\d+:\d+:\d+')
+
+
+def table_suffix():
+    return '.parquet' if pyarrow is not None else '.tsv.gz'
+
+
+def write_table(frame, base):
+    '''Write frame to base + table_suffix() atomically, returns the path'''
+    path = base + table_suffix()
+    tmp = f'{path}.{uuid.uuid4().hex[:12]}.tmp'
+    try:
+        if pyarrow is not None:
+            frame.to_parquet(tmp, index=False, compression='zstd')
+        else:
+            frame.to_csv(tmp, sep='\t', index=False, compression='gzip')
+        fsync_replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    return path
+
+
+def read_table(path):
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_csv(path, sep='\t', compression='gzip', keep_default_na=False)
+
+
+def table_path(base):
+    '''Existing table written by write_table(base), or None'''
+    for suffix in ('.parquet', '.tsv.gz'):
+        if os.path.exists(base + suffix):
+            return base + suffix
+    return None
+
+
+def psms_base(result_path):
+    return result_path + PSM_SUFFIX
+
+
+def is_decoy(accessions):
+    return bool(accessions) and all(a.startswith(DECOY_PREFIXES) or a.endswith(':reversed') for a in accessions)
+
+
+def _accession(label):
+    return label.split()[0] if label else ''
+
+
+def _tandem_psms(group, title):
+    spectrum = int(group.get('id'))
+    charge = int(group.get('z', 0))
+    rows = {}
+    for protein in group.iter('protein'):
+        accession = _accession(protein.get('label'))
+        for domain in protein.iter('domain'):
+            start = int(domain.get('start'))
+            mods = ';'.join(f"{aa.get('type')}{int(aa.get('at')) - start + 1}{float(aa.get('modified')):+.4f}"
+                            for aa in domain.iter('aa'))
+            key = (domain.get('seq'), mods)
+            row = rows.get(key)
+            if row is None:
+                rows[key] = row = dict(engine='tandem', spectrum=spectrum, title=title, rank=1, charge=charge,
+                                       peptide=key[0], mods=mods, calc_mh=float(domain.get('mh')),
+                                       delta=float(domain.get('delta')), score=float(domain.get('hyperscore')),
+                                       expect=float(domain.get('expect')), proteins=[],
+                                       missed=int(domain.get('missed_cleavages', 0)))
+            if accession not in row['proteins']:
+                row['proteins'].append(accession)
+    return rows.values()
+
+
+def iter_tandem(path):
+    '''PSM dicts of a tandem output file, one per spectrum and distinct peptide'''
+    depth = 0
+    group = None
+    title = ''
+    context = ET.iterparse(path, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if elem.tag != 'group' and not (event == 'end' and elem.tag == 'note' and depth > 1):
+            continue
+        if elem.tag == 'note':
+            if elem.get('label') == 'Description':
+                title = (elem.text or '').strip()
+            continue
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                group, title = elem, ''
+            continue
+        depth -= 1
+        if depth == 0:
+            if group.get('type') == 'model':
+                for row in _tandem_psms(group, title):
+                    yield row
+            # Done with the spectrum, drop it from the tree
+            root.clear()
+
+
+def _mascot_mods(modstring, peptide, deltas):
+    mods = []
+    for i, c in enumerate(modstring):
+        if c == '0' or c not in deltas:
+            continue
+        residue = 'n' if i == 0 else 'c' if i == len(modstring) - 1 else peptide[i - 1]
+        mods.append(f'{residue}{i}{deltas[c]:+.4f}')
+    return ';'.join(mods)
+
+
+def iter_mascot(path, max_rank=1):
+    '''PSM dicts of a Mascot .dat file, matches up to max_rank of every query'''
+    section = None
+    deltas, qexp, qmatch, titles = {}, {}, {}, {}
+    rows = []
+    delta_keys = '0123456789ABCDEFGHIJKLMNOPQRSTUVWX'
+    with open(path, errors='replace') as f:
+        for line in f:
+            if line.startswith('Content-Type: application/x-Mascot'):
+                m = SECTION_RE.match(line)
+                section = m.group(1) if m else None
+                continue
+            if '=' not in line:
+                continue
+            key, value = line.rstrip('\r\n').split('=', 1)
+            if section in ('peptides', 'decoy_peptides'):
+                m = PEPTIDE_KEY_RE.match(key)
+                if not m or value == '-1':
+                    continue
+                query, rank = int(m.group(1)), int(m.group(2))
+                if rank > max_rank:
+                    continue
+                data, _, proteins = value.partition(';')
+                fields = data.split(',')
+                accessions = PROTEIN_RE.findall(proteins)
+                score = float(fields[7])
+                rows.append(dict(engine='mascot', spectrum=query, title='', rank=rank, charge=0, peptide=fields[4],
+                                 mods=_mascot_mods(fields[6], fields[4], deltas), calc_mh=float(fields[1]) + PROTON,
+                                 delta=float(fields[2]), score=score, expect=None, proteins=accessions,
+                                 missed=int(fields[0]), decoy=section == 'decoy_peptides'))
+            elif section == 'summary':
+                if key.startswith('qexp'):
+                    mz, _, charge = value.partition(',')
+                    # Mr for queries given as a neutral mass
+                    charge = charge.rstrip('+-')
+                    qexp[int(key[4:])] = int(charge) if charge.isdigit() else 0
+                elif key.startswith('qmatch'):
+                    qmatch[int(key[6:])] = int(value)
+            elif section == 'masses':
+                if key.startswith('delta') and key[5:].isdigit():
+                    deltas[delta_keys[int(key[5:])]] = float(value.split(',')[0])
+            elif section and section.startswith('query') and key == 'title':
+                titles[int(section[5:])] = urllib.parse.unquote(value)
+    for row in rows:
+        query = row['spectrum']
+        row['charge'] = qexp.get(query, 0)
+        row['title'] = titles.get(query, '')
+        # Expect value from the identity threshold, 10 log10(qmatch / 0.05)
+        row['expect'] = max(qmatch.get(query, 1), 1) * 10 ** (-row['score'] / 10)
+        yield row
+
+
+def psm_frame(rows):
+    rows = list(rows)
+    for row in rows:
+        if 'decoy' not in row:
+            row['decoy'] = is_decoy(row['proteins'])
+        row['proteins'] = ';'.join(row['proteins'])
+    return pd.DataFrame(rows, columns=PSM_COLUMNS)
+
+
+def summarize(result_path, engine):
+    '''Parse a search result into its PSM table unless that is newer, returns the table path'''
+    base = psms_base(result_path)
+    existing = table_path(base)
+    if existing and os.path.getmtime(existing) >= os.path.getmtime(result_path):
+        return existing
+    rows = iter_tandem(result_path) if engine == 'tandem' else iter_mascot(result_path)
+    return write_table(psm_frame(rows), base)
+
+
+def _sample_of(path):
+    name = os.path.basename(path)
+    for suffix in ('.tandem.xml', '.dat'):
+        i = name.find(suffix + PSM_SUFFIX)
+        if i >= 0:
+            return name[:i]
+    return name
+
+
+def aggregate(project_root, project, threshold=EXPECT_THRESHOLD):
+    '''Per sample and engine counts, and protein hits, from the PSM tables of a project'''
+    frames = []
+    for path in sorted(glob.glob(os.path.join(glob.escape(project_root), f'*{PSM_SUFFIX}.*'))):
+        if path.endswith(('.parquet', '.tsv.gz')):
+            frame = read_table(path)
+            frame.insert(0, 'sample', _sample_of(path))
+            frames.append(frame)
+    if not frames:
+        return None, None
+    psms = pd.concat(frames, ignore_index=True)
+    psms['accepted'] = (psms['expect'] <= threshold) & ~psms['decoy']
+    by_run = psms.groupby(['sample', 'engine'])
+    summary = pd.DataFrame({
+        'spectra': by_run['spectrum'].nunique(),
+        'psms': by_run.size(),
+        'accepted_psms': by_run['accepted'].sum(),
+        'peptides': psms[psms['accepted']].groupby(['sample', 'engine'])['peptide'].nunique(),
+        'decoy_psms': by_run['decoy'].sum(),
+        'median_score': by_run['score'].median(),
+    }).fillna({'peptides': 0}).reset_index()
+    summary.insert(0, 'project', project)
+
+    accepted = psms[psms['accepted']].assign(protein=lambda f: f['proteins'].str.split(';')).explode('protein')
+    proteins = (accepted.groupby(['sample', 'engine', 'protein'])
+                .agg(psms=('spectrum', 'size'), peptides=('peptide', 'nunique'), best_expect=('expect', 'min'))
+                .reset_index())
+    proteins.insert(0, 'project', project)
+    summary_path = write_table(summary, os.path.join(project_root, f'{project}_summary'))
+    proteins_path = write_table(proteins, os.path.join(project_root, f'{project}_proteins'))
+    return summary_path, proteins_path
@@ -0,0 +1,47 @@
+'''Which queued job of a stage runs next'''
+import collections
+
+QueuedJob = collections.namedtuple('QueuedJob', 'id project owner priority queued organism')
+
+
+class FairShare:
+    '''Weighted fair share across owners and projects, with priorities and aging.
+
+    Every queued job of the stage gets a score
+
+        priority + aging * hours waited - share * (owner usage / owner weight + project usage)
+
+    where usage counts the jobs of the stage running now or finished within
+    the last `window` seconds. The highest score runs next, ties go to the
+    oldest job, so without priorities and usage this is FIFO. An owner with
+    no weight in `weights` has weight 1; jobs without an owner count as
+    owned by their project.
+
+    In the stages of `affinity` ({stage: bonus}) a job whose organism is warm,
+    searched by a running job or the last finished one, gets the bonus, so
+    searches of one database run back to back while its FASTA is cached.
+    '''
+
+    def __init__(self, weights=None, aging=0.1, share=1.0, window=3600, affinity=None):
+        self.weights = weights or {}
+        self.aging = aging
+        self.share = share
+        self.window = window
+        self.affinity = affinity or {}
+
+    def score(self, job, owner_usage, project_usage, now, warm=(), bonus=0.0):
+        owner = job.owner or job.project
+        penalty = owner_usage.get(owner, 0) / self.weights.get(owner, 1) + project_usage.get(job.project, 0)
+        score = job.priority + self.aging * (now - job.queued) / 3600 - self.share * penalty
+        return score + bonus if job.organism in warm else score
+
+    def pick(self, queued, used, now, warm=(), bonus=0.0):
+        '''id of the job to run from [QueuedJob], used is [(project, owner, n)] of the recent usage
+        and warm the organisms that get the affinity bonus'''
+        owner_usage, project_usage = collections.Counter(), collections.Counter()
+        for project, owner, n in used:
+            owner_usage[owner or project] += n
+            project_usage[project] += n
+        best = max(queued, key=lambda job: (self.score(job, owner_usage, project_usage, now, warm, bonus), -job.id),
+                   default=None)
+        return best.id if best else None
@@ -0,0 +1,229 @@
+import string
+import threading
+from collections import OrderedDict
+
+PROJECT_HEADER = 'Project_title'
+SAMPLE_HEADER = 'Sample_ID'
+PROTOCOL_HEADER = 'Proteolysis_protocol'
+ORGANISM_HEADER = 'Organism'
+STATUS_HEADER = 'Status'
+SCAFFOLD_SAMPLE_HEADER = 'Scaffold_sample'
+SCAFFOLD_RUN_HEADER = 'Run_scaffold'
+UPLOADED_HEADER = 'Uploaded'
+# Optional columns for the scheduler, an integer priority and the person or group owning the sample
+PRIORITY_HEADER = 'Priority'
+OWNER_HEADER = 'User'
+
+# The whole sheet, the optional columns (Priority, User) come after the nine original ones
+LIST_RANGE = 'List'
+REQUIRED_HEADERS = (PROJECT_HEADER, SAMPLE_HEADER, PROTOCOL_HEADER, ORGANISM_HEADER, STATUS_HEADER)
+
+
+def column_letter(index):
+    '''0-based column index to A1 column letters'''
+    letters = ''
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = string.ascii_uppercase[rem] + letters
+    return letters
+
+
+def column_index(letters):
+    '''A1 column letters to a 0-based column index'''
+    index = 0
+    for c in letters:
+        index = index * 26 + ord(c) - ord('A') + 1
+    return index - 1
+
+
+class SampleTable:
+    '''Rows of the tracking sheet indexed by (project, sample) and grouped by project.
+
+    Rows are dicts keyed by column name, short rows are padded with ''. For
+    duplicated (project, sample) pairs the index points at the first one, the
+    project grouping keeps all of them.
+    '''
+
+    def __init__(self, values, required=REQUIRED_HEADERS):
+        values = values or [[]]
+        self.columns = [cn.replace(' ', '_') for cn in values[0]]
+        self.colindex = {cn: i for i, cn in enumerate(self.columns)}
+        self.require(*required)
+        self.rows = []
+        self.sheet_rows = {}
+        self.by_project = OrderedDict()
+        for i, values_row in enumerate(values[1:], 2):
+            row = dict(zip(self.columns, list(values_row) + [''] * (len(self.columns) - len(values_row))))
+            key = (row[PROJECT_HEADER], row[SAMPLE_HEADER])
+            if not all(key):
+                continue
+            self.rows.append(row)
+            self.sheet_rows.setdefault(key, i)
+            self.by_project.setdefault(key[0], []).append(row)
+
+    def require(self, *headers):
+        missing = [h for h in headers if h not in self.colindex]
+        if missing:
+            raise KeyError(f'Columns {missing} not found in the sheet header {self.columns}')
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __contains__(self, key):
+        return (key[0], key[1]) in self.sheet_rows
+
+    def sheet_row(self, psample):
+        '''1-based sheet row of a (project, sample, ...) tuple'''
+        return self.sheet_rows[(psample[0], psample[1])]
+
+    def project_rows(self, project):
+        return self.by_project.get(project, [])
+
+    def projects(self, header=None, value=None):
+        '''Projects in sheet order, optionally only those with a row where header == value'''
+        if header is None:
+            return list(self.by_project)
+        return [p for p, rows in self.by_project.items() if any(r[header] == value for r in rows)]
+
+    def uploaded(self):
+        self.require(UPLOADED_HEADER)
+        return [r for r in self.rows if r[UPLOADED_HEADER] == 'TRUE']
+
+    @staticmethod
+    def priority(row):
+        '''(priority, owner) of a row, 0 and '' when the columns are missing or the priority is not a number'''
+        try:
+            priority = int(row.get(PRIORITY_HEADER) or 0)
+        except ValueError:
+            priority = 0
+        return priority, row.get(OWNER_HEADER, '')
+
+    @staticmethod
+    def psample(row):
+        return (row[PROJECT_HEADER], row[SAMPLE_HEADER], row[PROTOCOL_HEADER], row[ORGANISM_HEADER])
+
+
+class StatusWriter:
+    '''Write-back queue for cells of the tracking sheet.
+
+    Writes are kept by sample and column, repeated writes to the same cell
+    are coalesced, and flush() sends everything pending in a single
+    values().batchUpdate. Each write is mapped to its row by the table
+    current at flush time (the last one fetched or passed to use()), so rows
+    inserted or deleted meanwhile do not send it to another sample; the
+    writes of samples gone from the sheet are dropped. With an interval the
+    queue is also flushed periodically from a background thread.
+    '''
+
+    def __init__(self, service, spreadsheet_id, range_name=LIST_RANGE, interval=None):
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+        self.range_name = range_name
+        self.sheet = range_name.split('!')[0]
+        self.interval = interval
+        self.table = None
+        self.last_error = None
+        self.dropped = 0
+        self._pending = OrderedDict()
+        # httplib2 connections are not thread-safe, all service calls go through io_lock
+        self.io_lock = threading.Lock()
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def fetch(self):
+        with self.io_lock:
+            table = self.service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id,
+                                                             range=self.range_name).execute()
+        self.use(SampleTable(table.get('values'), required=(PROJECT_HEADER, SAMPLE_HEADER)))
+        return self.table
+
+    def use(self, table):
+        '''Resolve rows from an already fetched SampleTable'''
+        with self._lock:
+            self.table = table
+
+    def invalidate(self):
+        '''Forget the cached table, next lookup fetches it again'''
+        with self._lock:
+            self.table = None
+
+    def _cell(self, table, psample, column):
+        return f'{self.sheet}!{column_letter(table.colindex[column])}{table.sheet_row(psample)}'
+
+    def cell(self, psample, column=STATUS_HEADER):
+        with self._lock:
+            if self.table is None:
+                self.fetch()
+            elif psample not in self.table or column not in self.table.colindex:
+                # The sheet may have grown since the cached fetch
+                self.fetch()
+            self.table.require(column)
+            if psample not in self.table:
+                raise KeyError(f'Sample {psample[:2]} not found in {self.range_name}')
+            return self._cell(self.table, psample, column)
+
+    def set(self, psample, status, column=STATUS_HEADER):
+        # Checked now, so a write to an unknown sample or column fails in the caller
+        self.cell(psample, column)
+        key = (psample[0], psample[1], column)
+        with self._lock:
+            self._pending.pop(key, None)
+            self._pending[key] = (psample, status)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return None
+            batch, self._pending = self._pending, OrderedDict()
+            table = self.table if self.table is not None else self.fetch()
+        data = []
+        for (project, sample, column), (psample, value) in batch.items():
+            if psample not in table or column not in table.colindex:
+                self.dropped += 1
+                continue
+            data.append({'range': self._cell(table, psample, column), 'values': [[value]], 'majorDimension': 'ROWS'})
+        if not data:
+            return None
+        body = {'valueInputOption': 'RAW', 'data': data}
+        try:
+            with self.io_lock:
+                return self.service.spreadsheets().values().batchUpdate(spreadsheetId=self.spreadsheet_id,
+                                                                        body=body).execute()
+        except Exception:
+            with self._lock:
+                # Put the batch back without overwriting anything newer
+                for key, value in batch.items():
+                    if key not in self._pending:
+                        self._pending[key] = value
+            raise
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = e
+
+    def start(self):
+        if self.interval and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='StatusWriter', daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
@@ -0,0 +1,202 @@
+'''Incremental sync of the tracking sheet against a snapshot kept in the job store'''
+import collections
+import hashlib
+import json
+import threading
+
+from sheets import *
+
+SYNC_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sheet_rows (
+    project TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (project, sample)
+);
+CREATE TABLE IF NOT EXISTS sheet_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sheet_pending (
+    project TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    PRIMARY KEY (project, sample)
+);
+'''
+
+SheetDiff = collections.namedtuple('SheetDiff', 'added changed removed')
+
+
+def column_ranges(sheet, indexes):
+    '''Contiguous A1 column ranges covering the given 0-based column indexes'''
+    ranges = []
+    for i in sorted(indexes):
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return [f'{sheet}!{column_letter(a)}:{column_letter(b)}' for a, b in ranges]
+
+
+class SheetSync:
+    '''Keeps a snapshot of the tracking sheet with one hash per (project, sample) row.
+
+    poll() fetches the sheet, compares it with the snapshot and returns the
+    current SampleTable together with a SheetDiff of added, changed and
+    removed rows. Deltas also accumulate in the job store until take() is
+    called, so import sees every change even when other callers, in this or
+    another process, polled in between. Columns in `ignore` (by default the Status column we write
+    ourselves) are neither fetched nor hashed, so they come back empty in the
+    table. Once the header is known only the header row and the tracked
+    columns are fetched, with one values().batchGet; when the header row
+    differs (a column was added, moved or renamed) the whole sheet is fetched.
+    '''
+
+    def __init__(self, store, service, spreadsheet_id, range_name=LIST_RANGE, ignore=(STATUS_HEADER,),
+                 io_lock=None):
+        self.store = store
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+        self.range_name = range_name
+        self.sheet = range_name.split('!')[0]
+        self.ignore = set(ignore)
+        self.io_lock = io_lock or threading.Lock()
+        self.hashes = None
+        self.cells = {}
+        self.table = self.values = self._parts = None
+        self.store.create(SYNC_SCHEMA)
+
+    def _meta(self, key):
+        with self.store.read() as db:
+            row = db.execute('SELECT value FROM sheet_meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _fetch_full(self):
+        with self.io_lock:
+            table = self.service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id,
+                                                             range=self.range_name).execute()
+        return table.get('values', [])
+
+    def _fetch_tracked(self, header):
+        '''Rows with only the tracked columns filled, None if the header changed.
+
+        Returns self.values when nothing changed since the previous fetch.
+        '''
+        tracked = [i for i, cn in enumerate(header) if cn.replace(' ', '_') not in self.ignore]
+        ranges = column_ranges(self.sheet, tracked)
+        with self.io_lock:
+            result = self.service.spreadsheets().values().batchGet(
+                spreadsheetId=self.spreadsheet_id, ranges=[f'{self.sheet}!1:1'] + ranges,
+                majorDimension='ROWS').execute()
+        value_ranges = result.get('valueRanges', [])
+        if not value_ranges or value_ranges[0].get('values', [[]])[0] != header:
+            return None
+        parts = []
+        for a1, value_range in zip(ranges, value_ranges[1:]):
+            start, end = (column_index(c) for c in a1.split('!')[1].split(':'))
+            parts.append((start, end - start + 1, value_range.get('values', [])))
+        if self.values is not None and parts == self._parts:
+            return self.values
+        rows = []
+        for r in range(max((len(values) for _, _, values in parts), default=0)):
+            row = []
+            for start, width, values in parts:
+                cells = values[r] if r < len(values) else []
+                row += [''] * (start - len(row))
+                row += cells
+                row += [''] * (width - len(cells))
+            rows.append(row)
+        if not rows:
+            return None
+        rows[0] = list(header)
+        self._parts = parts
+        return rows
+
+    def fetch(self):
+        header = self._meta('header')
+        values = self._fetch_tracked(header) if header else None
+        if values is None:
+            self._parts = None
+            values = self._fetch_full()
+        return values
+
+    def poll(self):
+        values = self.fetch()
+        if values is self.values:
+            return self.table, SheetDiff([], [], [])
+        table = SampleTable(values)
+        tracked = [i for i, cn in enumerate(table.columns) if cn not in self.ignore]
+        old_hashes, old_cells = self.hashes or {}, self.cells
+        rows, hashes, cells = {}, {}, {}
+        for row in table:
+            key = (row[PROJECT_HEADER], row[SAMPLE_HEADER])
+            if key in cells:
+                continue
+            rows[key] = row
+            values_row = list(row.values())
+            cells[key] = [values_row[i] for i in tracked]
+            # Rows seen by this process compare by value, hashing is only needed for the snapshot
+            if old_cells.get(key) == cells[key]:
+                hashes[key] = old_hashes[key]
+                continue
+            # By column name and skipping empty cells, so adding or moving a column changes no row
+            named = sorted(f'{table.columns[i]}={value}' for i, value in zip(tracked, cells[key]) if value)
+            hashes[key] = hashlib.sha1('\x1f'.join(named).encode()).hexdigest()
+        with self.store.transaction() as db:
+            # Compared with the stored snapshot, which other processes may have advanced since our last poll
+            stored = {(p, s): h for p, s, h in db.execute('SELECT project, sample, hash FROM sheet_rows')}
+            added = [row for key, row in rows.items() if key not in stored]
+            changed = [row for key, row in rows.items() if key in stored and stored[key] != hashes[key]]
+            removed = [key for key in stored if key not in hashes]
+            db.executemany('INSERT OR REPLACE INTO sheet_rows (project, sample, hash) VALUES (?, ?, ?)',
+                           [key + (hashes[key],) for key in ((r[PROJECT_HEADER], r[SAMPLE_HEADER])
+                                                             for r in added + changed)])
+            db.executemany('DELETE FROM sheet_rows WHERE project = ? AND sample = ?', removed)
+            db.execute('INSERT OR REPLACE INTO sheet_meta (key, value) VALUES (?, ?)',
+                       ('header', json.dumps(values[0] if values else [])))
+            diff = SheetDiff(added, changed, removed)
+            self._accumulate(db, diff)
+        self.hashes, self.cells = hashes, cells
+        self.table, self.values = table, values
+        return table, diff
+
+    def _accumulate(self, db, diff):
+        '''Merge a diff into the pending one, in the transaction that advanced the snapshot'''
+        pending = {(p, s): kind for p, s, kind in db.execute('SELECT project, sample, kind FROM sheet_pending')}
+        update = {}
+        for row in diff.added:
+            key = (row[PROJECT_HEADER], row[SAMPLE_HEADER])
+            update[key] = 'changed' if pending.get(key) == 'removed' else 'added'
+        for row in diff.changed:
+            key = (row[PROJECT_HEADER], row[SAMPLE_HEADER])
+            update[key] = 'added' if pending.get(key) == 'added' else 'changed'
+        dropped = []
+        for key in diff.removed:
+            if pending.get(key) == 'added':
+                dropped.append(key)
+            else:
+                update[key] = 'removed'
+        db.executemany('INSERT OR REPLACE INTO sheet_pending (project, sample, kind) VALUES (?, ?, ?)',
+                       [key + (kind,) for key, kind in update.items()])
+        db.executemany('DELETE FROM sheet_pending WHERE project = ? AND sample = ?', dropped)
+
+    def take(self):
+        '''SheetDiff of everything polled by any process since the last take(), rows from the last poll'''
+        if self.table is None:
+            self.poll()
+        with self.store.transaction() as db:
+            pending = {(p, s): kind for p, s, kind in db.execute('SELECT project, sample, kind FROM sheet_pending')}
+            db.execute('DELETE FROM sheet_pending')
+        added, changed, seen = [], [], set()
+        for row in self.table:
+            key = (row[PROJECT_HEADER], row[SAMPLE_HEADER])
+            if key in seen:
+                continue
+            seen.add(key)
+            kind = pending.get(key)
+            if kind == 'added':
+                added.append(row)
+            elif kind == 'changed':
+                changed.append(row)
+        return SheetDiff(added, changed, sorted(key for key, kind in pending.items() if kind == 'removed'))
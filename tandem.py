@@ -0,0 +1,161 @@
+'''X!Tandem runs, either over the whole MGF or split into concurrently searched shards'''
+import os
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mgf
+from executor import run_logged, fsync_replace, file_tail
+
+tandem_stub = '''<?xml version="1.0"?>
+<bioml>
+	<note type="input" label="list path, default parameters">{defaults_path}</note>
+	<note type="input" label="list path, taxonomy information">{taxonomy_path}</note>
+	<note type="input" label="protein, taxon">{taxon}</note>
+	<note type="input" label="spectrum, path">{mgf_file}</note>
+	<note type="input" label="output, path">{output_path}</note>
+{extra}</bioml>
+'''
+
+shard_notes = '''	<note type="input" label="spectrum, threads">{threads}</note>
+	<note type="input" label="output, path hashing">no</note>
+'''
+
+GROUP_ID_RE = re.compile(r'(\bid=")(\d+)')
+
+
+def is_complete(path):
+    '''True for a whole tandem output file, False for a missing or cut off one'''
+    return file_tail(path, 64).rstrip().endswith(b'</bioml>')
+
+
+def finish_output(partial, output_path):
+    '''Rename a finished tandem output into place, raises on a cut off file'''
+    if not is_complete(partial):
+        raise RuntimeError(f'X!Tandem output {partial} is incomplete')
+    fsync_replace(partial, output_path)
+
+
+def write_conf(confpath, defaults_path, taxonomy_path, taxon, mgf_file, output_path, threads=None):
+    extra = shard_notes.format(threads=threads) if threads else ''
+    with open(confpath, 'w') as f:
+        f.write(tandem_stub.format(defaults_path=defaults_path, taxonomy_path=taxonomy_path, taxon=taxon,
+                                   mgf_file=mgf_file, output_path=output_path, extra=extra))
+
+
+def _top_groups(f):
+    '''Yield (type, lines) for every top-level <group> of a tandem output file'''
+    depth = 0
+    lines, gtype = [], None
+    for line in f:
+        if depth == 0:
+            if not line.lstrip().startswith('<group'):
+                continue
+            m = re.search(r'type="(\w+)"', line)
+            gtype = m.group(1) if m else None
+            lines = []
+        lines.append(line)
+        depth += (line.count('<group') - line.count('</group>')
+                  - len(re.findall(r'<group[^>]*/>', line)))
+        if depth == 0:
+            yield gtype, lines
+
+
+def merge_outputs(outputs, merged, mgf_file, output_path):
+    '''Merge shard outputs [(path, spectra)] into the tandem XML `merged`.
+
+    Spectrum ids of model groups (and the protein/domain ids derived from
+    them) are shifted by the number of spectra in the preceding shards, so
+    they match the positions in the unsplit MGF. Parameter groups are taken
+    from the first shard with the spectrum and output paths restored.
+    '''
+    first = outputs[0][0]
+    with open(first) as f:
+        head = []
+        for line in f:
+            if line.lstrip().startswith('<group'):
+                break
+            head.append(line)
+    parameters = []
+    with open(merged, 'w') as out:
+        out.writelines(head)
+        offset = 0
+        for path, spectra in outputs:
+            shift = lambda m: m.group(1) + str(int(m.group(2)) + offset)
+            with open(path) as f:
+                for gtype, lines in _top_groups(f):
+                    if gtype == 'model':
+                        out.writelines(GROUP_ID_RE.sub(shift, line) for line in lines)
+                    elif path == first:
+                        parameters.extend(lines)
+            offset += spectra
+        for line in parameters:
+            if 'label="spectrum, path"' in line:
+                line = re.sub(r'>[^<]*<', f'>{mgf_file}<', line)
+            elif 'label="output, path"' in line:
+                line = re.sub(r'>[^<]*<', f'>{output_path}<', line)
+            out.write(line)
+        out.write('</bioml>\n')
+
+
+def search(cmd, confpath, log):
+    start = time.time()
+    returncode = run_logged(cmd.format(infile=confpath), log)
+    return returncode, time.time() - start
+
+
+def search_split(cmd, mgf_file, output_path, defaults_path, taxonomy_path, taxon, shards, gate, log,
+                 workdir=None):
+    '''Search mgf_file as `shards` concurrent tandem runs sharing the threads of gate (executor.ThreadGate).
+
+    Each shard takes up to an equal part of the threads of the gate, what is
+    free when it starts. The merged result is written next to output_path
+    and renamed into place once every shard succeeded. Returns the wall time
+    in seconds.
+
+    With a workdir the shards are kept there until the merge, and shards
+    with a complete output from an interrupted run are not searched again.
+    '''
+    start = time.time()
+    temporary = workdir is None
+    if temporary:
+        workdir = tempfile.mkdtemp(prefix='.tandem-', dir=os.path.dirname(output_path))
+    else:
+        os.makedirs(workdir, exist_ok=True)
+    try:
+        parts = mgf.split(mgf_file, shards, os.path.join(workdir, 'part{}.mgf'))
+        per_shard = max(1, gate.threads // len(parts))
+        confs, outputs = [], []
+        for i, (part, spectra) in enumerate(parts):
+            conf = os.path.join(workdir, f'part{i}.tconf.xml')
+            shard_output = os.path.join(workdir, f'part{i}.tandem.xml')
+            outputs.append((shard_output, spectra))
+            if is_complete(shard_output):
+                continue
+            confs.append((conf, part, shard_output))
+        if len(confs) < len(parts):
+            log(f'{len(parts) - len(confs)} of {len(parts)} shards already searched')
+        log(f'Searching {len(confs)} shards with up to {per_shard} threads each')
+
+        def run(conf, part, shard_output):
+            with gate.acquire(per_shard) as threads:
+                write_conf(conf, defaults_path, taxonomy_path, taxon, part, shard_output, threads)
+                return search(cmd, conf, log)
+
+        if confs:
+            with ThreadPoolExecutor(len(confs)) as pool:
+                results = list(pool.map(lambda conf: run(*conf), confs))
+            for (returncode, seconds), (conf, part, shard_output) in zip(results, confs):
+                if returncode != 0 or not is_complete(shard_output):
+                    raise RuntimeError(f'X!Tandem shard {shard_output} failed with {returncode}')
+        merged = os.path.join(workdir, 'merged.tandem.xml')
+        merge_outputs(outputs, merged, mgf_file, output_path)
+        finish_output(merged, output_path)
+    except BaseException:
+        if temporary:
+            shutil.rmtree(workdir, ignore_errors=True)
+        raise
+    shutil.rmtree(workdir, ignore_errors=True)
+    return time.time() - start
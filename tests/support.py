@@ -0,0 +1,39 @@
+'''msauto pointed at a bench.setup_pipeline() tree and the fakes, for tests of whole subcommands'''
+import argparse
+import shutil
+import tempfile
+import unittest
+
+import bench
+import msauto
+from fakes import synthetic_table
+
+PIPELINE_ARGS = dict(projects=1, samples=2, raw_size=1024, spectra=20, poll=0.05, convert_time=0.0,
+                     tandem_time=0.0, scaffold_time=0.0, sf3_size=1024, postproc_time=0.0)
+
+
+def reset_msauto():
+    '''Forget the lazily created singletons, so the next test builds them from its own config'''
+    for name in dir(msauto):
+        if name.startswith('g_') and name != 'g_logs':
+            setattr(msauto, name, None)
+
+
+class MsautoTestCase(unittest.TestCase):
+    '''Each test gets a fresh tree and job store; rows() is the List sheet it starts with'''
+
+    def rows(self):
+        return synthetic_table(PIPELINE_ARGS['projects'], PIPELINE_ARGS['samples'])
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='msauto-test-')
+        reset_msauto()
+        self.config, _ = bench.setup_pipeline(self.root, argparse.Namespace(**PIPELINE_ARGS))
+        self.service = bench.configure_msauto(msauto, self.config, self.rows(), 0.0)
+        self.sheet = self.service.sheets['List']
+        self.args = argparse.Namespace(subparser='test')
+
+    def tearDown(self):
+        bench.close_msauto(msauto)
+        reset_msauto()
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from cluster import SharedLock
+from jobstore import STAGE_TANDEM, JobStore
+
+
+class SharedLockTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='cluster-test-')
+        self.path = os.path.join(self.workdir, 'jobs.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_abandoned_lock_is_broken(self):
+        dead = SharedLock(self.path, ttl=60)
+        self.assertTrue(dead.try_acquire())
+        # Its host died an hour ago by the file server clock, whatever the clock of this host says
+        os.utime(self.path, (time.time() - 3600,) * 2)
+        other = SharedLock(self.path, ttl=60)
+        self.assertFalse(other.try_acquire())
+        self.assertTrue(other.try_acquire())
+
+    def test_fresh_lock_is_kept(self):
+        holder = SharedLock(self.path, ttl=60)
+        self.assertTrue(holder.try_acquire())
+        self.assertFalse(SharedLock(self.path, ttl=60).try_acquire())
+        self.assertTrue(holder.held())
+
+    def test_kept_lock_is_refreshed(self):
+        holder = SharedLock(self.path, ttl=0.3, keep=True)
+        holder.acquire()
+        other = SharedLock(self.path, ttl=0.3)
+        deadline = time.time() + 1.0
+        while time.time() < deadline:
+            self.assertFalse(other.try_acquire())
+            time.sleep(0.05)
+        self.assertTrue(holder.held())
+        holder.release()
+        self.assertTrue(other.try_acquire())
+
+    def test_released_lock_stops_its_refresher(self):
+        for i in range(3):
+            with SharedLock(self.path, ttl=0.15, keep=True):
+                pass
+        time.sleep(0.3)
+        self.assertNotIn('shared-lock', [thread.name for thread in threading.enumerate()])
+        holder = SharedLock(self.path, ttl=0.15, keep=True)
+        with holder:
+            time.sleep(0.3)
+            self.assertTrue(holder.held())
+
+
+    def test_store_reads_wait_for_the_lock(self):
+        store = JobStore(os.path.join(self.workdir, 'jobs.sqlite'), lock=SharedLock(self.path, ttl=60))
+        store.enqueue(STAGE_TANDEM, [('P1', 'S1', '', '')])
+        other = SharedLock(self.path, ttl=60)
+        other.acquire()
+        reader = threading.Thread(target=store.counts)
+        reader.start()
+        reader.join(0.3)
+        self.assertTrue(reader.is_alive())
+        other.release()
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from databases import DatabaseManager, taxonomy_xml
+from fakes import synthetic_fasta
+from jobstore import JobStore
+
+
+class TaxonomyTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='databases-test-')
+        self.store = JobStore(os.path.join(self.workdir, 'jobs.sqlite'))
+        self.fasta_dir = os.path.join(self.workdir, 'fasta')
+        os.makedirs(self.fasta_dir)
+        self.taxonomy = os.path.join(self.workdir, 'taxonomy.xml')
+        # Named by its release, not after the taxon
+        self.human = os.path.join(self.workdir, 'uniprot_human_2019.fasta')
+        synthetic_fasta(self.human, 20)
+        with open(self.taxonomy, 'w') as f:
+            f.write(taxonomy_xml([('human', [self.human])]))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def databases(self, local_dir=None):
+        return DatabaseManager(self.store, self.fasta_dir, self.taxonomy, local_dir)
+
+    def test_listed_taxon_keeps_its_path(self):
+        databases = self.databases(os.path.join(self.workdir, 'local'))
+        synthetic_fasta(databases.fasta_path('mouse'), 20, seed=1)
+        self.assertTrue(databases.write_taxonomy({'human', 'mouse'}))
+        self.assertEqual(databases.listed(), {'human': [self.human], 'mouse': [databases.search_path('mouse')]})
+        self.assertEqual(databases.prepare('human').path, self.human)
+        self.assertEqual(databases.search_path('human'), self.human)
+        self.assertFalse(os.path.exists(os.path.join(self.workdir, 'local', 'human.fasta')))
+        databases.prepare('mouse')
+        self.assertTrue(os.path.exists(os.path.join(self.workdir, 'local', 'mouse.fasta')))
+
+    def test_taxon_with_several_files(self):
+        crap = os.path.join(self.workdir, 'crap.fasta')
+        synthetic_fasta(crap, 5, seed=2)
+        with open(self.taxonomy, 'w') as f:
+            f.write(taxonomy_xml([('human', [self.human, crap])]))
+        databases = self.databases(os.path.join(self.workdir, 'local'))
+        self.assertFalse(databases.write_taxonomy({'human'}))
+        self.assertEqual(databases.listed(), {'human': [self.human, crap]})
+        info = databases.prepare('human')
+        self.assertEqual(info.problem, '')
+        self.assertEqual(info.proteins, databases.verify('human').proteins)
+        self.assertEqual(info.size, os.path.getsize(self.human) + os.path.getsize(crap))
+        self.assertFalse(os.path.exists(os.path.join(self.workdir, 'local')))
+        # The cache key follows every file of the taxon
+        synthetic_fasta(crap, 6, seed=3)
+        self.assertNotEqual(databases.verify('human').sha256, info.sha256)
+        os.remove(crap)
+        self.assertEqual(databases.verify('human').path, crap)
+
+    def test_listed_taxa_leave_the_file_alone(self):
+        with open(self.taxonomy) as f:
+            before = f.read()
+        self.assertFalse(self.databases().write_taxonomy({'human'}))
+        with open(self.taxonomy) as f:
+            self.assertEqual(f.read(), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import threading
+import time
+import unittest
+
+from executor import ThreadGate
+
+
+class ThreadGateTest(unittest.TestCase):
+    def test_runs_share_the_threads(self):
+        gate = ThreadGate(4)
+        with gate.acquire(3) as first, gate.acquire(3) as second:
+            self.assertEqual((first, second, gate.free), (3, 1, 0))
+        self.assertEqual(gate.free, 4)
+
+    def test_waits_for_a_free_thread(self):
+        gate = ThreadGate(2)
+        peak, running = [0], [0]
+        lock = threading.Lock()
+
+        def run():
+            with gate.acquire(2) as threads:
+                with lock:
+                    running[0] += threads
+                    peak[0] = max(peak[0], running[0])
+                time.sleep(0.02)
+                with lock:
+                    running[0] -= threads
+
+        workers = [threading.Thread(target=run) for i in range(6)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual((peak[0], gate.free), (2, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
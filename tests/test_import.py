@@ -0,0 +1,34 @@
+import unittest
+
+import msauto
+from fakes import synthetic_table
+from sheets import PRIORITY_HEADER, OWNER_HEADER
+from tests.support import MsautoTestCase
+
+
+class PriorityTest(MsautoTestCase):
+    def rows(self):
+        # Priority and User after the nine original columns, as in the tracking sheet
+        rows = synthetic_table(1, 2)
+        rows[0] += [PRIORITY_HEADER, OWNER_HEADER]
+        rows[1] += ['5', 'alice']
+        rows[2] += ['', '']
+        return rows
+
+    def priorities(self):
+        return sorted(msauto.get_job_store().connection().execute(
+            'SELECT project, sample, priority, owner FROM priorities'))
+
+    def test_sheet_priority_reaches_job_store(self):
+        msauto.run_gimport(self.args)
+        self.assertEqual(self.priorities(), [('P0000', 'S0000_000', 5, 'alice'), ('P0000', 'S0000_001', 0, '')])
+
+    def test_edited_priority_is_updated(self):
+        msauto.run_gimport(self.args)
+        self.sheet[2][9:11] = ['9', 'bob']
+        msauto.run_gimport(self.args)
+        self.assertIn(('P0000', 'S0000_001', 9, 'bob'), self.priorities())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from fakes import FakeMascot, synthetic_mgf
+from mascot import MascotClient, MascotError, dat_complete
+
+
+class MascotClientTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='mascot-test-')
+        self.mgf = os.path.join(self.workdir, 'S0000_000.mgf')
+        synthetic_mgf(self.mgf, 20)
+        self.dat = os.path.join(self.workdir, 'S0000_000.dat')
+        self.lines = []
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def start(self, **kwargs):
+        self.server = FakeMascot(**dict(dict(search_time=0.1, dat_size=4096), **kwargs)).start()
+        self.client = MascotClient(self.server.cgi, 'user', 'password', concurrency=2, poll=0.05)
+
+    def search(self, mgfpath=None, resume=None, submitted=None, top_n=None):
+        return self.client.run(self.client.search(mgfpath or self.mgf, {'DB': 'synthetic'}, self.dat,
+                                                  self.lines.append, top_n=top_n, resume=resume,
+                                                  submitted=submitted))
+
+    def content(self, result):
+        return self.server.jobs[(result.date, result.file)][1]
+
+    def test_search(self):
+        self.start()
+        submitted = []
+        result = self.search(submitted=lambda date, file: submitted.append((date, file)))
+        self.assertEqual(submitted, [(result.date, result.file)])
+        with open(self.dat, 'rb') as f:
+            self.assertEqual(f.read(), self.content(result))
+        self.assertEqual(result.dat_bytes, len(self.content(result)))
+        self.assertEqual(result.bytes_sent, len(self.server.uploads[0]))
+        self.assertEqual(self.server.calls['login.pl'], 1)
+        self.assertEqual(self.server.calls['nph-mascot.exe'], 1)
+
+    def test_upload_sized_unless_filtered(self):
+        self.start()
+        self.search()
+        headers = self.server.upload_headers[0]
+        self.assertNotIn('Transfer-Encoding', headers)
+        self.assertEqual(int(headers['Content-Length']), len(self.server.uploads[0]))
+        with open(self.mgf, 'rb') as f:
+            self.assertIn(f.read(), self.server.uploads[0])
+        self.search(top_n=5)
+        self.assertEqual(self.server.upload_headers[1].get('Transfer-Encoding'), 'chunked')
+
+    def test_wait_until_written(self):
+        self.start(write_time=0.3)
+        result = self.search()
+        self.assertTrue(dat_complete(self.dat))
+        self.assertEqual(result.dat_bytes, len(self.content(result)))
+        self.assertGreater(self.server.calls['ms-status.exe'], 2)
+
+    def test_give_up_waiting(self):
+        self.start(write_time=30)
+        self.client.max_wait = 0.2
+        with self.assertRaisesRegex(MascotError, 'still incomplete'):
+            self.search()
+
+    def test_give_up_downloading(self):
+        # Without Range support the downloads are the polls
+        self.start(write_time=30, ranges=False)
+        self.client.max_wait = 0.2
+        with self.assertRaisesRegex(MascotError, 'still incomplete'):
+            self.search()
+
+    def test_resume_search(self):
+        self.start()
+        first = self.search()
+        os.unlink(self.dat)
+        result = self.search(resume=(first.date, first.file))
+        self.assertEqual((result.date, result.file, result.bytes_sent), (first.date, first.file, 0))
+        self.assertEqual(self.server.calls['nph-mascot.exe'], 1)
+        self.assertTrue(dat_complete(self.dat))
+
+    def test_download_resumes_with_range(self):
+        self.start()
+        result = self.search()
+        content = self.content(result)
+        os.unlink(self.dat)
+        # Marked, to tell the kept part from a download starting over
+        with open(self.dat + '.part', 'wb') as f:
+            f.write(b'#' * 1000)
+        size = self.client.run(self.client.download(result.date, result.file, self.dat))
+        self.assertEqual(size, len(content))
+        with open(self.dat, 'rb') as f:
+            self.assertEqual(f.read(), b'#' * 1000 + content[1000:])
+
+    def test_without_range_support(self):
+        self.start(write_time=0.3, ranges=False)
+        result = self.search()
+        with open(self.dat, 'rb') as f:
+            self.assertEqual(f.read(), self.content(result))
+        self.assertIs(self.client.ranges, False)
+        # One probe, then the downloads until the file is whole, not a full read per poll and another to download
+        polls = self.server.calls['ms-status.exe']
+        self.search(resume=(result.date, result.file))
+        self.assertEqual(self.server.calls['ms-status.exe'], polls + 1)
+
+    def test_login_again(self):
+        self.start()
+        first = self.search()
+        self.server.expire_sessions()
+        self.search()
+        self.assertEqual(self.server.calls['login.pl'], 2)
+        self.assertEqual(self.server.calls['nph-mascot.exe'], 3)
+        # Waiting and downloading log in again too
+        self.server.expire_sessions()
+        os.unlink(self.dat)
+        self.search(resume=(first.date, first.file))
+        self.assertEqual(self.server.calls['login.pl'], 3)
+        self.assertTrue(dat_complete(self.dat))
+
+    def test_login_again_once(self):
+        self.start(password='secret')
+        with self.assertRaises(MascotError):
+            self.search()
+        self.assertEqual(self.server.calls['login.pl'], 2)
+        self.assertEqual(self.server.calls['nph-mascot.exe'], 2)
+
+    def test_search_error(self):
+        self.start()
+        empty = os.path.join(self.workdir, 'empty.mgf')
+        open(empty, 'w').close()
+        with self.assertRaises(MascotError):
+            self.search(empty)
+        self.assertFalse(os.path.exists(self.dat))
+        self.assertTrue(any('could not be performed' in line for line in self.lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
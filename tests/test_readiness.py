@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from jobstore import *
+from readiness import ReadinessTracker
+
+RUN_ROW = ('P0000', 'S0000_000', 'trypsin', 'human')
+SAMPLES = [('S0000_000', 'A'), ('S0000_001', 'B')]
+
+
+class ReadinessTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='readiness-test-')
+        self.store = JobStore(os.path.join(self.workdir, 'jobs.sqlite'))
+        self.results = set()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def tracker(self):
+        return ReadinessTracker(self.store, finished=lambda stage, project, sample: (stage, sample) in self.results)
+
+    def scaffold_jobs(self):
+        return self.store.connection().execute('SELECT COUNT(*) FROM jobs WHERE stage = ?',
+                                               (STAGE_SCAFFOLD,)).fetchone()[0]
+
+    def test_searched_before_the_job_store(self):
+        # Migrated lists bring no search jobs, the results on disk count
+        tracker = self.tracker()
+        self.results = {(stage, s) for stage in (STAGE_TANDEM, STAGE_MASCOT) for s, _ in SAMPLES[1:]}
+        self.results.add((STAGE_TANDEM, SAMPLES[0][0]))
+        self.assertFalse(tracker.watch(RUN_ROW, SAMPLES))
+        self.assertEqual(tracker.progress(), {'P0000': (3, 4)})
+        self.results.add((STAGE_MASCOT, SAMPLES[0][0]))
+        self.assertTrue(tracker.watch(RUN_ROW, SAMPLES))
+        self.assertEqual(self.scaffold_jobs(), 1)
+
+    def test_job_state_wins_over_the_results(self):
+        tracker = self.tracker()
+        self.results = {(stage, s) for stage in (STAGE_TANDEM, STAGE_MASCOT) for s, _ in SAMPLES}
+        self.store.enqueue(STAGE_TANDEM, [RUN_ROW])
+        self.assertFalse(tracker.watch(RUN_ROW, SAMPLES))
+        self.assertEqual(self.scaffold_jobs(), 0)
+
+    def test_queued_once(self):
+        tracker = self.tracker()
+        self.results = {(stage, s) for stage in (STAGE_TANDEM, STAGE_MASCOT) for s, _ in SAMPLES}
+        self.assertTrue(tracker.watch(RUN_ROW, SAMPLES))
+        # Later checks and searches of a queued project report nothing new
+        self.assertFalse(tracker.watch(RUN_ROW, SAMPLES))
+        self.assertFalse(tracker.search_done('P0000'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import os
+import time
+import unittest
+
+import msauto
+from fakes import synthetic_mgf
+from jobstore import *
+from tests.support import MsautoTestCase
+
+CUT, DELETED = ('P0000', 'S0000_000', 'trypsin', 'human'), ('P0000', 'S0000_001', 'trypsin', 'human')
+
+
+class RecoverTest(MsautoTestCase):
+    def test_only_cut_off_outputs_are_converted_again(self):
+        store = msauto.get_job_store()
+        store.enqueue(STAGE_CONVERT, [CUT, DELETED], DONE)
+        os.makedirs(msauto.get_proj_root('P0000'), exist_ok=True)
+        path = msauto.get_sample_mgf_path(CUT)
+        synthetic_mgf(path, 5)
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 20)
+        jobs = msauto.recover_outputs(time.time() - 60)
+        self.assertEqual([job.psample for job in jobs], [CUT])
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(store.keys(STAGE_CONVERT, DONE), {DELETED[:2]})
+
+
+if __name__ == '__main__':
+    unittest.main()
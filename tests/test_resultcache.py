@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from jobstore import JobStore
+from resultcache import ResultCache
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='resultcache-test-')
+        self.store = JobStore(os.path.join(self.workdir, 'jobs.sqlite'))
+        self.cache = ResultCache(self.store, os.path.join(self.workdir, 'cache'), 2500)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def result(self, name):
+        path = os.path.join(self.workdir, name + '.dat')
+        with open(path, 'wb') as f:
+            f.write(b'x' * 1000)
+        return path
+
+    def test_least_recently_used_evicted(self):
+        for key in ('aa01', 'bb02'):
+            self.cache.put(key, '.dat', self.result(key))
+        self.assertTrue(self.cache.get('aa01', '.dat', os.path.join(self.workdir, 'hit.dat')))
+        self.cache.put('cc03', '.dat', self.result('cc03'))
+        self.assertFalse(os.path.exists(self.cache.path('bb02', '.dat')))
+        self.assertFalse(self.cache.get('bb02', '.dat', os.path.join(self.workdir, 'miss.dat')))
+        self.assertTrue(self.cache.get('aa01', '.dat', os.path.join(self.workdir, 'hit.dat')))
+        self.assertEqual(self.cache.size(), 2000)
+
+    def test_cut_off_entry_is_a_miss(self):
+        self.cache.put('aa01', '.dat', self.result('aa01'))
+        self.assertFalse(self.cache.get('aa01', '.dat', os.path.join(self.workdir, 'miss.dat'), lambda path: False))
+        self.assertEqual(self.cache.size(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
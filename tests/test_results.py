@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import msauto
+import results
+from fakes import synthetic_dat
+from jobstore import *
+from tests.support import MsautoTestCase
+
+
+class MascotParseTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='results-test-')
+        self.dat = os.path.join(self.workdir, 'S0000_000.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_neutral_mass_query_has_no_charge(self):
+        synthetic_dat(self.dat, 3)
+        with open(self.dat) as f:
+            content = f.read()
+        with open(self.dat, 'w') as f:
+            f.write(content.replace(',2+\n', ',Mr\n', 1))
+        rows = list(results.iter_mascot(self.dat))
+        self.assertEqual(sorted({row['spectrum']: row['charge'] for row in rows}.items()), [(1, 0), (2, 2), (3, 2)])
+
+
+class AggregateTest(MsautoTestCase):
+    def test_built_once_the_project_is_done(self):
+        store = msauto.get_job_store()
+        ready, busy = ('P0000', 'S0000_000', 'trypsin', 'human'), ('P0000', 'S0000_001', 'trypsin', 'human')
+        store.enqueue(STAGE_TANDEM, [busy])
+        self.assertTrue(msauto.aggregate_due('P0000'))
+        os.makedirs(msauto.get_proj_root('P0000'), exist_ok=True)
+        synthetic_dat(msauto.get_sample_mascot_path(ready), 10)
+        msauto.summarize_sample(ready)
+        # Built on the first summary, then not again while the searches go on
+        self.assertFalse(msauto.aggregate_due('P0000'))
+        store.remove(STAGE_TANDEM, [busy])
+        store.enqueue(STAGE_SUMMARY, [busy])
+        self.assertFalse(msauto.aggregate_due('P0000'))
+        store.remove(STAGE_SUMMARY, [busy])
+        self.assertTrue(msauto.aggregate_due('P0000'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+
+from fakes import FakeSheetsService, synthetic_table
+from sheets import SampleTable, StatusWriter
+
+STATUS = 4
+
+
+class StatusWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeSheetsService({'List': synthetic_table(2, 2)})
+        self.sheet = self.service.sheets['List']
+        self.writer = StatusWriter(self.service, 'sheet')
+
+    def status(self, project, sample):
+        return next(row[STATUS] for row in self.sheet if row[:2] == [project, sample])
+
+    def test_rows_resolved_at_flush(self):
+        self.writer.set(('P0001', 'S0001_001'), 'Converting')
+        self.writer.set(('P0000', 'S0000_001'), 'Searching')
+        # A row inserted above and another deleted before the write goes out
+        self.sheet.insert(1, ['P0002', 'S0002_000', 'trypsin', 'human', 'New', '', '', '', ''])
+        del self.sheet[[row[:2] for row in self.sheet].index(['P0000', 'S0000_001'])]
+        self.writer.use(SampleTable([list(row) for row in self.sheet]))
+        self.writer.flush()
+        self.assertEqual(self.status('P0001', 'S0001_001'), 'Converting')
+        self.assertEqual(self.status('P0002', 'S0002_000'), 'New')
+        self.assertEqual(self.writer.dropped, 1)
+        self.assertEqual(self.writer.pending(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
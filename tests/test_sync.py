@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from fakes import FakeSheetsService, synthetic_table
+from jobstore import JobStore
+from sync import SheetSync
+
+
+class SheetSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='sync-test-')
+        self.store = JobStore(os.path.join(self.workdir, 'jobs.sqlite'))
+        self.service = FakeSheetsService({'List': synthetic_table(2, 3)})
+        self.sheet = self.service.sheets['List']
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def sync(self):
+        return SheetSync(self.store, self.service, 'sheet')
+
+    def test_added_column_is_fetched(self):
+        sync = self.sync()
+        sync.poll()
+        sync.poll()
+        self.sheet[0].append('Priority')
+        self.sheet[1].append('7')
+        table, diff = sync.poll()
+        self.assertIn('Priority', table.colindex)
+        self.assertEqual(table.rows[0]['Priority'], '7')
+        self.assertEqual([(r['Project_title'], r['Sample_ID']) for r in diff.changed], [('P0000', 'S0000_000')])
+
+    def test_added_column_is_fetched_after_restart(self):
+        self.sync().poll()
+        self.sheet[0].append('Priority')
+        self.sheet[1].append('7')
+        table, _ = self.sync().poll()
+        self.assertEqual(table.rows[0]['Priority'], '7')
+
+    def test_renamed_column_is_fetched(self):
+        sync = self.sync()
+        sync.poll()
+        self.sheet[0][8] = 'Notes'
+        table, _ = sync.poll()
+        self.assertIn('Notes', table.colindex)
+        self.assertNotIn('Comment', table.colindex)
+
+    def test_pending_diff_is_shared_between_processes(self):
+        scaffold, gimport = self.sync(), self.sync()
+        gimport.poll()
+        gimport.take()
+        self.sheet.append(['P0002', 'S0002_000', 'trypsin', 'human', '', 'TRUE', '', '', ''])
+        self.sheet[1][5] = 'FALSE'
+        # The scaffold process polls first and moves the snapshot on
+        scaffold.poll()
+        gimport.poll()
+        diff = gimport.take()
+        self.assertEqual([(r['Project_title'], r['Sample_ID']) for r in diff.added], [('P0002', 'S0002_000')])
+        self.assertEqual([(r['Project_title'], r['Sample_ID']) for r in diff.changed], [('P0000', 'S0000_000')])
+        self.assertEqual(gimport.take(), ([], [], []))
+
+    def test_removed_then_added_is_changed(self):
+        sync = self.sync()
+        sync.poll()
+        sync.take()
+        row = self.sheet.pop(2)
+        sync.poll()
+        self.sheet.append(row)
+        sync.poll()
+        diff = sync.take()
+        self.assertEqual((diff.added, diff.removed), ([], []))
+        self.assertEqual([(r['Project_title'], r['Sample_ID']) for r in diff.changed], [('P0000', 'S0000_001')])
+
+
+if __name__ == '__main__':
+    unittest.main()
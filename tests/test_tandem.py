@@ -0,0 +1,38 @@
+import os
+import unittest
+
+import msauto
+from fakes import synthetic_mgf
+from jobstore import *
+from tests.support import MsautoTestCase
+
+PSAMPLE = ('P0000', 'S0000_000', 'trypsin', 'human')
+
+
+class TandemSampleTest(MsautoTestCase):
+    def setUp(self):
+        super().setUp()
+        os.makedirs(msauto.get_proj_root('P0000'), exist_ok=True)
+        synthetic_mgf(msauto.get_sample_mgf_path(PSAMPLE), 20)
+        msauto.get_job_store().enqueue(STAGE_TANDEM, [PSAMPLE])
+
+    def state(self):
+        return msauto.get_job_store().connection().execute(
+            'SELECT state, attempts FROM jobs WHERE stage = ?', (STAGE_TANDEM,)).fetchone()
+
+    def test_search(self):
+        msauto.run_stage(STAGE_TANDEM, msauto.tandem_sample)
+        self.assertEqual(self.state()[0], DONE)
+        self.assertTrue(os.path.exists(msauto.get_sample_tandem_path(PSAMPLE)))
+
+    def test_failed_search_is_retried(self):
+        msauto.TANDEM_CMD = 'exit 3'
+        with self.assertRaises(RuntimeError):
+            msauto.run_stage(STAGE_TANDEM, msauto.tandem_sample)
+        self.assertEqual(self.state(), (QUEUED, 1))
+        msauto.flush_status()
+        self.assertEqual(self.sheet[1][4], 'Identification (Tandem) running')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from jobstore import JobStore
+from watcher import RawIndex
+
+KEY = ('P0000', 'S0000_000')
+
+
+class RawIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='watcher-test-')
+        self.store = JobStore(os.path.join(self.workdir, 'jobs.sqlite'))
+        self.root = os.path.join(self.workdir, 'raw')
+        os.makedirs(os.path.join(self.root, KEY[0]))
+        self.path = os.path.join(self.root, KEY[0], KEY[1] + '.raw')
+        self.now = 1000.0
+        # Every scan builds its own index, as a cron import does
+        self.index = lambda: RawIndex(self.store, self.root, 120, lambda: self.now)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def write(self, size, mtime):
+        with open(self.path, 'wb') as f:
+            f.write(b'\0' * size)
+        os.utime(self.path, (mtime, mtime))
+
+    def scan(self):
+        index = self.index()
+        index.scan()
+        return index.files()
+
+    def test_settled_after_two_equal_stats(self):
+        # mtime kept from the source by cp -p, long before the copy started
+        self.write(100, 10.0)
+        self.assertEqual(self.scan(), {KEY: False})
+        self.now = 1300.0
+        self.write(200, 1290.0)
+        self.assertEqual(self.scan(), {KEY: False})
+        self.now = 1400.0
+        self.assertEqual(self.scan(), {KEY: False})
+        self.now = 1420.0
+        self.assertEqual(self.scan(), {KEY: True})
+
+    def test_confirmed_files_are_not_stat_ed_again(self):
+        self.write(100, 10.0)
+        self.scan()
+        self.now = 1200.0
+        self.assertEqual(self.scan(), {KEY: True})
+        self.write(200, 1250.0)
+        self.now = 1300.0
+        self.assertEqual(self.scan(), {KEY: True})
+        # A change notification still resets it
+        index = self.index()
+        index.touch(self.path)
+        self.assertEqual(index.files(), {KEY: False})
+
+
+if __name__ == '__main__':
+    unittest.main()
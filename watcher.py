@@ -0,0 +1,147 @@
+import os
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+RAW_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS raw_files (
+    project TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    changed REAL NOT NULL,
+    confirmed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (project, sample)
+);
+'''
+
+
+class RawIndex:
+    '''Index of <root>/<project>/<sample>.raw files with size and mtime.
+
+    Kept in the job store database. A file counts as ready once two stats at
+    least `settle` seconds apart found the same size and mtime, so files still
+    being copied are not picked up however far apart the scans are. Files
+    confirmed stable are not stat-ed again, a scan only lists the project
+    directories.
+    '''
+
+    def __init__(self, store, root, settle=120, clock=time.time):
+        self.store = store
+        self.root = root
+        self.settle = settle
+        self.clock = clock
+        self.scanned = 0
+        with self.store.read() as db:
+            db.executescript(RAW_SCHEMA)
+            if 'confirmed' not in {column for _, column, *rest in db.execute('PRAGMA table_info(raw_files)')}:
+                db.execute('ALTER TABLE raw_files ADD COLUMN confirmed INTEGER NOT NULL DEFAULT 0')
+
+    def _known(self, db, project=None):
+        query, params = 'SELECT project, sample, size, mtime, changed, confirmed FROM raw_files', ()
+        if project is not None:
+            query, params = query + ' WHERE project = ?', (project,)
+        return {(p, s): (size, mtime, changed, confirmed) for p, s, size, mtime, changed, confirmed
+                in db.execute(query, params)}
+
+    def _stat(self, db, project, sample, path, known, now):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            db.execute('DELETE FROM raw_files WHERE project = ? AND sample = ?', (project, sample))
+            return
+        old = known.get((project, sample))
+        if old and (old[0], old[1]) == (st.st_size, st.st_mtime):
+            if not old[3] and now - old[2] >= self.settle:
+                db.execute('UPDATE raw_files SET confirmed = 1 WHERE project = ? AND sample = ?', (project, sample))
+            return
+        # Timed from this stat, not the mtime: copies made with cp -p or robocopy keep the one of the source
+        db.execute('INSERT OR REPLACE INTO raw_files (project, sample, size, mtime, changed, confirmed)'
+                   ' VALUES (?, ?, ?, ?, ?, ?)', (project, sample, st.st_size, st.st_mtime, now, self.settle <= 0))
+
+    def scan(self, projects=None):
+        '''Update the index from a listing of the project directories'''
+        now = self.clock()
+        if projects is None:
+            projects = [e.name for e in os.scandir(self.root) if e.is_dir()] if os.path.isdir(self.root) else []
+        for project in projects:
+            pdir = os.path.join(self.root, project)
+            present = set()
+            if os.path.isdir(pdir):
+                present = {e.name[:-4] for e in os.scandir(pdir) if e.name.endswith('.raw')}
+            with self.store.transaction() as db:
+                known = self._known(db, project)
+                for sample in present:
+                    old = known.get((project, sample))
+                    if old and old[3]:
+                        continue
+                    self._stat(db, project, sample, os.path.join(pdir, sample + '.raw'), known, now)
+                for project_, sample in known.keys() - {(project, s) for s in present}:
+                    db.execute('DELETE FROM raw_files WHERE project = ? AND sample = ?', (project_, sample))
+        self.scanned = now
+
+    def refresh(self, projects=None, max_age=0):
+        '''scan() unless someone else (the watcher) did it within max_age seconds'''
+        if self.clock() - self.scanned >= max_age:
+            self.scan(projects)
+
+    def touch(self, path):
+        '''Re-stat a single file, used for change notifications'''
+        pdir, name = os.path.split(path)
+        if not name.endswith('.raw'):
+            return
+        project, sample = os.path.basename(pdir), name[:-4]
+        with self.store.transaction() as db:
+            self._stat(db, project, sample, path, self._known(db, project), self.clock())
+
+    def files(self):
+        '''{(project, sample): settled} for every raw file present'''
+        with self.store.read() as db:
+            rows = db.execute('SELECT project, sample, confirmed FROM raw_files').fetchall()
+        return {(project, sample): bool(confirmed) for project, sample, confirmed in rows}
+
+    def watch(self, stopping, interval=60):
+        '''Keep the index current until stopping is set.
+
+        Uses inotify when available and falls back to polling scans; inotify
+        does not see changes made by other NFS clients, so a full scan still
+        runs every interval seconds.
+        '''
+        if inotify_simple is None or not os.path.isdir(self.root):
+            while not stopping.is_set():
+                self.scan()
+                stopping.wait(interval)
+            return
+
+        flags = inotify_simple.flags
+        mask = flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE | flags.MOVED_FROM
+        inotify = inotify_simple.INotify()
+        dirs = {}
+
+        def add(path):
+            if path not in dirs.values():
+                dirs[inotify.add_watch(path, mask)] = path
+
+        add(self.root)
+        for e in os.scandir(self.root):
+            if e.is_dir():
+                add(e.path)
+        self.scan()
+        last = time.time()
+        try:
+            while not stopping.is_set():
+                for event in inotify.read(timeout=1000):
+                    path = os.path.join(dirs.get(event.wd, self.root), event.name)
+                    if event.wd in dirs and dirs[event.wd] == self.root:
+                        if os.path.isdir(path):
+                            add(path)
+                    else:
+                        self.touch(path)
+                if time.time() - last >= interval:
+                    self.scan()
+                    last = time.time()
+        finally:
+            inotify.close()